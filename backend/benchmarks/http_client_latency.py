@@ -0,0 +1,96 @@
+# Measures what the pooled HTTP client saves per call, against a local stand-in for the Places API (no quota is used).
+#
+# Run from the backend folder:
+#   python benchmarks/http_client_latency.py --calls 200 --delay-ms 20
+#
+# "new client per call" is what the app used to do (a new connection for every request), "pooled client" is
+# http_client.create_google_client(). The stub server is plain HTTP on localhost, so the saving here is only the
+# TCP handshake; against places.googleapis.com every new connection also pays for a TLS handshake.
+
+import argparse
+import asyncio
+import os
+import socket
+import statistics
+import sys
+import threading
+import time
+
+import httpx
+import uvicorn
+from fastapi import FastAPI
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from http_client import create_google_client, request_with_retries, get_latency_stats  # noqa: E402
+
+
+def make_stub_app(delay_ms: float) -> FastAPI:
+    """A Nearby Search stand-in that waits delay_ms and returns no places."""
+    stub = FastAPI()
+
+    @stub.post("/v1/places:searchNearby")
+    async def search_nearby():
+        await asyncio.sleep(delay_ms / 1000)
+        return {"places": []}
+
+    return stub
+
+
+def start_stub_server(delay_ms: float) -> str:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(make_stub_app(delay_ms), host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return f"http://127.0.0.1:{port}"
+
+
+async def time_calls(url: str, calls: int, concurrency: int, pooled: bool) -> list[float]:
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+    shared = create_google_client() if pooled else None
+
+    async def one_call():
+        async with semaphore:
+            start = time.perf_counter()
+            if pooled:
+                # A label without a RATE_LIMITS entry, so the token bucket doesn't pace the benchmark
+                await request_with_retries(shared, "POST", url, "benchmark", json={})
+            else:
+                async with httpx.AsyncClient(timeout=30) as client:
+                    await client.post(url, json={})
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    await asyncio.gather(*(one_call() for _ in range(calls)))
+    if shared is not None:
+        await shared.aclose()
+    return latencies
+
+
+def summarize(name: str, latencies: list[float]):
+    latencies = sorted(latencies)
+    p95 = latencies[int(0.95 * (len(latencies) - 1))]
+    print(f"{name:<24} avg {statistics.mean(latencies):7.2f} ms   p50 {statistics.median(latencies):7.2f} ms   p95 {p95:7.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare a new HTTP client per call with the pooled client against a local stub server")
+    parser.add_argument("--calls", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--delay-ms", type=float, default=20, help="How long the stub takes to answer each call")
+    args = parser.parse_args()
+
+    url = f"{start_stub_server(args.delay_ms)}/v1/places:searchNearby"
+    new_client = asyncio.run(time_calls(url, args.calls, args.concurrency, pooled=False))
+    pooled = asyncio.run(time_calls(url, args.calls, args.concurrency, pooled=True))
+
+    summarize("new client per call", new_client)
+    summarize("pooled client", pooled)
+    print(f"saved per call: {statistics.mean(new_client) - statistics.mean(pooled):.2f} ms on average")
+    print(f"pooled client stats: {get_latency_stats()['benchmark']}")
+
+
+if __name__ == "__main__":
+    main()
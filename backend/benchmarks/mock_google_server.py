@@ -0,0 +1,202 @@
+# A local stand-in for the Google endpoints we call (Nearby Search, Text Search and Geocoding), serving synthetic data,
+# so the search pipelines can be tested and benchmarked without spending quota.
+#
+# Run from the backend folder:
+#   python benchmarks/mock_google_server.py --port 8100 --latency-ms 80 --error-rate 0.01 --rate-429 0.02
+# and point the app at it:
+#   GOOGLE_PLACES_BASE_URL=http://127.0.0.1:8100 GOOGLE_MAPS_BASE_URL=http://127.0.0.1:8100 uvicorn main:app
+#
+# Places sit on a jittered grid (--places-per-km2), so the same circle always returns the same places, dense areas
+# saturate at 20 results like the real Nearby Search, and overlapping searches find the same place ids.
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import math
+import random
+from collections import Counter
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+METERS_PER_DEGREE_LAT = 111320.0
+MAX_RESULT_COUNT = 20
+TEXT_SEARCH_PAGE_SIZE = 20
+TEXT_SEARCH_MAX_RESULTS = 60
+PLACE_TYPES = ["car_wash", "car_rental", "gas_station", "car_dealer", "car_repair", "parking"]
+
+# Set from the command line (or by tests that import the app)
+settings = {
+    "latency_ms": 50.0,
+    "jitter_ms": 10.0,
+    "error_rate": 0.0,
+    "rate_429": 0.0,
+    "places_per_km2": 0.5,
+    "seed": 0
+}
+stats = Counter()
+
+
+def _unit_hash(*parts) -> float:
+    """A stable number in [0, 1) for the given values."""
+    digest = hashlib.sha256(json.dumps([settings["seed"], *parts]).encode()).digest()
+    return int.from_bytes(digest[:8], "big") / 2 ** 64
+
+
+def _place(i: int, j: int, spacing_m: float) -> dict:
+    """The synthetic place in grid cell (i, j)."""
+    lat = (j + _unit_hash("lat", i, j)) * spacing_m / METERS_PER_DEGREE_LAT
+    lng = (i + _unit_hash("lng", i, j)) * spacing_m / (METERS_PER_DEGREE_LAT * math.cos(math.radians(lat)))
+    place_type = PLACE_TYPES[int(_unit_hash("type", i, j) * len(PLACE_TYPES))]
+    number = int(_unit_hash("number", i, j) * 9000) + 100
+    place = {
+        "id": f"mock-{i}-{j}",
+        "displayName": {"text": f"Mock {place_type.replace('_', ' ').title()} {i}/{j}", "languageCode": "en"},
+        "formattedAddress": f"{number} Synthetic St, Testville",
+        "location": {"latitude": round(lat, 7), "longitude": round(lng, 7)},
+        "types": [place_type],
+        "rating": round(1 + 4 * _unit_hash("rating", i, j), 1)
+    }
+    if _unit_hash("phone", i, j) < 0.8:
+        place["nationalPhoneNumber"] = f"(555) {number % 1000:03d}-{(i * 7919 + j) % 10000:04d}"
+    if _unit_hash("website", i, j) < 0.6:
+        place["websiteUri"] = f"https://mock-{i}-{j}.example.com/"
+    return place
+
+
+def places_in_circle(lat: float, lng: float, radius: float, included_types: list[str] | None) -> list[dict]:
+    """Every synthetic place within radius meters of (lat, lng), nearest first."""
+    spacing_m = 1000 / math.sqrt(settings["places_per_km2"])
+    # Cells are laid out in meters from (0, 0), the same way _place does it
+    j0 = lat * METERS_PER_DEGREE_LAT / spacing_m
+    cells_y = radius / spacing_m + 1
+    found = []
+    for j in range(math.floor(j0 - cells_y), math.ceil(j0 + cells_y) + 1):
+        row_lat = j * spacing_m / METERS_PER_DEGREE_LAT
+        meters_per_degree_lng = METERS_PER_DEGREE_LAT * math.cos(math.radians(row_lat))
+        i0 = lng * meters_per_degree_lng / spacing_m
+        cells_x = radius / spacing_m + 1
+        for i in range(math.floor(i0 - cells_x), math.ceil(i0 + cells_x) + 1):
+            place = _place(i, j, spacing_m)
+            if included_types and place["types"][0] not in included_types:
+                continue
+            dy = (place["location"]["latitude"] - lat) * METERS_PER_DEGREE_LAT
+            dx = (place["location"]["longitude"] - lng) * meters_per_degree_lng
+            distance = math.hypot(dx, dy)
+            if distance <= radius:
+                found.append((distance, place))
+    found.sort(key=lambda item: item[0])
+    return [place for _, place in found]
+
+
+def text_query_center(text_query: str) -> tuple[float, float]:
+    """A stable point in the continental US for a text query's region."""
+    return 30 + 15 * _unit_hash("query lat", text_query), -120 + 45 * _unit_hash("query lng", text_query)
+
+
+def apply_field_mask(place: dict, field_mask: str) -> dict:
+    fields = {field.split(".", 1)[1] for field in field_mask.split(",") if field.startswith("places.")}
+    if not fields or "*" in fields:
+        return place
+    return {key: value for key, value in place.items() if key in fields}
+
+
+async def simulate_network(endpoint: str):
+    """Wait like a real call would, and maybe fail. Returns an error response to send, or None."""
+    stats[f"{endpoint}_calls"] += 1
+    delay_ms = max(0.0, random.gauss(settings["latency_ms"], settings["jitter_ms"]))
+    await asyncio.sleep(delay_ms / 1000)
+    roll = random.random()
+    if roll < settings["rate_429"]:
+        stats[f"{endpoint}_429s"] += 1
+        return JSONResponse({"error": {"code": 429, "status": "RESOURCE_EXHAUSTED", "message": "Mock quota exceeded"}}, status_code=429)
+    if roll < settings["rate_429"] + settings["error_rate"]:
+        stats[f"{endpoint}_errors"] += 1
+        return JSONResponse({"error": {"code": 500, "status": "INTERNAL", "message": "Mock internal error"}}, status_code=500)
+    return None
+
+
+app = FastAPI()
+
+
+@app.post("/v1/places:searchNearby")
+async def search_nearby(request: Request):
+    error = await simulate_network("nearby_search")
+    if error:
+        return error
+    body = await request.json()
+    circle = body["locationRestriction"]["circle"]
+    places = places_in_circle(circle["center"]["latitude"], circle["center"]["longitude"], circle["radius"], body.get("includedTypes"))
+    max_results = min(body.get("maxResultCount", MAX_RESULT_COUNT), MAX_RESULT_COUNT)
+    field_mask = request.headers.get("X-Goog-FieldMask", "")
+    return {"places": [apply_field_mask(place, field_mask) for place in places[:max_results]]}
+
+
+@app.post("/v1/places:searchText")
+async def search_text(request: Request):
+    error = await simulate_network("text_search")
+    if error:
+        return error
+    body = await request.json()
+    text_query = body["textQuery"]
+    page = 0
+    if body.get("pageToken"):
+        page = json.loads(base64.urlsafe_b64decode(body["pageToken"]))["page"]
+
+    # Each query has a stable number of results, some of which need more than one page
+    lat, lng = text_query_center(text_query)
+    num_results = 5 + int(_unit_hash("num results", text_query) * (TEXT_SEARCH_MAX_RESULTS - 4))
+    places = places_in_circle(lat, lng, 15000, None)[:num_results]
+    page_places = places[page * TEXT_SEARCH_PAGE_SIZE:(page + 1) * TEXT_SEARCH_PAGE_SIZE]
+
+    field_mask = request.headers.get("X-Goog-FieldMask", "")
+    response = {"places": [apply_field_mask(place, field_mask) for place in page_places]}
+    if (page + 1) * TEXT_SEARCH_PAGE_SIZE < len(places):
+        response["nextPageToken"] = base64.urlsafe_b64encode(json.dumps({"page": page + 1}).encode()).decode()
+    return response
+
+
+@app.get("/maps/api/geocode/json")
+async def geocode(address: str, key: str = ""):
+    error = await simulate_network("geocode")
+    if error:
+        return error
+    zip_code = address.split(",")[0].strip()
+    if not zip_code.isdigit():
+        return {"status": "ZERO_RESULTS", "results": []}
+    location = {"lat": round(30 + 15 * _unit_hash("zip lat", zip_code), 7), "lng": round(-120 + 45 * _unit_hash("zip lng", zip_code), 7)}
+    return {"status": "OK", "results": [{"geometry": {"location": location}, "formatted_address": f"{zip_code}, USA"}]}
+
+
+@app.get("/mock/stats")
+def get_stats():
+    """How many calls each endpoint got (and how many were answered with injected errors)."""
+    return dict(stats)
+
+
+@app.post("/mock/reset")
+def reset_stats():
+    stats.clear()
+    return {}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Google Places and Geocoding endpoints")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--latency-ms", type=float, default=settings["latency_ms"], help="Average time to answer a call")
+    parser.add_argument("--jitter-ms", type=float, default=settings["jitter_ms"], help="Standard deviation of the latency")
+    parser.add_argument("--error-rate", type=float, default=settings["error_rate"], help="Fraction of calls answered with a 500")
+    parser.add_argument("--rate-429", type=float, default=settings["rate_429"], help="Fraction of calls answered with a 429")
+    parser.add_argument("--places-per-km2", type=float, default=settings["places_per_km2"], help="Density of synthetic places (0.5 saturates a 5km search)")
+    parser.add_argument("--seed", type=int, default=settings["seed"], help="Changes which synthetic places exist")
+    args = parser.parse_args()
+    settings.update({key: getattr(args, key) for key in settings})
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+# Load test for running the app as several worker processes (uvicorn --workers N), against the mock Google server.
+#
+# Run from the backend folder:
+#   python benchmarks/multi_worker_load.py                                  # 1, 2 and 4 workers with the sqlite backend
+#   python benchmarks/multi_worker_load.py --workers 1 4 8 --backend redis  # redis backend, served by a local fakeredis server
+#
+# For each worker count the app starts fresh in a scratch directory and runs two phases of one zip code searches
+# (use_cache false, so every search makes exactly one Nearby Search call):
+#   throughput: limits are out of the way, and we measure searches per second and latency.
+#   limit:      the Nearby Search daily limit is set to allow exactly --limit-calls more calls, and more searches than that
+#               are sent at once. With the counts shared between processes, exactly --limit-calls searches get through:
+#               the mock server must have served exactly that many calls, and the usage counts must match what it served.
+# Throughput only scales with workers when there's a CPU core for each of them, so compare runs on the machine you deploy to.
+
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import httpx
+
+from search_load import BACKEND_DIR, DEFAULT_ZIP_LIST, free_port, wait_for_port, percentile
+
+INCLUDED_TYPES = ["car_wash"]
+# Longer than settings.RELOAD_CHECK_SECONDS, so every worker has the rewritten config before the limit phase
+CONFIG_RELOAD_WAIT = 1.5
+
+
+def write_config(work_dir: str, nearby_daily_limit: int, keep_rate_limits: bool):
+    """Copy api_limit_config.json with every limit out of the way except the Nearby Search daily limit."""
+    with open(os.path.join(BACKEND_DIR, "api_limit_config.json")) as file:
+        config = json.load(file)
+    for limits in config["API_LIMITS"].values():
+        limits["DAILY"] = limits["MONTHLY"] = 10 ** 9
+    config["API_LIMITS"]["NEARBY_SEARCH"]["DAILY"] = nearby_daily_limit
+    if not keep_rate_limits:
+        config.pop("RATE_LIMITS", None)
+    with open(os.path.join(work_dir, "api_limit_config.json"), "w") as file:
+        json.dump(config, file, indent=2)
+
+
+def start_fake_redis() -> str:
+    """A Redis protocol server backed by fakeredis, in a thread of this process. Returns its url."""
+    from fakeredis import TcpFakeServer
+    port = free_port()
+    server = TcpFakeServer(("127.0.0.1", port), server_type="redis")
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    wait_for_port(port)
+    return f"redis://127.0.0.1:{port}/0"
+
+
+def start_servers(work_dir: str, workers: int, args, redis_url: str | None) -> tuple[subprocess.Popen, subprocess.Popen, str, str]:
+    mock_port, app_port = free_port(), free_port()
+    mock = subprocess.Popen([sys.executable, os.path.join(BACKEND_DIR, "benchmarks", "mock_google_server.py"),
+                             "--port", str(mock_port), "--latency-ms", str(args.latency_ms), "--jitter-ms", str(args.jitter_ms),
+                             "--places-per-km2", str(args.places_per_km2)])
+    mock_url = f"http://127.0.0.1:{mock_port}"
+    env = {**os.environ, "GOOGLE_PLACES_BASE_URL": mock_url, "GOOGLE_MAPS_BASE_URL": mock_url, "GOOGLE_MAPS_API_KEY": "benchmark",
+           "SHARED_STATE_BACKEND": args.backend}
+    if redis_url:
+        env["REDIS_URL"] = redis_url
+    app = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--app-dir", BACKEND_DIR, "--workers", str(workers),
+                            "--host", "127.0.0.1", "--port", str(app_port), "--log-level", "warning"],
+                           cwd=work_dir, env=env)
+    wait_for_port(mock_port)
+    wait_for_port(app_port)
+    return mock, app, mock_url, f"http://127.0.0.1:{app_port}"
+
+
+async def search(client: httpx.AsyncClient, zip_code: str, radius: int) -> dict:
+    start = time.perf_counter()
+    response = await client.post("/search_carwashes_zipcodes", json={"zip_codes": [zip_code], "included_types": INCLUDED_TYPES,
+                                                                      "radius": radius, "use_cache": False, "stream_mode": "batch"})
+    messages = [json.loads(line) for line in response.text.splitlines() if line.strip()]
+    refused = any("Limit exceeded" in str(message.get("error", "")) for message in messages)
+    return {"latency": time.perf_counter() - start, "refused": refused,
+            "error": not refused and any("error" in message for message in messages)}
+
+
+async def run_phase(app_url: str, zip_codes: list[str], concurrency: int, radius: int) -> dict:
+    async with httpx.AsyncClient(base_url=app_url, timeout=600) as client:
+        queue = list(zip_codes)
+        results = []
+
+        async def worker():
+            while queue:
+                results.append(await search(client, queue.pop(), radius))
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        wall_time = time.perf_counter() - start
+    latencies = [result["latency"] for result in results]
+    return {
+        "requests": len(results),
+        "refused": sum(1 for result in results if result["refused"]),
+        "errors": sum(1 for result in results if result["error"]),
+        "requests_per_s": len(results) / wall_time,
+        "p50_s": percentile(latencies, 50),
+        "p95_s": percentile(latencies, 95)
+    }
+
+
+async def nearby_calls(app_url: str, mock_url: str) -> tuple[int, int]:
+    """(Nearby Search calls the mock server served, Nearby Search calls counted today by the app)"""
+    async with httpx.AsyncClient() as client:
+        served = (await client.get(f"{mock_url}/mock/stats")).json().get("nearby_search_calls", 0)
+        counted = (await client.get(f"{app_url}/api_analytics")).json()["nearby_search_calls"]["daily_count"]
+    return served, counted
+
+
+async def run_workers(workers: int, zip_codes: list[str], args) -> dict:
+    work_dir = tempfile.mkdtemp(prefix="multi_worker_load_")
+    write_config(work_dir, 10 ** 9, args.keep_rate_limits)
+    redis_url = start_fake_redis() if args.backend == "redis" else None
+    mock, app, mock_url, app_url = start_servers(work_dir, workers, args, redis_url)
+    try:
+        throughput_zips = zip_codes[:args.requests]
+        limit_zips = zip_codes[args.requests:args.requests + args.limit_calls + args.limit_excess]
+        throughput = await run_phase(app_url, throughput_zips, args.concurrency, args.radius)
+        served_before, counted_before = await nearby_calls(app_url, mock_url)
+
+        # Every worker reloads the config within settings.RELOAD_CHECK_SECONDS of the file changing
+        write_config(work_dir, counted_before + args.limit_calls, args.keep_rate_limits)
+        await asyncio.sleep(CONFIG_RELOAD_WAIT)
+        limit = await run_phase(app_url, limit_zips, args.concurrency, args.radius)
+        served_after, counted_after = await nearby_calls(app_url, mock_url)
+    finally:
+        app.terminate()
+        mock.terminate()
+        app.wait()
+        mock.wait()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    limit_served = served_after - served_before
+    return {
+        "workers": workers,
+        "backend": args.backend,
+        "throughput": throughput,
+        "limit": {**limit, "allowed_calls": args.limit_calls, "calls_served": limit_served,
+                  "calls_counted": counted_after - counted_before, "total_served": served_after, "total_counted": counted_after},
+        "limit_exact": limit_served == args.limit_calls and served_after == counted_after
+    }
+
+
+def print_report(report: list[dict]):
+    header = (f"{'workers':>8}{'backend':>9}{'reqs':>6}{'req/s':>8}{'p50 s':>8}{'p95 s':>8}{'err':>5}"
+              f"  |{'allowed':>8}{'served':>8}{'counted':>8}{'refused':>8}{'exact':>7}")
+    print(header)
+    print("-" * len(header))
+    for row in report:
+        throughput, limit = row["throughput"], row["limit"]
+        print(f"{row['workers']:>8}{row['backend']:>9}{throughput['requests']:>6}{throughput['requests_per_s']:>8.2f}"
+              f"{throughput['p50_s']:>8.3f}{throughput['p95_s']:>8.3f}{throughput['errors']:>5}"
+              f"  |{limit['allowed_calls']:>8}{limit['calls_served']:>8}{limit['calls_counted']:>8}{limit['refused']:>8}"
+              f"{'yes' if row['limit_exact'] else 'NO':>7}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that throughput scales with worker processes while api call limits stay exact")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="Worker process counts to compare")
+    parser.add_argument("--backend", choices=["sqlite", "redis"], default="sqlite", help="Shared state backend (redis uses a local fakeredis server)")
+    parser.add_argument("--requests", type=int, default=200, help="One zip code searches in the throughput phase")
+    parser.add_argument("--concurrency", type=int, default=32, help="How many searches are sent at once")
+    parser.add_argument("--limit-calls", type=int, default=50, help="Nearby Search calls the limit phase allows")
+    parser.add_argument("--limit-excess", type=int, default=50, help="Searches sent past what the limit phase allows")
+    parser.add_argument("--radius", type=int, default=2000)
+    parser.add_argument("--keep-rate-limits", action="store_true", help="Keep RATE_LIMITS, which caps calls per second across every worker")
+    parser.add_argument("--latency-ms", type=float, default=80)
+    parser.add_argument("--jitter-ms", type=float, default=20)
+    parser.add_argument("--places-per-km2", type=float, default=0.5)
+    parser.add_argument("--zip-list", default=DEFAULT_ZIP_LIST, help="Where the zip codes come from (each search uses a different one)")
+    parser.add_argument("--json", help="Save the results to this file")
+    args = parser.parse_args()
+
+    sys.path.insert(0, BACKEND_DIR)
+    from geocode_cache import read_zip_code_list
+    zip_codes = list(dict.fromkeys(read_zip_code_list(args.zip_list)))
+    needed = args.requests + args.limit_calls + args.limit_excess
+    if len(zip_codes) < needed:
+        parser.error(f"{args.zip_list} has {len(zip_codes)} zip codes, the test needs {needed}")
+
+    report = []
+    for workers in args.workers:
+        row = asyncio.run(run_workers(workers, zip_codes, args))
+        report.append(row)
+        print(f"finished {workers} workers: {row['throughput']['requests_per_s']:.2f} searches/s", file=sys.stderr)
+
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(report, file, indent=2)
+    if not all(row["limit_exact"] for row in report):
+        print("\nThe api call limit wasn't exact with every worker count", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,310 @@
+# Load benchmark for the search endpoints, run against the mock Google server so it doesn't spend any quota.
+#
+# Run from the backend folder:
+#   python benchmarks/search_load.py                                   # default scenarios
+#   python benchmarks/search_load.py --zip-counts 1 10 50 --concurrency 1 4 --rounds 3 --json results.json
+#   python benchmarks/search_load.py --baseline results.json           # exits 1 if p95 latency, calls per lead or peak RSS regressed
+#
+# The app and the mock server run as subprocesses in a scratch directory (so the benchmark's usage counts and caches
+# don't touch the real ones). Every search is sent with use_cache false unless --use-cache is given.
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import httpx
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REPO_DIR = os.path.dirname(BACKEND_DIR)
+DEFAULT_ZIP_LIST = os.path.join(REPO_DIR, "docs", "zipcodes", "NY_zipcodes.csv")
+INCLUDED_TYPES = ["car_wash", "car_dealer", "car_repair"]
+REGIONAL_QUERIES = ["car wash", "auto detailing", "oil change", "tire shop"]
+REGIONAL_REGIONS = ["Albany, NY", "Troy, NY", "Schenectady, NY", "Saratoga Springs, NY", "Utica, NY", "Syracuse, NY"]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port: int, timeout: float = 30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        with socket.socket() as sock:
+            if sock.connect_ex(("127.0.0.1", port)) == 0:
+                return
+        time.sleep(0.1)
+    raise RuntimeError(f"Nothing is listening on port {port} after {timeout}s")
+
+
+def percentile(values: list[float], pct: float) -> float | None:
+    if not values:
+        return None
+    values = sorted(values)
+    rank = (len(values) - 1) * pct / 100
+    low, high = math.floor(rank), math.ceil(rank)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+class PeakMemory:
+    """Tracks the peak resident memory of a process while a scenario runs (psutil if installed, /proc on Linux otherwise)."""
+
+    def __init__(self, pid: int):
+        self.pid = pid
+        self.peak_bytes = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _rss(self) -> int:
+        if psutil is not None:
+            return psutil.Process(self.pid).memory_info().rss
+        with open(f"/proc/{self.pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+        return 0
+
+    def _poll(self):
+        while not self._stop.is_set():
+            try:
+                self.peak_bytes = max(self.peak_bytes, self._rss())
+            except (OSError, ValueError):
+                return
+            self._stop.wait(0.05)
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._poll, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+
+def write_benchmark_config(work_dir: str, page_delay: float, keep_rate_limits: bool):
+    """Copy api_limit_config.json with limits high enough that the benchmark never gets refused."""
+    with open(os.path.join(BACKEND_DIR, "api_limit_config.json")) as file:
+        config = json.load(file)
+    for limits in config["API_LIMITS"].values():
+        limits["DAILY"] = limits["MONTHLY"] = 10 ** 9
+    config.setdefault("SEARCH_SETTINGS", {})["TEXT_SEARCH_PAGE_DELAY"] = page_delay
+    if not keep_rate_limits:
+        config.pop("RATE_LIMITS", None)
+    with open(os.path.join(work_dir, "api_limit_config.json"), "w") as file:
+        json.dump(config, file, indent=2)
+
+
+def start_servers(work_dir: str, args) -> tuple[subprocess.Popen, subprocess.Popen, str, str]:
+    mock_port, app_port = free_port(), free_port()
+    mock = subprocess.Popen([sys.executable, os.path.join(BACKEND_DIR, "benchmarks", "mock_google_server.py"),
+                             "--port", str(mock_port), "--latency-ms", str(args.latency_ms), "--jitter-ms", str(args.jitter_ms),
+                             "--error-rate", str(args.error_rate), "--rate-429", str(args.rate_429),
+                             "--places-per-km2", str(args.places_per_km2)])
+    mock_url = f"http://127.0.0.1:{mock_port}"
+    env = {**os.environ, "GOOGLE_PLACES_BASE_URL": mock_url, "GOOGLE_MAPS_BASE_URL": mock_url, "GOOGLE_MAPS_API_KEY": "benchmark"}
+    # The scratch geocode cache is pre-loaded from the bundled zip code centroids on first use, like in the Docker image
+    app = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--app-dir", BACKEND_DIR,
+                            "--host", "127.0.0.1", "--port", str(app_port), "--log-level", "warning"],
+                           cwd=work_dir, env=env)
+    wait_for_port(mock_port)
+    wait_for_port(app_port)
+    return mock, app, mock_url, f"http://127.0.0.1:{app_port}"
+
+
+async def timed_request(client: httpx.AsyncClient, path: str, payload: dict) -> dict:
+    """Send one search and time it. Streaming responses are read line by line to get the time to the first event."""
+    start = time.perf_counter()
+    first_event = None
+    lines = []
+    async with client.stream("POST", path, json=payload) as response:
+        async for line in response.aiter_lines():
+            if not line.strip():
+                continue
+            if first_event is None:
+                first_event = time.perf_counter() - start
+            lines.append(line)
+    elapsed = time.perf_counter() - start
+
+    lead_ids = set()
+    error = None
+    for line in lines:
+        message = json.loads(line)
+        if "error" in message:
+            error = message["error"]
+        for lead in message.get("results", []):
+            lead_ids.add(lead["goog_places_id"])
+        if message.get("type") == "place":
+            lead_ids.add(message["place"]["goog_places_id"])
+    return {"latency": elapsed, "first_event": first_event, "lead_ids": lead_ids, "error": error}
+
+
+async def run_scenario(app_url: str, mock_url: str, app_pid: int, name: str, path: str, payloads: list[dict], concurrency: int) -> dict:
+    """Send every payload, concurrency at a time, and summarize the run."""
+    async with httpx.AsyncClient(base_url=app_url, timeout=600) as client, httpx.AsyncClient(base_url=mock_url) as mock:
+        await mock.post("/mock/reset")
+        queue = list(payloads)
+        results = []
+
+        async def worker():
+            while queue:
+                results.append(await timed_request(client, path, queue.pop()))
+
+        start = time.perf_counter()
+        with PeakMemory(app_pid) as memory:
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+        wall_time = time.perf_counter() - start
+        mock_stats = (await mock.get("/mock/stats")).json()
+
+    latencies = [result["latency"] for result in results]
+    first_events = [result["first_event"] for result in results if result["first_event"] is not None]
+    lead_ids = set().union(*(result["lead_ids"] for result in results))
+    google_calls = sum(count for key, count in mock_stats.items() if key.endswith("_calls"))
+    return {
+        "scenario": name,
+        "requests": len(results),
+        "concurrency": concurrency,
+        "errors": sum(1 for result in results if result["error"]),
+        "p50_s": percentile(latencies, 50),
+        "p95_s": percentile(latencies, 95),
+        "p99_s": percentile(latencies, 99),
+        "first_event_p50_s": percentile(first_events, 50),
+        "requests_per_s": len(results) / wall_time,
+        "peak_rss_mb": memory.peak_bytes / 2 ** 20,
+        "google_calls": google_calls,
+        "unique_leads": len(lead_ids),
+        "calls_per_lead": google_calls / len(lead_ids) if lead_ids else None,
+        "mock_stats": mock_stats
+    }
+
+
+def zipcode_payloads(zip_codes: list[str], zip_count: int, rounds: int, args) -> list[dict]:
+    """rounds searches of zip_count zip codes each, each round a different slice of the zip list."""
+    payloads = []
+    for round_number in range(rounds):
+        start = (round_number * zip_count) % max(1, len(zip_codes) - zip_count + 1)
+        payloads.append({"zip_codes": zip_codes[start:start + zip_count], "included_types": INCLUDED_TYPES,
+                         "radius": args.radius, "use_cache": args.use_cache, "adaptive_tiling": args.adaptive_tiling,
+                         "plan_coverage": args.plan_coverage, "stream_mode": args.stream_mode})
+    return payloads
+
+
+def regional_payloads(rounds: int, args) -> list[dict]:
+    pairs = [(query, region) for region in REGIONAL_REGIONS for query in REGIONAL_QUERIES]
+    return [{"query": query, "region": region, "use_cache": args.use_cache} for query, region in (pairs[i % len(pairs)] for i in range(rounds))]
+
+
+def print_report(report: list[dict]):
+    header = f"{'scenario':<28}{'reqs':>5}{'conc':>5}{'err':>5}{'p50 s':>8}{'p95 s':>8}{'p99 s':>8}{'1st ev':>8}{'req/s':>7}{'RSS MB':>8}{'calls':>7}{'leads':>7}{'call/lead':>10}"
+    print(header)
+    print("-" * len(header))
+
+    def fmt(value, width, digits=2):
+        return f"{'-':>{width}}" if value is None else f"{value:>{width}.{digits}f}"
+
+    for row in report:
+        print(f"{row['scenario']:<28}{row['requests']:>5}{row['concurrency']:>5}{row['errors']:>5}"
+              f"{fmt(row['p50_s'], 8)}{fmt(row['p95_s'], 8)}{fmt(row['p99_s'], 8)}{fmt(row['first_event_p50_s'], 8)}"
+              f"{fmt(row['requests_per_s'], 7)}{fmt(row['peak_rss_mb'], 8, 1)}{row['google_calls']:>7}{row['unique_leads']:>7}{fmt(row['calls_per_lead'], 10, 3)}")
+
+
+def compare_to_baseline(report: list[dict], baseline_path: str, tolerance: float) -> bool:
+    """Print how each scenario changed since the baseline run. Returns False if any p95 latency or calls per lead got worse than tolerance."""
+    with open(baseline_path) as file:
+        baseline = {row["scenario"] + f"@{row['concurrency']}": row for row in json.load(file)}
+    ok = True
+    print(f"\nCompared to {baseline_path} (tolerance {tolerance:.0%}):")
+    for row in report:
+        before = baseline.get(row["scenario"] + f"@{row['concurrency']}")
+        if before is None:
+            continue
+        for metric in ("p95_s", "calls_per_lead", "peak_rss_mb"):
+            if before.get(metric) and row.get(metric) is not None:
+                change = row[metric] / before[metric] - 1
+                regressed = change > tolerance
+                ok = ok and not regressed
+                print(f"  {row['scenario']:<28} c={row['concurrency']:<3} {metric:<15} {before[metric]:9.3f} -> {row[metric]:9.3f} ({change:+.0%}){'  REGRESSION' if regressed else ''}")
+    return ok
+
+
+async def run_benchmarks(args, app_url: str, mock_url: str, app_pid: int) -> list[dict]:
+    sys.path.insert(0, BACKEND_DIR)
+    from geocode_cache import read_zip_code_list
+    zip_codes = list(dict.fromkeys(read_zip_code_list(args.zip_list)))
+
+    report = []
+    for concurrency in args.concurrency:
+        for zip_count in args.zip_counts:
+            payloads = zipcode_payloads(zip_codes, zip_count, args.rounds * concurrency, args)
+            row = await run_scenario(app_url, mock_url, app_pid, f"zipcodes x{zip_count}", "/search_carwashes_zipcodes", payloads, concurrency)
+            report.append(row)
+            print(f"finished {row['scenario']} at concurrency {concurrency} in p50 {row['p50_s']:.2f}s", file=sys.stderr)
+        if not args.skip_regional:
+            payloads = regional_payloads(args.rounds * concurrency, args)
+            row = await run_scenario(app_url, mock_url, app_pid, "regions", "/search_carwashes_regions", payloads, concurrency)
+            report.append(row)
+            print(f"finished regions at concurrency {concurrency} in p50 {row['p50_s']:.2f}s", file=sys.stderr)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the search endpoints against the mock Google server")
+    parser.add_argument("--zip-counts", type=int, nargs="+", default=[1, 10, 50], help="Zip list sizes to search")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4], help="How many searches run at once")
+    parser.add_argument("--rounds", type=int, default=3, help="Searches per scenario per concurrent client")
+    parser.add_argument("--zip-list", default=DEFAULT_ZIP_LIST, help="Where the zip codes come from")
+    parser.add_argument("--radius", type=int, default=5000)
+    parser.add_argument("--stream-mode", choices=["batch", "incremental"], default="batch")
+    parser.add_argument("--adaptive-tiling", action="store_true")
+    parser.add_argument("--plan-coverage", action="store_true")
+    parser.add_argument("--use-cache", action="store_true", help="Let searches use the result cache")
+    parser.add_argument("--skip-regional", action="store_true")
+    parser.add_argument("--page-delay", type=float, default=0, help="TEXT_SEARCH_PAGE_DELAY for the app (the mock's page tokens work right away)")
+    parser.add_argument("--no-rate-limits", action="store_true", help="Drop RATE_LIMITS so calls aren't paced")
+    parser.add_argument("--latency-ms", type=float, default=80)
+    parser.add_argument("--jitter-ms", type=float, default=20)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--places-per-km2", type=float, default=0.5)
+    parser.add_argument("--json", help="Save the results to this file (e.g. to use as a --baseline later)")
+    parser.add_argument("--baseline", help="Results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="How much worse a metric can get before it counts as a regression")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="search_load_")
+    write_benchmark_config(work_dir, args.page_delay, not args.no_rate_limits)
+    mock, app, mock_url, app_url = start_servers(work_dir, args)
+    try:
+        report = asyncio.run(run_benchmarks(args, app_url, mock_url, app.pid))
+    finally:
+        app.terminate()
+        mock.terminate()
+        app.wait()
+        mock.wait()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(report, file, indent=2)
+    if args.baseline and not compare_to_baseline(report, args.baseline, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
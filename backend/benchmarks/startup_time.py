@@ -0,0 +1,211 @@
+# Cold start benchmark: how long the app takes to import, to start answering, and to answer its first search, and how
+# often it reads api_limit_config.json while it serves requests. Runs against the mock Google server so it doesn't
+# spend any quota.
+#
+# Run from the backend folder:
+#   python benchmarks/startup_time.py                                  # 5 cold starts
+#   python benchmarks/startup_time.py --rounds 10 --json startup.json
+#   python benchmarks/startup_time.py --baseline startup.json          # exits 1 if a startup time got worse
+#   python benchmarks/startup_time.py --app-dir /tmp/old/backend       # another checkout of the backend, to compare with
+#
+# Each round starts a fresh app process in the same scratch directory (after one round that isn't counted, which fills
+# the scratch geocode cache and the OS file cache, like an image that has been pulled before) and measures:
+#   import_s:        importing main.py on its own (python -c "import main"), what every worker process pays first
+#   ready_s:         from starting uvicorn until it accepts connections
+#   first_request_s: from starting uvicorn until the first "/check_api_call_limits" response
+#   first_search_s:  from starting uvicorn until the first one zip code search is done (sent at the same time as the
+#                    first request, as soon as the app accepts connections, like the traffic a new container gets)
+#   warm_search_s:   the median of --searches more one zip code searches
+#   config_reads:    api_limit_config.json reads while serving all of that (the config_read stage in "/metrics")
+
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from search_load import BACKEND_DIR, DEFAULT_ZIP_LIST, free_port, wait_for_port, write_benchmark_config
+
+INCLUDED_TYPES = ["car_wash"]
+IMPORT_SCRIPT = "import time; start = time.perf_counter(); import main; print(time.perf_counter() - start)"
+METRICS = ("import_s", "ready_s", "first_request_s", "first_search_s", "warm_search_s")
+
+
+def start_mock(args) -> tuple[subprocess.Popen, str]:
+    port = free_port()
+    mock = subprocess.Popen([sys.executable, os.path.join(BACKEND_DIR, "benchmarks", "mock_google_server.py"),
+                             "--port", str(port), "--latency-ms", str(args.latency_ms), "--jitter-ms", "0"])
+    wait_for_port(port)
+    return mock, f"http://127.0.0.1:{port}"
+
+
+def app_env(mock_url: str, app_dir: str) -> dict:
+    return {**os.environ, "GOOGLE_PLACES_BASE_URL": mock_url, "GOOGLE_MAPS_BASE_URL": mock_url, "GOOGLE_MAPS_API_KEY": "benchmark",
+            "PYTHONPATH": app_dir}
+
+
+def measure_import(work_dir: str, env: dict) -> float:
+    output = subprocess.run([sys.executable, "-c", IMPORT_SCRIPT], cwd=work_dir, env=env, capture_output=True, text=True, check=True)
+    return float(output.stdout.strip().splitlines()[-1])
+
+
+def wait_until_accepting(port: int, app: subprocess.Popen, timeout: float = 60):
+    """Poll every 5 ms (wait_for_port polls every 100 ms, too coarse to time a startup with)."""
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if app.poll() is not None:
+            raise RuntimeError(f"The app exited with {app.returncode} before it started")
+        with socket.socket() as sock:
+            if sock.connect_ex(("127.0.0.1", port)) == 0:
+                return
+        time.sleep(0.005)
+    raise RuntimeError(f"The app didn't start within {timeout}s")
+
+
+def config_reads(metrics_text: str) -> int:
+    for line in metrics_text.splitlines():
+        if line.startswith("carwash_stage_seconds_count") and 'stage="config_read"' in line:
+            return int(float(line.split()[-1]))
+    return 0
+
+
+async def search(client: httpx.AsyncClient, zip_code: str) -> float:
+    start = time.perf_counter()
+    response = await client.post("/search_carwashes_zipcodes", json={"zip_codes": [zip_code], "included_types": INCLUDED_TYPES,
+                                                                      "radius": 2000, "use_cache": False, "stream_mode": "batch"})
+    elapsed = time.perf_counter() - start
+    messages = [json.loads(line) for line in response.text.splitlines() if line.strip()]
+    errors = [message["error"] for message in messages if "error" in message]
+    if errors:
+        raise RuntimeError(f"Search for {zip_code} failed: {errors[0]}")
+    return elapsed
+
+
+async def serve_requests(app_url: str, zip_codes: list[str], start: float) -> dict:
+    async with httpx.AsyncClient(base_url=app_url, timeout=120) as client:
+        async def first_request():
+            (await client.get("/check_api_call_limits")).raise_for_status()
+            return time.perf_counter() - start
+
+        async def first_search():
+            await search(client, zip_codes[0])
+            return time.perf_counter() - start
+
+        first_request_s, first_search_s = await asyncio.gather(first_request(), first_search())
+        warm_searches = [await search(client, zip_code) for zip_code in zip_codes[1:]]
+        for _ in range(len(warm_searches)):
+            (await client.get("/check_api_call_limits")).raise_for_status()
+        reads = config_reads((await client.get("/metrics")).text)
+    return {"first_request_s": first_request_s, "first_search_s": first_search_s,
+            "warm_search_s": statistics.median(warm_searches) if warm_searches else None,
+            "requests": 2 * len(zip_codes), "config_reads": reads}
+
+
+def run_round(work_dir: str, env: dict, app_dir: str, zip_codes: list[str]) -> dict:
+    row = {"import_s": measure_import(work_dir, env)}
+    port = free_port()
+    start = time.perf_counter()
+    app = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--app-dir", app_dir,
+                            "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+                           cwd=work_dir, env=env)
+    try:
+        wait_until_accepting(port, app)
+        row["ready_s"] = time.perf_counter() - start
+        row.update(asyncio.run(serve_requests(f"http://127.0.0.1:{port}", zip_codes, start)))
+    finally:
+        app.terminate()
+        app.wait()
+    return row
+
+
+def summarize(rounds: list[dict]) -> dict:
+    summary = {metric: statistics.median(row[metric] for row in rounds) for metric in METRICS if rounds[0].get(metric) is not None}
+    summary["config_reads_per_request"] = statistics.median(row["config_reads"] / row["requests"] for row in rounds)
+    summary["rounds"] = rounds
+    return summary
+
+
+def print_report(summary: dict):
+    print(f"{'metric':<26}{'median':>10}{'min':>10}{'max':>10}")
+    print("-" * 56)
+    for metric in METRICS:
+        if metric in summary:
+            values = [row[metric] for row in summary["rounds"]]
+            print(f"{metric:<26}{summary[metric]:>10.3f}{min(values):>10.3f}{max(values):>10.3f}")
+    print(f"{'config_reads_per_request':<26}{summary['config_reads_per_request']:>10.3f}")
+
+
+def compare_to_baseline(summary: dict, baseline_path: str, tolerance: float) -> bool:
+    """Print how each median changed since the baseline run. Returns False if any got worse than tolerance."""
+    with open(baseline_path) as file:
+        baseline = json.load(file)
+    ok = True
+    print(f"\nCompared to {baseline_path} (tolerance {tolerance:.0%}):")
+    for metric in METRICS + ("config_reads_per_request",):
+        before, after = baseline.get(metric), summary.get(metric)
+        if before and after is not None:
+            change = after / before - 1
+            regressed = change > tolerance
+            ok = ok and not regressed
+            print(f"  {metric:<26} {before:9.3f} -> {after:9.3f} ({change:+.0%}){'  REGRESSION' if regressed else ''}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the app's cold start and first request times, and config file reads per request")
+    parser.add_argument("--rounds", type=int, default=5, help="Cold starts to measure")
+    parser.add_argument("--searches", type=int, default=10, help="Warm searches after the cold one in each round")
+    parser.add_argument("--app-dir", default=BACKEND_DIR, help="The backend folder to start (e.g. an older checkout to compare with)")
+    parser.add_argument("--zip-list", default=DEFAULT_ZIP_LIST, help="Where the zip codes come from (each search uses a different one)")
+    parser.add_argument("--latency-ms", type=float, default=20, help="Latency of the mock Google server")
+    parser.add_argument("--json", help="Save the results to this file (e.g. to use as a --baseline later)")
+    parser.add_argument("--baseline", help="Results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="How much worse a median can get before it counts as a regression")
+    args = parser.parse_args()
+
+    sys.path.insert(0, BACKEND_DIR)
+    from geocode_cache import read_zip_code_list
+    zip_codes = list(dict.fromkeys(read_zip_code_list(args.zip_list)))
+    needed = (args.rounds + 1) * (args.searches + 1)
+    if len(zip_codes) < needed:
+        parser.error(f"{args.zip_list} has {len(zip_codes)} zip codes, the benchmark needs {needed}")
+
+    app_dir = os.path.abspath(args.app_dir)
+    work_dir = tempfile.mkdtemp(prefix="startup_time_")
+    write_benchmark_config(work_dir, 0, False)
+    mock, mock_url = start_mock(args)
+    env = app_env(mock_url, app_dir)
+    rounds = []
+    try:
+        for round_number in range(args.rounds + 1):
+            round_zip_codes = zip_codes[round_number * (args.searches + 1):(round_number + 1) * (args.searches + 1)]
+            row = run_round(work_dir, env, app_dir, round_zip_codes)
+            if round_number == 0:
+                print(f"finished the warm up round: ready in {row['ready_s']:.3f}s", file=sys.stderr)
+                continue
+            rounds.append(row)
+            print(f"finished round {round_number}: ready in {row['ready_s']:.3f}s", file=sys.stderr)
+    finally:
+        mock.terminate()
+        mock.wait()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    summary = summarize(rounds)
+    print_report(summary)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(summary, file, indent=2)
+    if args.baseline and not compare_to_baseline(summary, args.baseline, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,92 +1,316 @@
-import requests
+import asyncio
 import time
 import json
+import httpx
 #from utils import check_api_call_limit
-from check_api_call_limit import  check_api_call_limit_new
+from check_api_call_limit import check_api_call_limit_async
+from quota_scheduler import CallReservation, active_reservation, run_with_reservation
+from http_client import get_shared_client, request_with_retries, PLACES_BASE_URL
+from metrics import timed
+from settings import get_config
+from lead_dedup import dedupe_leads
+from lead_store import record_text_search, get_text_search_leads, record_search_run
+from search_cache import make_cache_key, get_cached_response, is_cached, cache_response, record_cache_bypass, DEFAULT_TTL_SECONDS, DEFAULT_MAX_ENTRIES
 
-def get_all_car_washes(api_key, region, query):
+PLACES_TEXT_SEARCH_URL = f"{PLACES_BASE_URL}/v1/places:searchText"
+TEXT_SEARCH_FIELD_MASK = "places.displayName,places.formattedAddress,places.rating,places.location,places.id,places.nationalPhoneNumber,places.websiteUri,places.types,nextPageToken"
+
+# Text Search returns at most 3 pages of 20 results
+MAX_TEXT_SEARCH_PAGES = 3
+# Google needs a moment before a nextPageToken can be used. Used if SEARCH_SETTINGS doesn't set TEXT_SEARCH_PAGE_DELAY.
+DEFAULT_TEXT_SEARCH_PAGE_DELAY = 2
+# How many regional searches of a batch run at once. Used if SEARCH_SETTINGS doesn't set REGIONAL_BATCH_CONCURRENCY.
+DEFAULT_REGIONAL_BATCH_CONCURRENCY = 4
+
+
+def text_search_query(query: str, region: str) -> str:
+    """The textQuery we send for a query and region."""
+    # Strip quotation marks from the query parameter
+    query = query.replace('"', '')
+    return f"{query} {region}"
+
+
+def text_search_cache_key(text_query: str) -> str:
+    """The result cache key of a Text Search (the same query with the same field mask gives the same results)."""
+    return make_cache_key("searchText", TEXT_SEARCH_FIELD_MASK, text_query=text_query, language_code="en")
+
+
+def car_wash_record(place: dict) -> dict:
+    """Turn a raw Text Search place (or a lead from the lead store) into the car wash record we send to the frontend."""
+    if "goog_places_id" in place:
+        return {key: place[key] for key in ("name", "address", "goog_rating", "phone", "website", "lat", "lng", "goog_places_id")}
+    return {
+        "name": place["displayName"]["text"],
+        "address": place.get("formattedAddress"),
+        "goog_rating": place.get("rating"),
+        "phone": place.get("nationalPhoneNumber"),
+        "website": place.get("websiteUri"),
+        "lat": place["location"]["latitude"],
+        "lng": place["location"]["longitude"],
+        "goog_places_id": place['id'],
+    }
+
+
+async def iter_car_wash_pages(api_key, region, query, use_cache=True, client: httpx.AsyncClient | None = None):
     """
-    Fetch car washes in a region using Google Places API.
+    Fetch car washes in a region using Google Places API, one page at a time.
     Makes multiple API calls to get car wash and detailing businesses,
     handling pagination and API usage limits.
 
+    This is an async generator, so each page can be used (or streamed to the frontend) as soon as it arrives,
+    and the wait before the next page doesn't block the server.
+
     Args:
         api_key (str): Google Maps API key.
         region (str): Search region.
+        query (str): What to search for, e.g. "car wash".
+        use_cache (bool): Serve a recent identical search from the result cache. Defaults to True.
+        client (httpx.AsyncClient, optional): HTTP client to use. Defaults to the shared pooled client.
 
-    Returns:
-        list: Car wash info (name, address, rating, etc.) if successful.
-        dict: Error details if API limit exceeded.
+    Yields:
+        dict: {"type": "page", "page": page number, "results": car wash info (name, address, rating, etc.), "from_cache": bool}
+              or {"error": ...} if an API limit is exceeded or Google returns an error (the last thing yielded).
 
     Notes:
         - Uses check_api_call_limit to stay within API limits.
-        - Maximum 3 API calls per invocation.
-        - Searches for "car wash and car detailing" businesses.
+        - Maximum 3 API calls per invocation, reserved up front (see quota_scheduler.py) and refunded if there are fewer pages.
+        - Results are cached (see RESULT_CACHE in api_limit_config.json); a cache hit makes no API calls
+          and comes back as a single page.
     """
+    # The api_limit_config.json settings (loaded once, and again only when the file changes)
+    config = get_config()
+    api_limits = config["API_LIMITS"]
+    cache_config = config.get("RESULT_CACHE", {})
+    page_delay = config.get("SEARCH_SETTINGS", {}).get("TEXT_SEARCH_PAGE_DELAY", DEFAULT_TEXT_SEARCH_PAGE_DELAY)
 
+    client = client or get_shared_client()
 
-
-    # Read in the api_limit_config.json file
-    with open('api_limit_config.json', 'r') as file:
-        api_limits = json.load(file)
-        api_limits = api_limits["API_LIMITS"]
-
-    base_url = "https://places.googleapis.com/v1/places:searchText"
-    
     # These headers: we pass the api key, we pass the field mask
     headers = {
         "Content-Type": "application/json",
         "X-Goog-Api-Key": api_key,
-        "X-Goog-FieldMask": "places.displayName,places.formattedAddress,places.rating,places.location,places.id,places.nationalPhoneNumber,places.websiteUri,nextPageToken"
+        "X-Goog-FieldMask": TEXT_SEARCH_FIELD_MASK
     }
-    
-    # Strip quotation marks from the query parameter
-    query = query.replace('"', '')
-    text_query = f"{query} {region}"
+
+    text_query = text_search_query(query, region)
 
     data = {
         "textQuery": text_query,
         "languageCode": "en"
     }
-    
+
+    # The same query with the same field mask gives the same results, so check the cache first
+    cache_key = text_search_cache_key(text_query)
+    if use_cache:
+        cached_car_washes = get_cached_response(cache_key)
+        if cached_car_washes is not None:
+            yield {"type": "page", "page": 1, "results": list(cached_car_washes), "from_cache": True}
+            return
+        # Then the lead store, which remembers recent searches across restarts (LEAD_STORE.TEXT_SEARCH_MAX_AGE_DAYS)
+        with timed("lead_store_read"):
+            stored_leads = get_text_search_leads(text_query)
+        if stored_leads is not None:
+            yield {"type": "page", "page": 1, "results": [car_wash_record(lead) for lead in stored_leads], "from_cache": True}
+            return
+    else:
+        record_cache_bypass()
+
+    # Reserve every page up front (unless a batch already reserved them), so we don't stop after the first page
+    reservation = None
+    if active_reservation() is None:
+        reservation = CallReservation(api_limits)
+        success, message, counts = await asyncio.to_thread(reservation.reserve, {"text_search_calls": MAX_TEXT_SEARCH_PAGES})
+        if not success:
+            yield {"error": f"Limit exceeded: {message}. Total calls: {counts['total_calls']}, Monthly calls: {counts['monthly_calls']}, Daily calls: {counts['daily_calls']}."}
+            return
+
     all_car_washes = []
+    all_places = []
     next_page_token = None
     callcount = 0
 
-    while True:
-        # Check API call limit before making the next request
-        success, message, counts = check_api_call_limit_new("text_search_calls", daily_limit=api_limits["TEXT_SEARCH"]["DAILY"], monthly_limit=api_limits["TEXT_SEARCH"]["MONTHLY"])
-        if not success:
-            return {"error": f"Limit exceeded: {message}. Total calls: {counts['total_calls']}, Monthly calls: {counts['monthly_calls']}, Daily calls: {counts['daily_calls']}."}
-
-        # If there is a next page token, add it to the data
-        if next_page_token:
-            data["pageToken"] = next_page_token
-        
-        # Make the API call
-        response = requests.post(base_url, json=data, headers=headers)
-        results = response.json()
-        places = results.get("places", [])
-        for place in places:
-            car_wash = {
-                "name": place["displayName"]["text"],
-                "address": place.get("formattedAddress"),
-                "goog_rating": place.get("rating"),
-                "phone": place.get("nationalPhoneNumber"),
-                "website": place.get("websiteUri"),
-                "lat": place["location"]["latitude"],
-                "lng": place["location"]["longitude"],
-                "goog_places_id": place['id'], 
-            }
-            all_car_washes.append(car_wash)
-        
-        next_page_token = results.get("nextPageToken")
-        callcount += 1
-        if not next_page_token or callcount > 2 or (len(places) < 19):
-            break
-        
-        # Wait before making the next request (to comply with API usage limits)
-        time.sleep(2)
-    
-    return all_car_washes
+    try:
+        while True:
+            # Check API call limit before making the next request
+            success, message, counts = await check_api_call_limit_async("text_search_calls", daily_limit=api_limits["TEXT_SEARCH"]["DAILY"], monthly_limit=api_limits["TEXT_SEARCH"]["MONTHLY"], reservation=reservation)
+            if not success:
+                yield {"error": f"Limit exceeded: {message}. Total calls: {counts['total_calls']}, Monthly calls: {counts['monthly_calls']}, Daily calls: {counts['daily_calls']}."}
+                return
+
+            # If there is a next page token, add it to the data
+            if next_page_token:
+                data["pageToken"] = next_page_token
+
+            # Make the API call
+            with timed("text_page"):
+                response = await request_with_retries(client, "POST", PLACES_TEXT_SEARCH_URL, "text_search", json=data, headers=headers)
+            # An error response has no places (and may not be json), so stop here rather than cache or store a partial search
+            if response.status_code != 200:
+                yield {"error": f"Error: {response.status_code} - {response.text}"}
+                return
+            results = response.json()
+            places = results.get("places", [])
+            page_car_washes = [car_wash_record(place) for place in places]
+            all_car_washes.extend(page_car_washes)
+            all_places.extend(places)
+
+            callcount += 1
+            yield {"type": "page", "page": callcount, "results": page_car_washes, "from_cache": False}
+
+            next_page_token = results.get("nextPageToken")
+            if not next_page_token or callcount >= MAX_TEXT_SEARCH_PAGES or (len(places) < 19):
+                break
+
+            # Wait before making the next request (the page token isn't valid right away), without blocking the server
+            await asyncio.sleep(page_delay)
+    finally:
+        # Give back the pages we reserved but didn't need
+        if reservation is not None:
+            await asyncio.to_thread(reservation.release)
+
+    # SQLite writes that can wait for another worker process's lock, so they run in a thread
+    await asyncio.to_thread(cache_response, cache_key, list(all_car_washes),
+                            ttl_seconds=cache_config.get("TTL_SECONDS", DEFAULT_TTL_SECONDS),
+                            max_entries=cache_config.get("MAX_ENTRIES", DEFAULT_MAX_ENTRIES))
+    # Keep every lead we paid for in the lead store, and remember the search so it can be answered from there
+    with timed("lead_store_write"):
+        await asyncio.to_thread(record_text_search, text_query, all_places)
+
+
+def record_regional_search(query: str, region: str, car_washes: list[dict]) -> str:
+    """Save a regional search run in the lead store. Returns its search_id."""
+    with timed("lead_store_write"):
+        return record_search_run("region", {"query": query, "region": region},
+                                 {car_wash["goog_places_id"]: {key: car_wash[key] for key in ("duplicate_place_ids",) if key in car_wash}
+                                  for car_wash in car_washes})
 
+
+async def get_all_car_washes(api_key, region, query, use_cache=True, client: httpx.AsyncClient | None = None):
+    """
+    Fetch car washes in a region using Google Places API, collecting every page (see iter_car_wash_pages).
+
+    Returns:
+        list: Car wash info (name, address, rating, etc.) if successful.
+        dict: Error details if API limit exceeded.
+    """
+    all_car_washes = []
+    async for page in iter_car_wash_pages(api_key, region, query, use_cache, client):
+        if "error" in page:
+            return page
+        all_car_washes.extend(page["results"])
+    # The same business can be listed twice under different place ids (see lead_dedup.py)
+    with timed("dedup"):
+        return dedupe_leads(all_car_washes)
+
+
+async def generate_car_washes_by_region(api_key, region, query, use_cache=True, client: httpx.AsyncClient | None = None):
+    """
+    Streaming version of get_all_car_washes: yields newline delimited json, one message per page of results,
+    so the first 20 leads show up right away instead of after every page has been fetched.
+
+    Yields:
+        str: {"type": "progress"}, then {"type": "page", "page", "results", "num_results"} per page,
+             then {"type": "place_merge", "place"} for each business listed under more than one place id,
+             then {"type": "summary", "search_id", "num_results", "exc_time"}; or {"error": ...} if an API limit is exceeded.
+    """
+    start_time = time.time()
+    yield json.dumps({"type": "progress", "message": f"Searching for {query} in {region}..."}) + "\n"
+
+    all_car_washes = []
+    async for page in iter_car_wash_pages(api_key, region, query, use_cache, client):
+        if "error" in page:
+            yield json.dumps(page) + "\n"
+            return
+        all_car_washes.extend(page["results"])
+        yield json.dumps({**page, "num_results": len(page["results"])}) + "\n"
+
+    # Tell the frontend which of the places it has are the same business, so it can replace them with the merged lead
+    with timed("dedup"):
+        all_car_washes = dedupe_leads(all_car_washes)
+    for car_wash in all_car_washes:
+        if car_wash.get("duplicate_place_ids"):
+            yield json.dumps({"type": "place_merge", "place": car_wash}) + "\n"
+
+    yield json.dumps({
+        "type": "summary",
+        "message": "Search complete",
+        "search_id": record_regional_search(query, region, all_car_washes),
+        "num_results": len(all_car_washes),
+        "exc_time": round((time.time() - start_time), 2)
+    }) + "\n"
+
+
+async def search_car_washes_batch(api_key, searches: list[tuple[str, str]], use_cache=True, client: httpx.AsyncClient | None = None):
+    """
+    Run many (query, region) text searches concurrently and merge them into one deduplicated lead set.
+
+    Each search is a normal regional search (same pagination, cache and TEXT_SEARCH limits), and at most
+    REGIONAL_BATCH_CONCURRENCY (in api_limit_config.json) run at once. If a limit is hit, the searches that
+    haven't finished are cancelled and we return what we have along with the error.
+
+    Args:
+        api_key (str): Google Maps API key.
+        searches (list): (query, region) pairs.
+        use_cache (bool): Serve recent identical searches from the result cache. Defaults to True.
+
+    Returns:
+        dict: {"search_id", "results": car wash info plus "matched_queries" and "matched_regions" for each place,
+               "num_results", "num_searches", "exc_time"} and "error" if a limit was hit.
+    """
+    start_time = time.time()
+    config = get_config()
+    concurrency = config.get("SEARCH_SETTINGS", {}).get("REGIONAL_BATCH_CONCURRENCY", DEFAULT_REGIONAL_BATCH_CONCURRENCY)
+
+    # The same pair twice is the same search
+    searches = list(dict.fromkeys((query.strip(), region.strip()) for query, region in searches))
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    # Reserve every page of every search that isn't cached up front, so the batch either runs in full or doesn't start
+    num_uncached = sum(1 for query, region in searches
+                       if not use_cache or (not is_cached(text_search_cache_key(text_search_query(query, region)))
+                                            and get_text_search_leads(text_search_query(query, region)) is None))
+    reservation = CallReservation(config["API_LIMITS"])
+    success, message, counts = await asyncio.to_thread(reservation.reserve, {"text_search_calls": MAX_TEXT_SEARCH_PAGES * num_uncached})
+    if not success:
+        return {"error": f"Limit exceeded: {message}. Total calls: {counts['total_calls']}, Monthly calls: {counts['monthly_calls']}, Daily calls: {counts['daily_calls']}."}
+
+    async def run_search(query, region):
+        async with semaphore:
+            return query, region, await get_all_car_washes(api_key, region, query, use_cache, client)
+
+    found_car_washes = []  # every search's results, tagged with the query and region that found them
+    error = None
+    tasks = [asyncio.create_task(run_with_reservation(reservation, run_search(query, region))) for query, region in searches]
+    try:
+        for next_finished in asyncio.as_completed(tasks):
+            query, region, car_washes = await next_finished
+            if "error" in car_washes:
+                error = car_washes["error"]
+                break
+            found_car_washes.extend({**car_wash, "matched_queries": [query], "matched_regions": [region]} for car_wash in car_washes)
+    finally:
+        # Stop the rest of the batch if a limit was hit (or the request was cancelled)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # Give back the pages we reserved but didn't need (cached searches, searches with fewer than 3 pages)
+        await asyncio.to_thread(reservation.release)
+
+    # Deduplicate across the whole batch, by place id and fuzzily (see lead_dedup.py), combining matched_queries and matched_regions
+    with timed("dedup"):
+        all_car_washes = dedupe_leads(found_car_washes)
+    with timed("lead_store_write"):
+        search_id = record_search_run("region_batch", {"searches": searches},
+                                      {car_wash["goog_places_id"]: {key: car_wash[key] for key in ("matched_queries", "matched_regions", "duplicate_place_ids")
+                                                                    if key in car_wash}
+                                       for car_wash in all_car_washes})
+    batch_result = {
+        "search_id": search_id,
+        "results": all_car_washes,
+        "num_results": len(all_car_washes),
+        "num_searches": len(searches),
+        "exc_time": round((time.time() - start_time), 2)
+    }
+    if error:
+        batch_result["error"] = error
+    return batch_result
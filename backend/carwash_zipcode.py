@@ -1,23 +1,561 @@
+import asyncio
 import time
-from fastapi.responses import StreamingResponse
-import googlemaps
 import json
-import requests
+import httpx
 #from utils import check_api_call_limit
-from check_api_call_limit import check_api_call_limit_new
+from check_api_call_limit import check_api_call_limit_async
+from geocode_cache import get_cached_location, cache_location
+from geo_utils import haversine_m, split_circle
+from coverage_planner import plan_search_circles, zip_codes_near_place, dry_run_zipcode_search
+from quota_scheduler import CallReservation, run_with_reservation
+from http_client import get_shared_client, request_with_retries, MAPS_BASE_URL, PLACES_BASE_URL
+from metrics import timed, record_error
+from settings import get_config
+from lead_store import record_places, record_coverage, is_covered, covering_search_time, places_within, record_search_run, get_leads
+from lead_dedup import dedupe_leads
+from zip_radius import plan_zip_radii, record_radius_feedback
+from territory import expand_territory
+from search_cache import make_cache_key, get_cached_response, is_cached, cache_response, record_cache_bypass, DEFAULT_TTL_SECONDS, DEFAULT_MAX_ENTRIES
+
+GEOCODE_URL = f"{MAPS_BASE_URL}/maps/api/geocode/json"
+PLACES_NEARBY_URL = f"{PLACES_BASE_URL}/v1/places:searchNearby"
+NEARBY_FIELD_MASK = "places.displayName,places.formattedAddress,places.rating,places.location,places.id,places.nationalPhoneNumber,places.websiteUri,places.types"
+
+# Nearby Search never returns more than 20 places per request
+MAX_RESULT_COUNT = 20
+
+# Used if the api_limit_config.json file does not specify these SEARCH_SETTINGS for the zip code search
+DEFAULT_ZIPCODE_CONCURRENCY = 8
+DEFAULT_ADAPTIVE_MAX_CALLS_PER_ZIP = 21  # the original search plus two levels of splits (1 + 4 + 16)
+DEFAULT_ADAPTIVE_MIN_RADIUS = 250
+DEFAULT_ZIPCODE_CHUNK_SIZE = 100
+DEFAULT_MAX_TERRITORY_ZIP_CODES = 10000
+
+
+def limit_exceeded_message(message: str, counts: dict) -> dict:
+    """Build the error message we stream to the frontend when one of our self imposed limits is hit."""
+    return {"error": f"Limit exceeded: {message}. Total calls: {counts['total_calls']}, Monthly calls: {counts['monthly_calls']}, Daily calls: {counts['daily_calls']}."}
+
+
+async def geocode_zip_code(client: httpx.AsyncClient, api_key: str, zip_code: str):
+    """
+    Convert a zip code to its central coordinates with the Google Geocoding API.
+
+    Args:
+        client (httpx.AsyncClient): Shared HTTP client for the search.
+        api_key (str): Google Maps API key.
+        zip_code (str): The zip code to geocode.
+
+    Returns:
+        dict | None: {"lat": ..., "lng": ...} or None if Google has no coordinates for the zip code.
+
+    Raises:
+        Exception: If the Geocoding API returns an error status.
+    """
+    with timed("geocode"):
+        response = await request_with_retries(client, "GET", GEOCODE_URL, "geocode", params={"address": f"{zip_code}, USA", "key": api_key})
+    response.raise_for_status()
+    geocode_result = response.json()
+    status = geocode_result.get("status")
+    if status == "ZERO_RESULTS":
+        return None
+    if status != "OK":
+        record_error("geocode", status)
+        raise Exception(f"{status} - {geocode_result.get('error_message', '')}")
+    return geocode_result["results"][0]["geometry"]["location"]
+
+
+def nearby_cache_key(center: tuple[float, float], radius: float, included_types_list: list[str]) -> str:
+    """The result cache key of a Nearby Search for a circle."""
+    return make_cache_key("searchNearby", NEARBY_FIELD_MASK, center=list(center),
+                          radius=radius, included_types=included_types_list, max_result_count=MAX_RESULT_COUNT)
+
+
+async def search_nearby_circle(client: httpx.AsyncClient, api_key: str, center: tuple[float, float], radius: float,
+                               included_types_list: list[str], api_limits: dict, cache_config: dict, use_cache: bool = True):
+    """
+    Run one Nearby Search for a circle, checking the result cache, the lead store and our api call limits first.
+
+    If fresh coverage in the lead store contains the circle (see lead_store.is_covered), the places come from the store
+    and Google isn't called. use_cache=False skips both the result cache and the lead store.
+
+    Returns:
+        dict: {"places" (raw places, None if the request failed), "from_cache" (bool), "from_store" (bool, may be more than 20 places),
+               "error" (message to stream or None), "limit_exceeded" (bool)}
+    """
+    outcome = {"places": None, "from_cache": False, "from_store": False, "error": None, "limit_exceeded": False}
+
+    # We set up the params for the Google Places API Nearby Search
+    headers = {
+        "Content-Type": "application/json",
+        "X-Goog-Api-Key": api_key,
+        "X-Goog-FieldMask": NEARBY_FIELD_MASK
+    }
+
+    params = {
+    "includedTypes": included_types_list,
+    "maxResultCount": MAX_RESULT_COUNT,
+    "locationRestriction": {
+        "circle": {
+        "center": {
+            "latitude": center[0],
+            "longitude": center[1]
+        },
+        "radius": radius
+        }
+
+    }
+    }
+
+    # As of now, there is no next page token with this endpoint, so it is a single request per circle
+    # The same circle, types and field mask give the same results, so check the result cache first
+    cache_key = nearby_cache_key(center, radius, included_types_list)
+    if use_cache:
+        results = get_cached_response(cache_key)
+        if results is not None:
+            outcome["places"] = results.get("places", [])
+            outcome["from_cache"] = True
+            return outcome
+        # We've already searched an area containing this circle recently, so the lead store has every place it would return
+        with timed("lead_store_read"):
+            covered_at = covering_search_time(center, radius, included_types_list)
+            if covered_at is not None:
+                outcome["places"] = places_within(center, radius, included_types_list, seen_since=covered_at)
+                outcome["from_cache"] = outcome["from_store"] = True
+        if outcome["from_store"]:
+            return outcome
+    else:
+        record_cache_bypass()
+
+    # We check if we've exceeded our api call limit, if so we report it so the search can stop
+    success, message, counts = await check_api_call_limit_async("nearby_search_calls", daily_limit=api_limits["NEARBY_SEARCH"]["DAILY"], monthly_limit=api_limits["NEARBY_SEARCH"]["MONTHLY"])
+    if not success:
+        outcome["error"] = limit_exceeded_message(message, counts)
+        outcome["limit_exceeded"] = True
+        return outcome
+
+    # Finally, we make the request to the Google Places API with the params we've set up
+    searched_at = time.time()
+    try:
+        with timed("nearby_call"):
+            response = await request_with_retries(client, "POST", PLACES_NEARBY_URL, "nearby_search", json=params, headers=headers)
+    except httpx.HTTPError as e:
+        outcome["error"] = {"error": f"Error: {str(e)}"}
+        return outcome
+    if response.status_code != 200:
+        outcome["error"] = {"error": f"Error: {response.status_code} - {response.text}"}
+        return outcome
+
+    results = response.json()
+    outcome["places"] = results.get("places", [])
+    # SQLite writes that can wait for another worker process's lock, so they run in a thread
+    with timed("lead_store_write"):
+        await asyncio.to_thread(store_nearby_results, cache_key, results, cache_config, center, radius, included_types_list, searched_at)
+    return outcome
+
+
+def store_nearby_results(cache_key: str, results: dict, cache_config: dict, center: tuple[float, float], radius: float,
+                         included_types_list: list[str], searched_at: float):
+    """Cache a Nearby Search response and keep every lead we paid for, and if the search wasn't saturated, record that we have everything in its circle."""
+    cache_response(cache_key, results,
+                   ttl_seconds=cache_config.get("TTL_SECONDS", DEFAULT_TTL_SECONDS),
+                   max_entries=cache_config.get("MAX_ENTRIES", DEFAULT_MAX_ENTRIES))
+    places = results.get("places", [])
+    record_places(places)
+    if len(places) < MAX_RESULT_COUNT:
+        record_coverage(center, radius, included_types_list, searched_at)
+
+
+async def tile_nearby_search(client: httpx.AsyncClient, api_key: str, center: tuple[float, float], radius: float,
+                             included_types_list: list[str], api_limits: dict, cache_config: dict, use_cache: bool = True,
+                             max_calls: int = 1, min_radius: float = DEFAULT_ADAPTIVE_MIN_RADIUS):
+    """
+    Search a circle, splitting it into smaller overlapping circles (a quadtree) whenever a search comes back saturated.
+
+    Nearby Search returns at most 20 places, so a saturated circle probably hides more businesses.
+    Each saturated circle is split in 4 (see geo_utils.split_circle) and the sub circles of a level are searched together,
+    until nothing saturates, the sub circles would be smaller than min_radius, or a split would go over max_calls.
+    With max_calls=1 this is a plain single Nearby Search.
+
+    Returns:
+        dict: {"places" (unique raw places inside the original circle), "num_searches", "saturated" (circles we couldn't split),
+               "errors" (messages to stream), "limit_exceeded" (bool), "from_cache" (bool, every search was a cache hit)}
+    """
+    tiled = {"places": [], "num_searches": 0, "saturated": 0, "errors": [], "limit_exceeded": False, "from_cache": True}
+    places_by_id = {}
+    searched_at = time.time()
+    # Coverage of the whole circle is only recorded if every search was a fresh one (see below)
+    all_fresh = True
+    level = [(center[0], center[1], radius)]
+    planned_searches = 1
+
+    while level:
+        outcomes = await asyncio.gather(*[
+            search_nearby_circle(client, api_key, (lat, lng), circle_radius, included_types_list, api_limits, cache_config, use_cache)
+            for lat, lng, circle_radius in level])
+
+        next_level = []
+        for (lat, lng, circle_radius), outcome in zip(level, outcomes):
+            tiled["num_searches"] += 1
+            tiled["from_cache"] = tiled["from_cache"] and outcome["from_cache"]
+            all_fresh = all_fresh and not outcome["from_cache"]
+            if outcome["limit_exceeded"]:
+                tiled["limit_exceeded"] = True
+            if outcome["error"]:
+                tiled["errors"].append(outcome["error"])
+            if outcome["places"] is None:
+                continue
+
+            for place in outcome["places"]:
+                # Sub circles poke outside the original circle, we only keep what the original search asked for
+                if circle_radius < radius and haversine_m(center[0], center[1], place["location"]["latitude"], place["location"]["longitude"]) > radius:
+                    continue
+                places_by_id.setdefault(place["id"], place)
+
+            # Leads from the store come from covered circles, so they're complete even if there are more than 20
+            if len(outcome["places"]) >= MAX_RESULT_COUNT and not outcome["from_store"]:
+                sub_circles = split_circle(lat, lng, circle_radius)
+                if sub_circles[0][2] >= min_radius and planned_searches + len(sub_circles) <= max_calls:
+                    next_level.extend(sub_circles)
+                    planned_searches += len(sub_circles)
+                else:
+                    tiled["saturated"] += 1
+
+        # Don't start another level of searches if we've hit one of our limits
+        level = [] if tiled["limit_exceeded"] else next_level
+
+    tiled["places"] = list(places_by_id.values())
+    # If the smaller searches found everything, the whole original circle is covered now. Cached responses can be older
+    # than the last time their places were seen, so with any of those the sub circles' own coverage has to do.
+    if tiled["num_searches"] > 1 and not tiled["saturated"] and not tiled["errors"] and not tiled["limit_exceeded"] and all_fresh:
+        with timed("lead_store_write"):
+            await asyncio.to_thread(record_coverage, center, radius, included_types_list, searched_at)
+    return tiled
+
+
+async def locate_zip_code(client: httpx.AsyncClient, api_key: str, zip_code: str, api_limits: dict):
+    """
+    Get the central coordinates of a zip code, from the geocode cache if we can and the Geocoding API if we can't.
+
+    Returns:
+        tuple: (location dict or None, list of events to stream, bool limit exceeded)
+    """
+    events = [{"type": "progress", "message": f"Getting central coordinates for {zip_code}"}]
+    try:
+        # Zip code centroids almost never change, so a cached location skips the Geocoding API (and its quota check) entirely
+        location = get_cached_location(zip_code)
+        if not location:
+            # Geocode the zip code to get the latitude and longitude
+            success, message, counts = await check_api_call_limit_async("geocode_calls", daily_limit=api_limits["GEOCODE"]["DAILY"], monthly_limit=api_limits["GEOCODE"]["MONTHLY"])
+            if not success:
+                events.append(limit_exceeded_message(message, counts))
+                return None, events, True
+            location = await geocode_zip_code(client, api_key, zip_code)
+            if not location:
+                events.append({"type": "progress", "message": f"Could not find coordinates for zip code {zip_code}"})
+                return None, events, False
+            cache_location(zip_code, location)
+    except Exception as e:
+        events.append({"type": "progress", "message": f"Error geocoding zip code {zip_code}: {str(e)}"})
+        return None, events, False
+
+    events.append({"type": "progress", "message": f"Coordinates for {zip_code} are: {location}"})
+    return location, events, False
+
+
+async def search_zip_code(client: httpx.AsyncClient, semaphore: asyncio.Semaphore, api_key: str,
+                          zip_code: str, included_types_list: list[str], zipcode_radius: int, api_limits: dict,
+                          cache_config: dict, use_cache: bool = True, adaptive_tiling: bool = False, tiling_config: dict | None = None,
+                          radius_settings: dict | None = None):
+    """
+    Geocode a single zip code and search for businesses around it with the Nearby Search API.
+
+    Runs under the search's semaphore so only a limited number of zip codes hit Google at the same time.
+    Instead of yielding, the events for the zip code are collected and returned together once it finishes.
+    Nearby Search responses are served from the result cache when use_cache is True.
+    With adaptive_tiling, saturated searches are split into smaller ones (see tile_nearby_search),
+    up to ADAPTIVE_MAX_CALLS_PER_ZIP searches for the zip code.
+    Whether the search saturated or came back empty is recorded for auto_radius (see zip_radius.py),
+    radius_settings is the AUTO_RADIUS section of api_limit_config.json.
+
+    Returns:
+        dict: {"events" (list of messages to stream), "places" (raw Nearby Search places),
+               "zip_codes_by_place" (place id -> the zip codes it is near), "limit_exceeded" (bool, the whole search should stop)}
+    """
+    outcome = {"events": [], "places": [], "zip_codes_by_place": {}, "limit_exceeded": False}
+    events = outcome["events"]
+    tiling_config = tiling_config or {}
+
+    async with semaphore:
+        location, locate_events, limit_exceeded = await locate_zip_code(client, api_key, zip_code, api_limits)
+        events.extend(locate_events)
+        if limit_exceeded:
+            outcome["limit_exceeded"] = True
+        if not location:
+            return outcome
+
+        # Once we have the coordinates, search for car washes in area (within the specified radius) of that zip code
+        events.append({"type": "progress", "message": f"Searching for businesses within {zipcode_radius}m radius of {zip_code}"})
+
+        max_calls = tiling_config.get("ADAPTIVE_MAX_CALLS_PER_ZIP", DEFAULT_ADAPTIVE_MAX_CALLS_PER_ZIP) if adaptive_tiling else 1
+        tiled = await tile_nearby_search(client, api_key, (location["lat"], location["lng"]), zipcode_radius, included_types_list,
+                                         api_limits, cache_config, use_cache, max_calls=max_calls,
+                                         min_radius=tiling_config.get("ADAPTIVE_MIN_RADIUS", DEFAULT_ADAPTIVE_MIN_RADIUS))
+
+    # If a search failed we stream the error message and move on
+    events.extend(tiled["errors"])
+    if tiled["limit_exceeded"]:
+        # The searches that got through are paid for, so their places are kept
+        outcome["limit_exceeded"] = True
+        outcome["places"] = tiled["places"]
+        outcome["zip_codes_by_place"] = {place["id"]: [zip_code] for place in tiled["places"]}
+        return outcome
+    if tiled["from_cache"]:
+        events.append({"type": "progress", "message": f"Using cached results for {zip_code}"})
+    if tiled["num_searches"] > 1:
+        events.append({"type": "progress", "message": f"Used {tiled['num_searches']} smaller overlapping searches around {zip_code} because the search hit the {MAX_RESULT_COUNT} result cap"})
+
+    places = tiled["places"]
+    if not tiled["errors"] and len(places) < 1:
+        events.append({"type": "warning",
+                       "message": f"Found 0 results in {zip_code}. This just means there are no results within the {zipcode_radius}m radius of {location['lat']}, {location['lng']}."})
+    elif tiled["saturated"] and not adaptive_tiling:
+        events.append({"type": "warning",
+                       "message": f"Found {len(places)} (MAX!) results in {zip_code}. This probably means the radius is too large and you did not capture all businesses of interest within this zip code. You might want to try a smaller radius."})
+    elif tiled["saturated"]:
+        events.append({"type": "warning",
+                       "message": f"{tiled['saturated']} of the searches around {zip_code} still found the MAX number of results after {tiled['num_searches']} searches. Some businesses in this zip code were probably missed, you might want to try a smaller radius."})
+    if not tiled["errors"]:
+        # A split search means the first one hit the result cap too, so either way the radius was too big for this zip code.
+        # Recorded for every search (so auto_radius learns from searches without it too), in a thread as it's an SQLite write.
+        with timed("radius_feedback"):
+            await asyncio.to_thread(record_radius_feedback, zip_code, included_types_list, zipcode_radius,
+                                    saturated=tiled["saturated"] > 0 or tiled["num_searches"] > 1, empty=len(places) < 1,
+                                    settings=radius_settings)
+
+    outcome["places"] = places
+    outcome["zip_codes_by_place"] = {place["id"]: [zip_code] for place in places}
+    # Want to keep track of how many car washes we've found for the given zip code
+    events.append({"type": "progress", "message": f"Completed search for {zip_code}; {len(outcome['places'])} automotive businesses found"})
+    return outcome
+
+
+async def search_planned_circle(client: httpx.AsyncClient, semaphore: asyncio.Semaphore, api_key: str,
+                                circle_number: int, circle: dict, zip_centers: dict, zipcode_radius: int, included_types_list: list[str],
+                                api_limits: dict, cache_config: dict, use_cache: bool = True, adaptive_tiling: bool = False, tiling_config: dict | None = None):
+    """
+    Search one circle from the coverage plan (see coverage_planner.py) and map each place back to the zip codes it is near.
+
+    A place is near a zip code when it is within zipcode_radius of the zip code's center, the same area a per zip code search covers.
+
+    Returns:
+        dict: The same shape as search_zip_code's outcome.
+    """
+    outcome = {"events": [], "places": [], "zip_codes_by_place": {}, "limit_exceeded": False}
+    events = outcome["events"]
+    tiling_config = tiling_config or {}
+    area_label = f"search area {circle_number} (near {', '.join(circle['zip_codes'][:3])}{'...' if len(circle['zip_codes']) > 3 else ''})"
+
+    async with semaphore:
+        events.append({"type": "progress", "message": f"Searching for businesses within {zipcode_radius}m radius of {area_label}"})
+        max_calls = tiling_config.get("ADAPTIVE_MAX_CALLS_PER_ZIP", DEFAULT_ADAPTIVE_MAX_CALLS_PER_ZIP) if adaptive_tiling else 1
+        tiled = await tile_nearby_search(client, api_key, circle["center"], zipcode_radius, included_types_list,
+                                         api_limits, cache_config, use_cache, max_calls=max_calls,
+                                         min_radius=tiling_config.get("ADAPTIVE_MIN_RADIUS", DEFAULT_ADAPTIVE_MIN_RADIUS))
+
+    events.extend(tiled["errors"])
+    # The searches that got through before a limit was hit are paid for, so their places are kept
+    outcome["limit_exceeded"] = tiled["limit_exceeded"]
+    if tiled["saturated"] and not tiled["limit_exceeded"]:
+        events.append({"type": "warning",
+                       "message": f"Found the MAX number of results in {area_label}. You did not capture all businesses of interest in this area, you might want to try a smaller radius{'' if adaptive_tiling else ' or adaptive tiling'}."})
+
+    for place in tiled["places"]:
+        nearby_zip_codes = zip_codes_near_place(place["location"]["latitude"], place["location"]["longitude"],
+                                                zip_centers, zipcode_radius, circle["zip_codes"])
+        # Places outside every zip code's circle weren't asked for
+        if nearby_zip_codes:
+            outcome["places"].append(place)
+            outcome["zip_codes_by_place"][place["id"]] = nearby_zip_codes
+
+    events.append({"type": "progress", "message": f"Completed {area_label}; {len(outcome['places'])} automotive businesses found"})
+    return outcome
+
+
+def place_record(place: dict, zip_codes: list[str]) -> dict:
+    """Turn a raw Nearby Search place into the lead record we send to the frontend."""
+    return {
+        "name": place["displayName"]["text"],
+        "address": place.get("formattedAddress"),
+        "goog_rating": place.get("rating"),
+        "phone": place.get("nationalPhoneNumber"),
+        "website": place.get("websiteUri"),
+        "lat": place["location"]["latitude"],
+        "lng": place["location"]["longitude"],
+        "goog_places_id": place["id"],
+        "zip_codes_nearby": list(zip_codes)
+    }
+
+
+def merge_places(all_car_washes: dict, outcome: dict):
+    """Add the places from a search outcome to all_car_washes, deduplicating on place_id and merging zip_codes_nearby."""
+    for place in outcome["places"]:
+        place_id = place['id']
+        zip_codes = outcome["zip_codes_by_place"][place_id]
+
+        # If the place_id is not in the all_car_washes dictionary, we add it
+        if place_id not in all_car_washes:
+            all_car_washes[place_id] = place_record(place, zip_codes)
+        else:
+            # If the place_id is already in the all_car_washes dictionary, we add the zip code to the list of zip codes nearby
+            for zip_code in zip_codes:
+                if zip_code not in all_car_washes[place_id]["zip_codes_nearby"]:
+                    all_car_washes[place_id]["zip_codes_nearby"].append(zip_code)
+
+
+def merge_duplicate_places(all_car_washes: dict, incremental: bool) -> list[dict]:
+    """
+    Merge places that are the same business listed under different place ids (see lead_dedup.py).
+
+    Args:
+        all_car_washes (dict): place id -> lead record (from merge_places), or place id -> zip codes (from place_events).
+        incremental (bool): Whether all_car_washes came from place_events. The records are then read back from the lead store.
+
+    Returns:
+        list: The lead records, with each business once. A lead that absorbed others lists their ids in "duplicate_place_ids".
+    """
+    if not incremental:
+        return dedupe_leads(all_car_washes.values())
+    stored_leads = get_leads(list(all_car_washes))
+    records = []
+    for place_id, zip_codes in all_car_washes.items():
+        lead = stored_leads.get(place_id)
+        if lead is None:
+            # Not stored (shouldn't happen, every place we get is recorded), so it can't be compared but is still a result
+            records.append({"goog_places_id": place_id, "zip_codes_nearby": list(zip_codes)})
+            continue
+        records.append({**{key: lead[key] for key in ("name", "address", "goog_rating", "phone", "website", "lat", "lng", "goog_places_id")},
+                        "zip_codes_nearby": list(zip_codes)})
+    return dedupe_leads([record for record in records if "lat" in record]) + [record for record in records if "lat" not in record]
+
+
+def place_events(known_zip_codes: dict, outcome: dict) -> list[dict]:
+    """
+    Incremental version of merge_places: instead of building up the full results, return the events to stream.
+
+    A place we haven't seen yet becomes a "place" event with its full record. A known place that is near a new zip code
+    becomes a "place_update" event. Only place_id -> zip codes is kept in memory (known_zip_codes), not the records.
+    """
+    events = []
+    for place in outcome["places"]:
+        place_id = place['id']
+        zip_codes = outcome["zip_codes_by_place"][place_id]
+
+        if place_id not in known_zip_codes:
+            known_zip_codes[place_id] = list(zip_codes)
+            events.append({"type": "place", "place": place_record(place, zip_codes)})
+        else:
+            added_zip_codes = [zip_code for zip_code in zip_codes if zip_code not in known_zip_codes[place_id]]
+            if added_zip_codes:
+                known_zip_codes[place_id].extend(added_zip_codes)
+                events.append({"type": "place_update", "goog_places_id": place_id,
+                               "added_zip_codes": added_zip_codes, "zip_codes_nearby": known_zip_codes[place_id]})
+    return events
+
+
+async def locate_zip_codes(client: httpx.AsyncClient, semaphore: asyncio.Semaphore, api_key: str, zip_codes_list: list[str], api_limits: dict):
+    """
+    Get the coordinates of every zip code concurrently.
+
+    Returns:
+        tuple: (dict zip code -> (lat, lng) for the zip codes we could locate, list of events to stream, bool limit exceeded)
+    """
+    async def locate(zip_code):
+        async with semaphore:
+            return zip_code, await locate_zip_code(client, api_key, zip_code, api_limits)
+
+    centers = {}
+    events = []
+    for zip_code, (location, locate_events, limit_exceeded) in await asyncio.gather(*[locate(zip_code) for zip_code in zip_codes_list]):
+        events.extend(locate_events)
+        if limit_exceeded:
+            return centers, events, True
+        if location:
+            centers[zip_code] = (location["lat"], location["lng"])
+    return centers, events, False
+
+
+def estimate_zipcode_search_calls(zip_codes_list: list[str], zipcode_radius: int, included_types_list: list[str],
+                                  use_cache: bool = True, plan_coverage: bool = False, radii: dict[str, int] | None = None) -> dict[str, int]:
+    """
+    Estimate the calls a zip code search will make, so they can be reserved before it starts.
+
+    One Geocoding call per zip code that isn't in the geocode cache, and one Nearby Search per zip code
+    (or per planned circle with plan_coverage) unless the result cache or the lead store already has it. Extra searches from
+    adaptive tiling aren't included, those are counted one at a time as they happen.
+    radii (zip code -> radius, from auto_radius) overrides zipcode_radius for the zip codes in it.
+
+    Returns:
+        dict: {"geocode_calls": ..., "nearby_search_calls": ...}
+    """
+    if plan_coverage:
+        dry_run = dry_run_zipcode_search(zip_codes_list, zipcode_radius)
+        circles = [(circle["lat"], circle["lng"]) for circle in dry_run["planned_searches"]]
+        cached_calls = sum(1 for center in circles if use_cache and (is_cached(nearby_cache_key(center, zipcode_radius, included_types_list))
+                                                                      or is_covered(center, zipcode_radius, included_types_list)))
+        return {"geocode_calls": dry_run["geocode_calls_needed"], "nearby_search_calls": dry_run["planned_nearby_calls"] - cached_calls}
+
+    estimate = {"geocode_calls": 0, "nearby_search_calls": 0}
+    for zip_code in dict.fromkeys(zip_codes_list):
+        location = get_cached_location(zip_code)
+        if location is None:
+            estimate["geocode_calls"] += 1
+        if location is None or not use_cache:
+            estimate["nearby_search_calls"] += 1
+            continue
+        center = (location["lat"], location["lng"])
+        radius = (radii or {}).get(zip_code, zipcode_radius)
+        if not is_cached(nearby_cache_key(center, radius, included_types_list)) and not is_covered(center, radius, included_types_list):
+            estimate["nearby_search_calls"] += 1
+    return estimate
+
 
 # Lets try to use a generator so we can stream some progress statements to the frontend
-def generate_carwashes_by_zipcode(api_key: str, zip_codes: str | list[str], 
-                                   includedTypes: str | list[str],
-                                   zipcode_radius: int = 5000):
+async def generate_carwashes_by_zipcode(api_key: str, zip_codes: str | list[str],
+                                        includedTypes: str | list[str],
+                                        zipcode_radius: int = 5000, use_cache: bool = True, adaptive_tiling: bool = False,
+                                        plan_coverage: bool = False, stream_mode: str = "batch",
+                                        client: httpx.AsyncClient | None = None, auto_radius: bool = False,
+                                        states: list[str] | None = None, counties: list[str] | None = None, within: list[dict] | None = None):
     """
     Fetch automotive businesses for one or more zip codes using Google Places API Nearby Search.
     Includes deduplication based on place_id and streams updates.
 
+    The zip codes, states, counties and areas are expanded into a validated list of zip codes first (see territory.py),
+    so invalid and duplicate zip codes are dropped before any calls are made.
+    Zip codes are searched concurrently (up to ZIPCODE_CONCURRENCY at a time, set in api_limit_config.json)
+    over the pooled HTTP client. Updates for each zip code are streamed as soon as that zip code finishes.
+    Long lists are searched ZIPCODE_CHUNK_SIZE zip codes at a time, each chunk reserving its own calls, so a state wide
+    sweep starts right away and only needs the next chunk's calls to be left in the budget.
+
     Args:
         api_key (str): Google Maps API key.
-        zip_codes (str or list): Single zip code or list of zip codes.
+        zip_codes (str or list): Zip codes, as a list and/or strings separated by commas or whitespace.
         zipcode_radius (int): The radius of the search in meters. Defaults to 5000.
+        use_cache (bool): Reuse recent identical Nearby Search responses from the result cache. Defaults to True.
+        adaptive_tiling (bool): Split searches that hit the 20 result cap into smaller ones. Defaults to False.
+        plan_coverage (bool): Locate every zip code first and cover them all with as few search circles as possible
+            (see coverage_planner.py) instead of one search per zip code. Defaults to False.
+        stream_mode (str): "batch" streams progress and then every result in one final "result" message.
+            "incremental" streams each new place as its own "place" event (and "place_update" events when a known place
+            is near another zip code), then a "place_merge" event for each business that was found under more than one place id,
+            and ends with a "summary" message that only has the stats. Defaults to "batch".
+        client (httpx.AsyncClient, optional): HTTP client to use. Defaults to the shared pooled client.
+        auto_radius (bool): Pick each zip code's radius from its area and past searches of it (see zip_radius.py),
+            zipcode_radius is only used for zip codes we know nothing about. Can't be combined with plan_coverage. Defaults to False.
+        states (list, optional): States to search every zip code of, e.g. "NY" or "New York".
+        counties (list, optional): Counties to search every zip code of, e.g. "Kings County, NY".
+        within (list, optional): {"center": zip code or "lat,lng", "km": distance} areas to search every zip code of.
 
     Returns:
         StreamingResponse: Streams updates and final results.
@@ -25,16 +563,19 @@ def generate_carwashes_by_zipcode(api_key: str, zip_codes: str | list[str],
     # Initialize the start time so we can calculate how long the function takes to run
     start_time = time.time()
 
-    # Read in the api_limit_config.json file
-    with open('api_limit_config.json', 'r') as file:
-        api_limits = json.load(file)
-        api_limits = api_limits["API_LIMITS"]
+    # The api_limit_config.json settings (loaded once, and again only when the file changes)
+    config = get_config()
+    api_limits = config["API_LIMITS"]
+    search_settings = config.get("SEARCH_SETTINGS", {})
+    concurrency = search_settings.get("ZIPCODE_CONCURRENCY", DEFAULT_ZIPCODE_CONCURRENCY)
+    cache_config = config.get("RESULT_CACHE", {})
+    radius_settings = config.get("AUTO_RADIUS", {})
 
-    # If the zip code is a string convert it to a list
-    if isinstance(zip_codes, str):
-        zip_codes_list = [zip_codes]
-    else:
-        zip_codes_list = zip_codes
+    # Expand and validate the territory, so bad input never costs a call
+    territory = expand_territory(zip_codes, states, counties, within,
+                                 search_settings.get("MAX_TERRITORY_ZIP_CODES", DEFAULT_MAX_TERRITORY_ZIP_CODES))
+    zip_codes_list = territory["zip_codes"]
+    chunk_size = max(1, search_settings.get("ZIPCODE_CHUNK_SIZE", DEFAULT_ZIPCODE_CHUNK_SIZE))
 
     # If includedTypes is a string convert it to a list
     if isinstance(includedTypes, str):
@@ -42,128 +583,150 @@ def generate_carwashes_by_zipcode(api_key: str, zip_codes: str | list[str],
     else:
         included_types_list = includedTypes
 
+    for error in territory["errors"]:
+        yield json.dumps({"error": error}) + "\n"
+    if territory["errors"] or not zip_codes_list:
+        if not territory["errors"]:
+            yield json.dumps({"error": "None of the zip codes are valid"}) + "\n"
+        return
+    if territory["invalid_zip_codes"]:
+        yield json.dumps({"type": "warning", "message": f"Skipping {len(territory['invalid_zip_codes'])} invalid zip codes: {', '.join(territory['invalid_zip_codes'][:20])}",
+                          "invalid_zip_codes": territory["invalid_zip_codes"]}) + "\n"
+
     # Start the stream with a progress message
     yield json.dumps({
         "type": "progress",
-        "message": f"Starting search for {len(zip_codes_list)} zip codes..."}) + "\n"
+        "message": f"Starting search for {len(zip_codes_list)} zip codes...",
+        "duplicates_removed": territory["duplicates_removed"]}) + "\n"
+
+    radii = None
+    if auto_radius and zip_codes_list:
+        if plan_coverage:
+            # Planned circles cover several zip codes at once, so they all need the same radius
+            yield json.dumps({"error": "auto_radius can't be combined with plan_coverage, pick one"}) + "\n"
+            return
+        radii = {zip_code: planned["radius"] for zip_code, planned in plan_zip_radii(zip_codes_list, included_types_list, zipcode_radius, radius_settings).items()}
+        yield json.dumps({"type": "progress", "message": f"Picked search radii between {min(radii.values())}m and {max(radii.values())}m for {len(radii)} zip codes",
+                          "radii": radii}) + "\n"
 
-    # Initialize the Google Maps client
-    gmaps = googlemaps.Client(key=api_key)
-    places_url = "https://places.googleapis.com/v1/places:searchNearby"
-    
     all_car_washes = {}  # Use a dictionary to store unique car washes (for deduplication)
+    incremental = stream_mode == "incremental"
+    # The pooled HTTP client (and its kept alive connections) is shared by every zip code and every request to our app
+    client = client or get_shared_client()
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    stopped_early = False
 
-    # Iterate over each zip code
-    for zip_code in zip_codes_list:
-        yield json.dumps({"type": "progress", "message": f"Getting central coordinates for {zip_code}"}) + "\n"
-        try:
-            # Geocode the zip code to get the latitude and longitude
-            success, message, counts = check_api_call_limit_new("geocode_calls", daily_limit=api_limits["GEOCODE"]["DAILY"], monthly_limit=api_limits["GEOCODE"]["DAILY"])
-            if not success:
-                yield json.dumps({"error": f"Limit exceeded: {message}. Total calls: {counts['total_calls']}, Monthly calls: {counts['monthly_calls']}, Daily calls: {counts['daily_calls']}."}) + "\n"
+    for chunk_start in range(0, len(zip_codes_list), chunk_size):
+        chunk = zip_codes_list[chunk_start:chunk_start + chunk_size]
+        if len(zip_codes_list) > chunk_size:
+            yield json.dumps({"type": "progress", "message": f"Searching zip codes {chunk_start + 1}-{chunk_start + len(chunk)} of {len(zip_codes_list)}"}) + "\n"
+
+        # Reserve the calls we expect to make up front, so we don't stop halfway through with partial results
+        reservation = CallReservation(api_limits)
+        # A cache and coverage lookup per zip code (and the whole coverage plan with plan_coverage), so it runs in a thread
+        # to keep the event loop free for every other request
+        estimated_calls = await asyncio.to_thread(estimate_zipcode_search_calls, chunk, zipcode_radius, included_types_list, use_cache, plan_coverage, radii)
+        success, message, counts = await asyncio.to_thread(reservation.reserve, estimated_calls)
+        if not success:
+            yield json.dumps(limit_exceeded_message(message, counts)) + "\n"
+            if chunk_start == 0:
                 return
-            geocode_result = gmaps.geocode(f"{zip_code}, USA")
-            if not geocode_result:
-                yield json.dumps({"type": "progress", "message": f"Could not find coordinates for zip code {zip_code}"}) + "\n"
-                continue
-            location = geocode_result[0]['geometry']['location']
-        except Exception as e:
-            yield json.dumps({"type": "progress", "message": f"Error geocoding zip code {zip_code}: {str(e)}"}) + "\n"
-            continue
+            # Keep what the chunks we already paid for found
+            stopped_early = True
+            break
 
-        # Once we have the coordinates, search for car washes in area (within the specified radius) of that zip code
-        yield json.dumps({"type": "progress", "message": f"Coordinates for {zip_code} are: {location}"}) + "\n"
-        yield json.dumps({"type": "progress", "message": f"Searching for businesses within {zipcode_radius}m radius of {zip_code}"}) + "\n"
-
-        # We set up the params for the Google Places API Nearby Search
-        headers = {
-            "Content-Type": "application/json",
-            "X-Goog-Api-Key": api_key,
-            "X-Goog-FieldMask": "places.displayName,places.formattedAddress,places.rating,places.location,places.id,places.nationalPhoneNumber,places.websiteUri"
-        }
+        try:
+            if plan_coverage:
+                # Locate every zip code first, then cover all of them with as few Nearby Searches as we can
+                zip_centers, locate_events, limit_exceeded = await run_with_reservation(reservation, locate_zip_codes(client, semaphore, api_key, chunk, api_limits))
+                for event in locate_events:
+                    yield json.dumps(event) + "\n"
+                if limit_exceeded:
+                    # Keep what the earlier chunks found
+                    stopped_early = True
+                    break
+                plan = await asyncio.to_thread(plan_search_circles, zip_centers, zipcode_radius)
+                yield json.dumps({"type": "progress", "message": f"Planned {len(plan)} searches to cover {len(zip_centers)} zip codes (instead of {len(zip_centers)})"}) + "\n"
+                searches = [search_planned_circle(client, semaphore, api_key, circle_number, circle, zip_centers, zipcode_radius, included_types_list,
+                                                  api_limits, cache_config, use_cache, adaptive_tiling, search_settings)
+                            for circle_number, circle in enumerate(plan, start=1)]
+            else:
+                searches = [search_zip_code(client, semaphore, api_key, zip_code, included_types_list, (radii or {}).get(zip_code, zipcode_radius),
+                                            api_limits, cache_config, use_cache, adaptive_tiling, search_settings, radius_settings)
+                            for zip_code in chunk]
 
-        params = {
-        "includedTypes": included_types_list,
-        "maxResultCount": 20,
-        "locationRestriction": {
-            "circle": {
-            "center": {
-                "latitude": location["lat"],
-                "longitude": location["lng"]
-            },
-            "radius": zipcode_radius
-            }
-            
-        }
-        }
-        
-        # As of now, there is no next page token with this endpoint, no need to set it
+            tasks = [asyncio.create_task(run_with_reservation(reservation, search)) for search in searches]
+            try:
+                # Stream the results of each zip code (or planned search area) in the order they finish
+                for next_finished in asyncio.as_completed(tasks):
+                    outcome = await next_finished
+                    for event in outcome["events"]:
+                        yield json.dumps(event) + "\n"
 
-        num_car_washes_found = 0
-        while True:
-            # We check if we've exceeded our api call limit, if so we stream an error message and break out of the loop 
-            success, message, counts = check_api_call_limit_new("nearby_search_calls", daily_limit=api_limits["NEARBY_SEARCH"]["DAILY"], monthly_limit=api_limits["NEARBY_SEARCH"]["MONTHLY"])
-            if not success:
-                yield json.dumps({"error": f"Limit exceeded: {message}. Total calls: {counts['total_calls']}, Monthly calls: {counts['monthly_calls']}, Daily calls: {counts['daily_calls']}."}) + "\n"
-                return
+                    # Add the results to the all_car_washes dictionary, or in incremental mode stream them right away
+                    if incremental:
+                        with timed("dedup"):
+                            new_events = place_events(all_car_washes, outcome)
+                        for event in new_events:
+                            yield json.dumps(event) + "\n"
+                    else:
+                        with timed("dedup"):
+                            merge_places(all_car_washes, outcome)
+                    if outcome["limit_exceeded"]:
+                        # Keep what this and the earlier chunks found (the calls are paid for), the other zip codes are cancelled below
+                        stopped_early = True
+                        break
+            finally:
+                # If the search stopped early (limit hit or the client disconnected) we don't want the other zip codes to keep calling Google
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            # Give back the calls we reserved but didn't make (cached results, zip codes that couldn't be located, stopping early).
+            # The refund runs to the end in its thread even if the client disconnects while we wait for it.
+            await asyncio.to_thread(reservation.release)
+        if stopped_early:
+            break
 
-            
-            # Finally, we make the request to the Google Places API with the params we've set up
-            response = requests.post(places_url, json=params, headers=headers)
-            # If the status is not OK, we stream an error message and break out of the loop
-            if response.status_code != 200:
-                print(response.text)
-                yield json.dumps({"error": f"Error: {response.status_code} - {response.text}"}) + "\n"
-                break
-
-            results = response.json()
-
-            if len(results) == 0 or len(results['places']) < 1 :
-                yield json.dumps({"type": "warning", 
-                                  "message": f"Found 0 results in {zip_code}. This just means there are no results within the {zipcode_radius}m radius of {location['lat']}, {location['lng']}."}) + "\n"
-                break
-            if len(results['places']) > 19:
-                yield json.dumps({"type": "warning", 
-                                  "message": f"Found {len(results['places'])} (MAX!) results in {zip_code}. This probably means the radius is too large and you did not capture all businesses of interest within this zip code. You might want to try a smaller radius."}) + "\n"
-
-            
-            # Iterate over the results and add them to the all_car_washes dictionary
-            for place in results["places"]:
-                num_car_washes_found += 1
-                place_id = place['id']
-
-                # If the place_id is not in the all_car_washes dictionary, we add it
-                if place_id not in all_car_washes:
-                    all_car_washes[place_id] = {
-                        "name": place["displayName"]["text"],
-                        "address": place.get("formattedAddress"),
-                        "goog_rating": place.get("rating"),
-                        "phone": place.get("nationalPhoneNumber"),
-                        "website": place.get("websiteUri"),
-                        "lat": place["location"]["latitude"],
-                        "lng": place["location"]["longitude"],
-                        "goog_places_id": place_id,
-                        "zip_codes_nearby": [zip_code]
-                    }
-                else:
-                    # If the place_id is already in the all_car_washes dictionary, we add the zip code to the list of zip codes nearby
-                    if zip_code not in all_car_washes[place_id]["zip_codes_nearby"]:
-                        all_car_washes[place_id]["zip_codes_nearby"].append(zip_code)
-            
-    
+    # Exact place id duplicates were merged as results came in, now merge the same business under different place ids
+    with timed("dedup"):
+        final_results = merge_duplicate_places(all_car_washes, incremental)
 
-        
-            break
-            
-        # Want to keep track of how many car washes we've found for the given zip code
-        yield json.dumps({"type": "progress", "message": f"Completed search for {zip_code}; {num_car_washes_found} automotive businesses found"}) + "\n"
+    # Save the run, so its leads can be fetched (or exported) again later by its search_id
+    lead_extras = {lead["goog_places_id"]: {key: lead[key] for key in ("zip_codes_nearby", "duplicate_place_ids") if key in lead}
+                   for lead in final_results}
+    with timed("lead_store_write"):
+        search_id = record_search_run("zipcode", {"zip_codes": zip_codes_list, "included_types": included_types_list, "radius": zipcode_radius,
+                                                  "adaptive_tiling": adaptive_tiling, "plan_coverage": plan_coverage, "auto_radius": auto_radius,
+                                                  **({"radii": radii} if radii else {}),
+                                                  **{key: value for key, value in (("states", states), ("counties", counties), ("within", within)) if value}},
+                                     lead_extras)
 
-    final_results = list(all_car_washes.values())
-    yield json.dumps({
-        "type": "result",
-        "message": "Search complete",
-        "results": final_results,
-        "num_results": len(final_results),
-        "num_zip_codes": len(zip_codes_list),
-        "exc_time": round((time.time() - start_time), 2)
-    }) + "\n"
+    if incremental:
+        # Tell the frontend which of the places it has are the same business, so it can replace them with the merged lead
+        for lead in final_results:
+            if lead.get("duplicate_place_ids"):
+                yield json.dumps({"type": "place_merge", "place": lead}) + "\n"
+        # Every place has already been streamed, so the last message only has the stats
+        yield json.dumps({
+            "type": "summary",
+            "message": "Search stopped at the API call limit" if stopped_early else "Search complete",
+            "search_id": search_id,
+            "num_results": len(final_results),
+            "num_zip_codes": len(zip_codes_list),
+            "exc_time": round((time.time() - start_time), 2)
+        }) + "\n"
+        return
+
+    # The final message has every result, so serializing it can take a while for big searches
+    with timed("serialize"):
+        result_message = json.dumps({
+            "type": "result",
+            "message": "Search stopped at the API call limit" if stopped_early else "Search complete",
+            "search_id": search_id,
+            "results": final_results,
+            "num_results": len(final_results),
+            "num_zip_codes": len(zip_codes_list),
+            "exc_time": round((time.time() - start_time), 2)
+        }) + "\n"
+    yield result_message
@@ -0,0 +1,162 @@
+# Plans a small set of Nearby Search circles that covers the same area as searching every zip code separately.
+# Adjacent zip codes searched with the same radius overlap heavily, so one circle per zip code wastes calls.
+
+import heapq
+import math
+from collections import defaultdict
+
+from geo_utils import METERS_PER_DEGREE_LAT, haversine_m
+from geocode_cache import get_cached_location
+
+# Sample points are laid out every radius / SAMPLE_DIVISIONS meters, candidate circles every radius / CANDIDATE_DIVISIONS
+SAMPLE_DIVISIONS = 5
+CANDIDATE_DIVISIONS = 2
+
+
+def _projection(centers: dict):
+    """Equirectangular projection around the middle of the zip codes, good to well under 1% over a few hundred km."""
+    lat0 = sum(lat for lat, _ in centers.values()) / len(centers)
+    lng0 = sum(lng for _, lng in centers.values()) / len(centers)
+    meters_per_degree_lng = METERS_PER_DEGREE_LAT * math.cos(math.radians(lat0))
+
+    def to_xy(lat, lng):
+        return (lng - lng0) * meters_per_degree_lng, (lat - lat0) * METERS_PER_DEGREE_LAT
+
+    def to_lat_lng(x, y):
+        return lat0 + y / METERS_PER_DEGREE_LAT, lng0 + x / meters_per_degree_lng
+
+    return to_xy, to_lat_lng
+
+
+def plan_search_circles(centers: dict[str, tuple[float, float]], radius: float) -> list[dict]:
+    """
+    Compute a small set of search circles that covers the union of the zip code search circles.
+
+    Every zip code's circle (its center, with the search radius) is filled with a grid of sample points.
+    Candidate circles are the zip code centers plus a triangular grid over the whole area, and we greedily
+    pick the candidate that covers the most uncovered sample points until every point is covered (greedy set cover).
+    Coverage is checked at the sample points, so the plan is accurate to about radius / 5.
+    If the plan isn't smaller than one circle per zip code, we just return one circle per zip code.
+
+    Args:
+        centers (dict): zip code -> (lat, lng) of its center.
+        radius (float): The search radius in meters, used for every circle.
+
+    Returns:
+        list: [{"center": (lat, lng), "zip_codes": [zip codes whose circle it overlaps]}, ...]
+    """
+    if not centers:
+        return []
+    naive_plan = [{"center": center, "zip_codes": [zip_code]} for zip_code, center in centers.items()]
+    if len(centers) == 1:
+        return naive_plan
+
+    to_xy, to_lat_lng = _projection(centers)
+    zip_points = {zip_code: to_xy(*center) for zip_code, center in centers.items()}
+
+    # Sample points inside the union, bucketed into radius sized cells so we only compare nearby points
+    step = radius / SAMPLE_DIVISIONS
+    samples = set()
+    for x, y in zip_points.values():
+        # Points come from one shared grid, so overlapping zip codes share sample points
+        grid_x, grid_y = round(x / step), round(y / step)
+        for i in range(grid_x - SAMPLE_DIVISIONS - 1, grid_x + SAMPLE_DIVISIONS + 2):
+            for j in range(grid_y - SAMPLE_DIVISIONS - 1, grid_y + SAMPLE_DIVISIONS + 2):
+                if (i * step - x) ** 2 + (j * step - y) ** 2 <= radius * radius:
+                    samples.add((i, j))
+    samples = [(i * step, j * step) for i, j in samples]
+    buckets = defaultdict(list)
+    for index, (x, y) in enumerate(samples):
+        buckets[(int(x // radius), int(y // radius))].append(index)
+
+    # Candidate circles: every zip code center, plus a triangular grid over the bounding box of the samples
+    candidates = list(zip_points.values())
+    spacing = radius / CANDIDATE_DIVISIONS
+    min_x, max_x = min(x for x, _ in samples), max(x for x, _ in samples)
+    min_y, max_y = min(y for _, y in samples), max(y for _, y in samples)
+    row = 0
+    y = min_y
+    while y <= max_y:
+        x = min_x + (spacing / 2 if row % 2 else 0)
+        while x <= max_x:
+            candidates.append((x, y))
+            x += spacing
+        y += spacing * math.sqrt(3) / 2
+        row += 1
+
+    coverage = []
+    radius_squared = radius * radius
+    for cx, cy in candidates:
+        bucket_x, bucket_y = int(cx // radius), int(cy // radius)
+        covered = set()
+        for bx in (bucket_x - 1, bucket_x, bucket_x + 1):
+            for by in (bucket_y - 1, bucket_y, bucket_y + 1):
+                for index in buckets.get((bx, by), ()):
+                    sx, sy = samples[index]
+                    if (sx - cx) ** 2 + (sy - cy) ** 2 <= radius_squared:
+                        covered.add(index)
+        coverage.append(covered)
+
+    # Lazy greedy set cover: a candidate's gain can only shrink, so stale heap entries are re-scored when popped
+    uncovered = set(range(len(samples)))
+    heap = [(-len(covered), index) for index, covered in enumerate(coverage) if covered]
+    heapq.heapify(heap)
+    chosen = []
+    while uncovered and heap:
+        negative_gain, index = heapq.heappop(heap)
+        gain = len(coverage[index] & uncovered)
+        if gain == 0:
+            continue
+        if gain < -negative_gain:
+            heapq.heappush(heap, (-gain, index))
+            continue
+        chosen.append(index)
+        uncovered -= coverage[index]
+        if len(chosen) >= len(naive_plan):
+            return naive_plan
+
+    plan = []
+    for index in chosen:
+        center = to_lat_lng(*candidates[index])
+        overlapping = [zip_code for zip_code, zip_center in centers.items()
+                       if haversine_m(center[0], center[1], zip_center[0], zip_center[1]) < 2 * radius]
+        plan.append({"center": center, "zip_codes": overlapping})
+    return plan
+
+
+def zip_codes_near_place(place_lat: float, place_lng: float, centers: dict[str, tuple[float, float]],
+                         radius: float, candidate_zip_codes: list[str] | None = None) -> list[str]:
+    """The zip codes whose search circle contains a place, i.e. the zip_codes_nearby a per zip code search would give it."""
+    zip_codes = candidate_zip_codes if candidate_zip_codes is not None else centers.keys()
+    return [zip_code for zip_code in zip_codes
+            if haversine_m(place_lat, place_lng, centers[zip_code][0], centers[zip_code][1]) <= radius]
+
+
+def dry_run_zipcode_search(zip_codes: list[str], radius: float) -> dict:
+    """
+    Report how many Nearby Searches a zip code search would make with and without the coverage plan, without calling Google.
+
+    Only zip codes with cached coordinates can be planned, the rest would need a geocode call first
+    and are counted as one search each in both numbers.
+    """
+    zip_centers = {}
+    unlocated = []
+    for zip_code in dict.fromkeys(zip_codes):
+        location = get_cached_location(zip_code)
+        if location:
+            zip_centers[zip_code] = (location["lat"], location["lng"])
+        else:
+            unlocated.append(zip_code)
+
+    plan = plan_search_circles(zip_centers, radius)
+    naive_calls = len(zip_centers) + len(unlocated)
+    planned_calls = len(plan) + len(unlocated)
+    return {
+        "naive_nearby_calls": naive_calls,
+        "planned_nearby_calls": planned_calls,
+        "calls_saved": naive_calls - planned_calls,
+        "geocode_calls_needed": len(unlocated),
+        "zip_codes_without_cached_coordinates": unlocated,
+        "planned_searches": [{"lat": round(circle["center"][0], 6), "lng": round(circle["center"][1], 6), "zip_codes": circle["zip_codes"]}
+                             for circle in plan]
+    }
@@ -0,0 +1,103 @@
+"""
+Build the bundled zip code area table (data/zip_areas.csv.gz), used to pick a search radius for each zip code.
+
+The source is the same zipcodes package dataset as data/build_zip_centroids.py. It has no land areas or populations,
+but zip codes are drawn by the USPS around delivery volume, so how tightly packed the zip codes around one are is a
+good stand in for both: a Manhattan zip code is a few blocks, a Montana one is a county.
+The area of each standard zip code is estimated from the distance to its ZIP_NEIGHBORS-th nearest standard zip code
+(a k nearest neighbor density estimate). PO box, unique (a single building or company) and military zip codes sit inside
+a standard zip code, so they get the area of the nearest standard one.
+
+Usage:
+    pip install zipcodes==1.2.0
+    python data/build_zip_areas.py
+"""
+import bz2
+import csv
+import gzip
+import io
+import json
+import math
+import os
+import sys
+
+OUTPUT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "zip_areas.csv.gz")
+# Which neighbor's distance sets the area. Fewer is noisier, more blurs small towns into the countryside around them.
+ZIP_NEIGHBORS = 6
+# Clamp the estimates (km2): zip codes sharing a centroid would come out as 0, coastal ones with no neighbors at sea as huge
+MIN_AREA_KM2 = 0.25
+MAX_AREA_KM2 = 20000
+GRID_KM = 10.0
+# Stop looking for neighbors this far out (islands, military zip codes placed at sea)
+MAX_NEIGHBOR_KM = 500
+KM_PER_DEGREE_LAT = 110.574
+KM_PER_DEGREE_LNG_AT_EQUATOR = 111.320
+
+
+def _project(lat: float, lng: float) -> tuple[float, float]:
+    """Rough x, y in km, good enough for distances between neighboring zip codes."""
+    return lng * KM_PER_DEGREE_LNG_AT_EQUATOR * math.cos(math.radians(lat)), lat * KM_PER_DEGREE_LAT
+
+
+def _nearest(point: tuple[float, float], grid: dict, count: int, skip: int | None = None) -> list[tuple[float, int]]:
+    """(distance in km, index) of the count nearest points of the grid, nearest first, searching rings of cells outwards."""
+    cell_x, cell_y = int(point[0] // GRID_KM), int(point[1] // GRID_KM)
+    found = []
+    ring = 0
+    while True:
+        for dx in range(-ring, ring + 1):
+            for dy in range(-ring, ring + 1):
+                if max(abs(dx), abs(dy)) != ring:
+                    continue
+                for index, (x, y) in grid.get((cell_x + dx, cell_y + dy), ()):
+                    if index != skip:
+                        found.append((math.hypot(x - point[0], y - point[1]), index))
+        found.sort()
+        # Every point outside the rings searched so far is at least ring * GRID_KM away
+        if (len(found) >= count and found[count - 1][0] <= ring * GRID_KM) or ring * GRID_KM > MAX_NEIGHBOR_KM:
+            return found[:count]
+        ring += 1
+
+
+def build_zip_areas(source_file: str, output_file: str = OUTPUT_FILE) -> int:
+    """Write zip_code,area_km2 rows for every zip code with a centroid in the source file. Returns the number of rows written."""
+    with bz2.open(source_file, "rt") as file:
+        zips = [z for z in json.load(file) if z.get("lat") and z.get("long")]
+
+    points = [_project(float(z["lat"]), float(z["long"])) for z in zips]
+    standard = [i for i, z in enumerate(zips) if z["zip_code_type"] == "STANDARD"]
+    grid = {}
+    for i in standard:
+        grid.setdefault((int(points[i][0] // GRID_KM), int(points[i][1] // GRID_KM)), []).append((i, points[i]))
+
+    areas = {}
+    for i in standard:
+        neighbors = _nearest(points[i], grid, ZIP_NEIGHBORS, skip=i)
+        radius_km = neighbors[-1][0] if len(neighbors) == ZIP_NEIGHBORS else MAX_NEIGHBOR_KM
+        # k nearest neighbor density: (k - 1) zip codes per circle of radius r, so each covers pi r^2 / (k - 1)
+        areas[i] = min(MAX_AREA_KM2, max(MIN_AREA_KM2, math.pi * radius_km ** 2 / (ZIP_NEIGHBORS - 1)))
+
+    rows = []
+    for i, z in enumerate(zips):
+        if i not in areas:
+            nearest = _nearest(points[i], grid, 1)
+            areas[i] = areas[nearest[0][1]] if nearest else MAX_AREA_KM2
+        rows.append((z["zip_code"], round(areas[i], 2)))
+    rows.sort()
+
+    # mtime=0 keeps the output byte for byte reproducible
+    with gzip.GzipFile(output_file, "wb", mtime=0) as raw:
+        with io.TextIOWrapper(raw, encoding="utf-8", newline="") as file:
+            writer = csv.writer(file, lineterminator="\n")
+            writer.writerow(["zip_code", "area_km2"])
+            writer.writerows(rows)
+    return len(rows)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        source = sys.argv[1]
+    else:
+        import zipcodes
+        source = os.path.join(os.path.dirname(zipcodes.__file__), "zips.json.bz2")
+    print(f"Wrote {build_zip_areas(source)} zip code areas to {OUTPUT_FILE}")
@@ -0,0 +1,45 @@
+"""
+Build the bundled zip code centroid table (data/zip_centroids.csv.gz).
+
+The source is the MIT licensed zip code dataset shipped with the `zipcodes` python package
+(https://github.com/seanpianka/zipcodes, version 1.2.0), which has a centroid for every US zip code.
+We only keep the columns we need so the file stays small.
+
+Usage:
+    pip install zipcodes==1.2.0
+    python data/build_zip_centroids.py
+"""
+import bz2
+import csv
+import gzip
+import io
+import json
+import os
+import sys
+
+OUTPUT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "zip_centroids.csv.gz")
+
+
+def build_zip_centroids(source_file: str, output_file: str = OUTPUT_FILE) -> int:
+    """Write zip_code,lat,lng rows for every zip code in the source file. Returns the number of rows written."""
+    with bz2.open(source_file, "rt") as file:
+        zips = json.load(file)
+
+    rows = sorted((z["zip_code"], z["lat"], z["long"]) for z in zips if z.get("lat") and z.get("long"))
+
+    # mtime=0 keeps the output byte for byte reproducible
+    with gzip.GzipFile(output_file, "wb", mtime=0) as raw:
+        with io.TextIOWrapper(raw, encoding="utf-8", newline="") as file:
+            writer = csv.writer(file, lineterminator="\n")
+            writer.writerow(["zip_code", "lat", "lng"])
+            writer.writerows(rows)
+    return len(rows)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        source = sys.argv[1]
+    else:
+        import zipcodes
+        source = os.path.join(os.path.dirname(zipcodes.__file__), "zips.json.bz2")
+    print(f"Wrote {build_zip_centroids(source)} zip code centroids to {OUTPUT_FILE}")
@@ -0,0 +1,74 @@
+"""
+Build the bundled zip code table (data/zip_table.bin) that territory.py memory maps to validate zip codes and expand
+states, counties and "within N km of" areas into zip codes.
+
+The source is the same zipcodes package dataset as data/build_zip_centroids.py. The file is little endian and column
+oriented, so each column can be used in place as a typed memoryview without parsing or copying anything:
+
+    header      32 bytes: b"ZIPT", version (u32), number of zip codes n (u32), names offset (u32), names length (u32), padding
+    zip_code    u32[n], sorted (00501 is stored as 501)
+    lat, lng    f32[n] each, NaN if the source has no coordinates
+    county      u16[n], index into names["counties"]
+    state       u8[n], index into names["states"]
+    flags       u8[n], FLAG_ACTIVE | FLAG_STANDARD (PO box, unique and military zip codes aren't standard)
+    names       utf-8 JSON: {"states": [abbreviations], "counties": [names], "county_states": [state index of each county]}
+
+Usage:
+    pip install zipcodes==1.2.0
+    python data/build_zip_table.py
+"""
+import bz2
+import json
+import os
+import struct
+import sys
+from array import array
+
+OUTPUT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "zip_table.bin")
+MAGIC = b"ZIPT"
+VERSION = 1
+HEADER_FORMAT = "<4sIIII12x"
+FLAG_ACTIVE = 1
+FLAG_STANDARD = 2
+
+
+def build_zip_table(source_file: str, output_file: str = OUTPUT_FILE) -> int:
+    """Write the table for every zip code in the source file. Returns the number of zip codes written."""
+    with bz2.open(source_file, "rt") as file:
+        zips = sorted(json.load(file), key=lambda z: int(z["zip_code"]))
+
+    states = sorted({z["state"] for z in zips})
+    counties = sorted({(z["state"], z["county"] or "") for z in zips})
+    state_ids = {state: index for index, state in enumerate(states)}
+    county_ids = {county: index for index, county in enumerate(counties)}
+
+    columns = {"zip_code": array("I"), "lat": array("f"), "lng": array("f"), "county": array("H"), "state": array("B"), "flags": array("B")}
+    for z in zips:
+        columns["zip_code"].append(int(z["zip_code"]))
+        columns["lat"].append(float(z["lat"]) if z.get("lat") else float("nan"))
+        columns["lng"].append(float(z["long"]) if z.get("long") else float("nan"))
+        columns["county"].append(county_ids[(z["state"], z["county"] or "")])
+        columns["state"].append(state_ids[z["state"]])
+        columns["flags"].append((FLAG_ACTIVE if z["active"] else 0) | (FLAG_STANDARD if z["zip_code_type"] == "STANDARD" else 0))
+    if sys.byteorder != "little":
+        for column in columns.values():
+            column.byteswap()
+
+    names = json.dumps({"states": states, "counties": [county for _, county in counties],
+                        "county_states": [state_ids[state] for state, _ in counties]}, separators=(",", ":")).encode()
+    body = b"".join(column.tobytes() for column in columns.values())
+    header_size = struct.calcsize(HEADER_FORMAT)
+    with open(output_file, "wb") as file:
+        file.write(struct.pack(HEADER_FORMAT, MAGIC, VERSION, len(zips), header_size + len(body), len(names)))
+        file.write(body)
+        file.write(names)
+    return len(zips)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        source = sys.argv[1]
+    else:
+        import zipcodes
+        source = os.path.join(os.path.dirname(zipcodes.__file__), "zips.json.bz2")
+    print(f"Wrote {build_zip_table(source)} zip codes to {OUTPUT_FILE}")
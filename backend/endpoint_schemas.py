@@ -1,10 +1,49 @@
+from typing import Literal
 from pydantic import BaseModel
 
 class SearchTextQueryRequest(BaseModel):
     query: str
     region: str
+    use_cache: bool = True
 
-class SearchZipCodesRequest(BaseModel):
-    zip_codes: str | list[str]
+class RegionalSearch(BaseModel):
+    query: str
+    region: str
+
+class SearchTextQueryBatchRequest(BaseModel):
+    # Explicit (query, region) pairs, and/or every combination of queries x regions
+    searches: list[RegionalSearch] = []
+    queries: list[str] = []
+    regions: list[str] = []
+    use_cache: bool = True
+
+class WithinArea(BaseModel):
+    # Every zip code whose center is within km of center (a zip code or "lat,lng")
+    center: str
+    km: float
+
+class TerritoryRequest(BaseModel):
+    # Any mix of zip codes (a list and/or strings separated by commas or whitespace), states, counties and areas, see territory.py
+    zip_codes: str | list[str] = []
+    states: list[str] = []
+    counties: list[str] = []
+    within: list[WithinArea] = []
+
+class SearchZipCodesRequest(TerritoryRequest):
+    included_types: str | list[str]
+    radius: int = 5000
+    use_cache: bool = True
+    adaptive_tiling: bool = False
+    plan_coverage: bool = False
+    stream_mode: Literal["batch", "incremental"] = "batch"
+    # Pick each zip code's radius from its area and past searches, radius is only used for zip codes we know nothing about
+    auto_radius: bool = False
+
+class SearchZipCodesJobRequest(TerritoryRequest):
+    # Jobs search zip code by zip code so each one can be checkpointed, so there's no plan_coverage or stream_mode here
+    rep: str = "default"
     included_types: str | list[str]
-    radius: int = 5000
\ No newline at end of file
+    radius: int = 5000
+    use_cache: bool = True
+    adaptive_tiling: bool = False
+    auto_radius: bool = False
@@ -0,0 +1,35 @@
+# Small geometry helpers for working with search circles (lat/lng in degrees, distances in meters)
+
+import math
+
+EARTH_RADIUS_M = 6371008.8
+METERS_PER_DEGREE_LAT = 111320.0
+
+
+def haversine_m(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    """Great circle distance between two points in meters."""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lng2 - lng1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+
+def offset_point(lat: float, lng: float, north_m: float, east_m: float) -> tuple[float, float]:
+    """Move a point north/east by a number of meters. Accurate enough for the few km our search circles span."""
+    new_lat = lat + north_m / METERS_PER_DEGREE_LAT
+    new_lng = lng + east_m / (METERS_PER_DEGREE_LAT * math.cos(math.radians(lat)))
+    return new_lat, new_lng
+
+
+def split_circle(lat: float, lng: float, radius: float) -> list[tuple[float, float, float]]:
+    """
+    Split a circle into 4 smaller overlapping circles that together cover it.
+
+    Each sub circle is centered on one quadrant of the circle's bounding square and just covers that quadrant,
+    so the sub circles have a radius of radius / sqrt(2).
+    """
+    half = radius / 2
+    sub_radius = radius / math.sqrt(2)
+    return [(*offset_point(lat, lng, north, east), sub_radius)
+            for north in (half, -half) for east in (half, -half)]
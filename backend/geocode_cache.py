@@ -0,0 +1,127 @@
+# Persistent cache of zip code coordinates, so each zip code only ever has to be geocoded once
+
+import csv
+import gzip
+import os
+import sqlite3
+import sys
+import threading
+from datetime import datetime
+
+GEOCODE_CACHE_DB = "geocode_cache.sqlite3"
+# Offline centroid table for every US zip code, see data/build_zip_centroids.py
+BUNDLED_CENTROIDS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "zip_centroids.csv.gz")
+
+_local = threading.local()
+_initialized_databases = set()
+
+
+def normalize_zip_code(zip_code) -> str:
+    """Strip whitespace and restore the leading zeros spreadsheets like to drop (e.g. 501 -> 00501)."""
+    return str(zip_code).strip().lstrip("﻿").zfill(5)
+
+
+def _get_connection(db_path: str = GEOCODE_CACHE_DB) -> sqlite3.Connection:
+    """
+    Get this thread's connection to the cache database, creating the table the first time (same setup as usage_store.py).
+
+    A brand new cache is pre-loaded from the bundled centroid table, so most zip codes never hit the Geocoding API.
+    """
+    connections = getattr(_local, "connections", None)
+    if connections is None:
+        connections = _local.connections = {}
+    conn = connections.get(db_path)
+    if conn is None:
+        conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=30000")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS zip_locations (
+                zip_code TEXT PRIMARY KEY,
+                lat REAL NOT NULL,
+                lng REAL NOT NULL,
+                source TEXT NOT NULL,
+                updated_at TEXT NOT NULL
+            )""")
+        connections[db_path] = conn
+        if db_path not in _initialized_databases:
+            _initialized_databases.add(db_path)
+            is_empty = conn.execute("SELECT 1 FROM zip_locations LIMIT 1").fetchone() is None
+            if is_empty and os.path.exists(BUNDLED_CENTROIDS_FILE):
+                preload_centroids(db_path=db_path)
+    return conn
+
+
+def get_cached_location(zip_code: str, db_path: str = GEOCODE_CACHE_DB):
+    """
+    Look up the coordinates of a zip code in the cache.
+
+    Returns:
+        dict | None: {"lat": ..., "lng": ...} in the same shape the Geocoding API returns, or None on a cache miss.
+    """
+    row = _get_connection(db_path).execute("SELECT lat, lng FROM zip_locations WHERE zip_code = ?", (normalize_zip_code(zip_code),)).fetchone()
+    if row is None:
+        return None
+    return {"lat": row[0], "lng": row[1]}
+
+
+def cache_location(zip_code: str, location: dict, source: str = "google", db_path: str = GEOCODE_CACHE_DB):
+    """Save the coordinates of a zip code, replacing whatever was cached before."""
+    _get_connection(db_path).execute("INSERT OR REPLACE INTO zip_locations (zip_code, lat, lng, source, updated_at) VALUES (?, ?, ?, ?, ?)",
+                                     (normalize_zip_code(zip_code), location["lat"], location["lng"], source, datetime.now().isoformat(timespec="seconds")))
+
+
+def read_zip_code_list(path: str) -> list[str]:
+    """Read a list of zip codes from a file like the ones in docs/zipcodes (one per line or comma separated)."""
+    zip_codes = []
+    with open(path, "r", encoding="utf-8-sig") as file:
+        for line in file:
+            for value in line.replace(",", " ").split():
+                if value.isdigit():
+                    zip_codes.append(normalize_zip_code(value))
+    return zip_codes
+
+
+def preload_centroids(centroids_file: str = BUNDLED_CENTROIDS_FILE, zip_codes: list[str] | None = None,
+                      db_path: str = GEOCODE_CACHE_DB) -> int:
+    """
+    Load zip code centroids from a zip_code,lat,lng csv (optionally gzipped) into the cache.
+
+    Entries that came from Google are never overwritten by the bundled data.
+
+    Args:
+        centroids_file (str): Path to the centroid csv. Defaults to the bundled table.
+        zip_codes (list, optional): Only load these zip codes. Defaults to every zip code in the file.
+
+    Returns:
+        int: Number of zip codes loaded.
+    """
+    wanted = {normalize_zip_code(z) for z in zip_codes} if zip_codes is not None else None
+    opener = gzip.open if centroids_file.endswith(".gz") else open
+    now = datetime.now().isoformat(timespec="seconds")
+
+    with opener(centroids_file, "rt", encoding="utf-8") as file:
+        rows = [(normalize_zip_code(row["zip_code"]), float(row["lat"]), float(row["lng"]), "bundled", now)
+                for row in csv.DictReader(file)
+                if wanted is None or normalize_zip_code(row["zip_code"]) in wanted]
+
+    conn = _get_connection(db_path)
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.executemany("INSERT OR IGNORE INTO zip_locations (zip_code, lat, lng, source, updated_at) VALUES (?, ?, ?, ?, ?)", rows)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return len(rows)
+
+
+if __name__ == "__main__":
+    # Usage: python geocode_cache.py [zip list files, e.g. ../docs/zipcodes/NY_zipcodes.csv]
+    # Loads the bundled centroids for the listed zip codes (or all of them) and reports any zip codes still missing.
+    requested = [zip_code for path in sys.argv[1:] for zip_code in read_zip_code_list(path)] or None
+    print(f"Loaded {preload_centroids(zip_codes=requested)} zip code centroids into {GEOCODE_CACHE_DB}")
+    if requested:
+        missing = [zip_code for zip_code in requested if get_cached_location(zip_code) is None]
+        print(f"{len(requested) - len(missing)} of {len(requested)} zip codes are cached. Missing: {', '.join(missing) or 'none'}")
@@ -0,0 +1,160 @@
+# One pooled async HTTP client shared by every request to Google, so we reuse connections instead of
+# doing a new TCP + TLS handshake for each call. It is created when the app starts (see main.py) and
+# injected into both search paths.
+
+import asyncio
+import os
+import random
+import time
+
+import httpx
+
+from metrics import BUCKETS_SECONDS, observe, increment, record_error, histogram_stats, counter_values
+from quota_scheduler import acquire_call_slot
+from settings import get_config
+
+# Point these at a local stand-in server to test or benchmark without spending quota
+PLACES_BASE_URL = os.getenv("GOOGLE_PLACES_BASE_URL", "https://places.googleapis.com")
+MAPS_BASE_URL = os.getenv("GOOGLE_MAPS_BASE_URL", "https://maps.googleapis.com")
+
+# Used if the api_limit_config.json file doesn't have an HTTP_CLIENT section
+DEFAULT_HTTP_CLIENT_CONFIG = {
+    "MAX_CONNECTIONS": 50,
+    "MAX_KEEPALIVE_CONNECTIONS": 20,
+    "KEEPALIVE_EXPIRY": 60,
+    "CONNECT_TIMEOUT": 5,
+    "READ_TIMEOUT": 20,
+    "MAX_RETRIES": 3,
+    "RETRY_BASE_DELAY": 0.5,
+    "RETRY_MAX_DELAY": 8
+}
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+# A POST (the billed Places endpoints) may already have been run, and billed, by Google after a read timeout or a 5xx,
+# and a retry doesn't count against our limits. So a POST is only sent again when it never reached Google, or Google
+# refused it with a 429.
+NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+POST_RETRY_STATUS_CODES = {429}
+
+_shared_client = None
+_client_config = dict(DEFAULT_HTTP_CLIENT_CONFIG)
+
+
+def _http2_available() -> bool:
+    """httpx only speaks HTTP/2 when the optional h2 package is installed."""
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def create_google_client() -> httpx.AsyncClient:
+    """
+    Create a pooled client for Google's APIs, tuned from the HTTP_CLIENT section of api_limit_config.json.
+
+    Connections are kept alive between calls (and between requests to our app), and HTTP/2 is used when h2 is installed
+    so concurrent zip code searches can share a single connection to places.googleapis.com.
+    """
+    global _client_config
+    _client_config = {**DEFAULT_HTTP_CLIENT_CONFIG, **get_config().get("HTTP_CLIENT", {})}
+
+    limits = httpx.Limits(max_connections=_client_config["MAX_CONNECTIONS"],
+                          max_keepalive_connections=_client_config["MAX_KEEPALIVE_CONNECTIONS"],
+                          keepalive_expiry=_client_config["KEEPALIVE_EXPIRY"])
+    timeout = httpx.Timeout(_client_config["READ_TIMEOUT"], connect=_client_config["CONNECT_TIMEOUT"])
+    return httpx.AsyncClient(http2=_http2_available(), limits=limits, timeout=timeout)
+
+
+def open_shared_client() -> httpx.AsyncClient:
+    """Create the process wide client (called when the app starts)."""
+    global _shared_client
+    if _shared_client is None or _shared_client.is_closed:
+        _shared_client = create_google_client()
+    return _shared_client
+
+
+def get_shared_client() -> httpx.AsyncClient:
+    """Get the process wide client, creating it if the app didn't (e.g. when a search function is used on its own)."""
+    return open_shared_client()
+
+
+async def close_shared_client():
+    """Close the shared client (called when the app shuts down)."""
+    global _shared_client
+    if _shared_client is not None:
+        await _shared_client.aclose()
+        _shared_client = None
+
+
+def _record_latency(label: str, elapsed_ms: float, status: str):
+    """Record one attempt in the google_request_seconds / google_requests_total metrics (see metrics.py)."""
+    observe("google_request_seconds", elapsed_ms / 1000, endpoint=label)
+    increment("google_requests_total", endpoint=label, outcome=status)
+
+
+def get_latency_stats() -> dict:
+    """Per endpoint call latency (every attempt, including retries) for the analytics endpoint."""
+    report = {"http2": _http2_available()}
+    outcomes = counter_values("google_requests_total")
+    for labels, stats in histogram_stats("google_request_seconds").items():
+        label = dict(labels)["endpoint"]
+        report[label] = {
+            "calls": stats["count"],
+            "retries": int(outcomes.get((("endpoint", label), ("outcome", "retry")), 0)),
+            "errors": int(outcomes.get((("endpoint", label), ("outcome", "error")), 0)),
+            "avg_ms": round(stats["sum"] / stats["count"] * 1000, 1),
+            "min_ms": round(stats["min"] * 1000, 1),
+            "max_ms": round(stats["max"] * 1000, 1),
+            "histogram_ms": {f"<={upper * 1000:g}": count for upper, count in zip(BUCKETS_SECONDS, stats["buckets"])}
+                            | {f">{BUCKETS_SECONDS[-1] * 1000:g}": stats["buckets"][-1]}
+        }
+    return report
+
+
+def _retry_delay(attempt: int, response: httpx.Response | None) -> float:
+    """Exponential backoff with full jitter, or whatever Retry-After asks for if Google sends it."""
+    if response is not None and response.headers.get("Retry-After", "").isdigit():
+        return min(float(response.headers["Retry-After"]), _client_config["RETRY_MAX_DELAY"])
+    return random.uniform(0, min(_client_config["RETRY_MAX_DELAY"], _client_config["RETRY_BASE_DELAY"] * 2 ** attempt))
+
+
+async def request_with_retries(client: httpx.AsyncClient, method: str, url: str, label: str, **kwargs) -> httpx.Response:
+    """
+    Send a request, retrying with jittered backoff on 429s, 5xxs and connection errors.
+    POSTs are only retried on 429s and on errors where the request was never sent (see NOT_SENT_ERRORS).
+
+    Every attempt waits for the label's token bucket (see quota_scheduler.py) and its latency is recorded under
+    label (e.g. "nearby_search"). The api call limits are checked once by the caller, a retry doesn't count as another call.
+
+    Returns:
+        httpx.Response: The last response (which may still be an error if we ran out of retries).
+
+    Raises:
+        httpx.HTTPError: If the last attempt couldn't get a response at all.
+    """
+    max_retries = _client_config["MAX_RETRIES"]
+    is_post = method.upper() == "POST"
+    retry_errors = NOT_SENT_ERRORS if is_post else (httpx.TransportError, httpx.TimeoutException)
+    retry_status_codes = POST_RETRY_STATUS_CODES if is_post else RETRY_STATUS_CODES
+    for attempt in range(max_retries + 1):
+        await acquire_call_slot(label)
+        start = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+        except (httpx.TransportError, httpx.TimeoutException) as e:
+            record_error(label, type(e).__name__)
+            retry = attempt < max_retries and isinstance(e, retry_errors)
+            _record_latency(label, (time.perf_counter() - start) * 1000, "retry" if retry else "error")
+            if not retry:
+                raise
+            await asyncio.sleep(_retry_delay(attempt, None))
+            continue
+
+        if response.status_code >= 400:
+            record_error(label, f"http_{response.status_code}")
+        if response.status_code in retry_status_codes and attempt < max_retries:
+            _record_latency(label, (time.perf_counter() - start) * 1000, "retry")
+            await asyncio.sleep(_retry_delay(attempt, response))
+            continue
+        _record_latency(label, (time.perf_counter() - start) * 1000, "ok" if response.status_code < 400 else "error")
+        return response
@@ -0,0 +1,283 @@
+# Fuzzy deduplication of leads across result sets.
+#
+# Exact place id dedup misses the same business listed twice on Google (a duplicate listing, or the same car wash
+# under "Joe's Car Wash" and "Joes Carwash & Detail"), and the same business found by different searches.
+# Leads are only compared with candidates that share a block: nearby (same or neighboring geohash cell), the same
+# phone number, or the same website domain. Names and addresses are compared with trigram similarity, and duplicates
+# are grouped with union-find, so a lead found three different ways ends up as one record.
+# Similar names alone aren't enough: once the generic words are dropped, "Joe's Car Wash" and "Joe's Auto Detailing" next
+# door are both just "joes". Names only count together with a similar address or the same phone number or website domain.
+
+import re
+
+from geo_utils import haversine_m
+
+# Leads are blocked by geohash cells of this precision, about 150m x 150m (at the equator; narrower further north)
+GEOHASH_PRECISION = 7
+_GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+# Cells are keyed by one int, row * _CELL_KEY_ROW + column, leaving room for a neighbor on either side of every column
+_CELL_KEY_ROW = 2 ** ((5 * GEOHASH_PRECISION + 1) // 2) + 2
+
+# Candidates found by phone or website can be this far apart (duplicate listings are sometimes pinned in the wrong place)
+MAX_CONTACT_MATCH_DISTANCE_M = 5000
+# Rules for calling two candidates the same business (similarities are 0 to 1, see _similarity)
+SAME_ADDRESS_DISTANCE_M = 300
+SAME_ADDRESS_SIMILARITY = 0.9
+SAME_ADDRESS_NAME_SIMILARITY = 0.5
+SAME_CONTACT_NAME_SIMILARITY = 0.5
+SAME_CONTACT_ADDRESS_SIMILARITY = 0.8
+# A block with more leads than this (e.g. a chain's shared phone number) is too generic to use
+MAX_BLOCK_SIZE = 50
+
+# Words every car wash (or automotive business) name has, which would make unrelated names look alike
+NAME_STOP_WORDS = {"the", "and", "car", "cars", "wash", "washes", "carwash", "auto", "autos", "automotive", "detail", "detailing",
+                   "express", "service", "services", "center", "centre", "llc", "inc", "co", "corp", "company", "ltd"}
+ADDRESS_ABBREVIATIONS = {"street": "st", "avenue": "ave", "road": "rd", "drive": "dr", "boulevard": "blvd", "highway": "hwy",
+                         "lane": "ln", "court": "ct", "place": "pl", "parkway": "pkwy", "suite": "ste", "north": "n",
+                         "south": "s", "east": "e", "west": "w", "route": "rte", "usa": "", "united": "", "states": ""}
+# Website hosts shared by many unrelated businesses, so they don't say anything about who a lead is
+SHARED_WEBSITE_DOMAINS = {"facebook.com", "instagram.com", "google.com", "sites.google.com", "business.site", "yelp.com",
+                          "square.site", "wixsite.com", "linktr.ee", "godaddysites.com", "weebly.com", "squarespace.com"}
+# List fields that are combined when leads are merged (everything else is taken from the primary lead, or the first lead that has it)
+LIST_FIELDS = ("zip_codes_nearby", "matched_queries", "matched_regions", "types")
+
+_WORDS = re.compile(r"[a-z0-9]+")
+_NON_DIGITS = re.compile(r"\D")
+_URL_HOST = re.compile(r"^(?:[a-z][a-z0-9+.-]*:)?//([^/:?#@]+)")
+
+
+def geohash_cell(lat: float, lng: float, precision: int = GEOHASH_PRECISION) -> tuple[int, int]:
+    """
+    The (row, column) of the geohash cell a point is in. A geohash interleaves the bits of these two numbers,
+    so cells can be compared (and their neighbors found, by adding 1) without building the strings.
+    """
+    lng_bits = (5 * precision + 1) // 2
+    lat_bits = 5 * precision // 2
+    row = min(int((lat + 90) / 180 * 2 ** lat_bits), 2 ** lat_bits - 1)
+    column = min(int((lng + 180) / 360 * 2 ** lng_bits), 2 ** lng_bits - 1)
+    return row, column
+
+
+def geohash(lat: float, lng: float, precision: int = GEOHASH_PRECISION) -> str:
+    """The geohash of a point."""
+    row, column = geohash_cell(lat, lng, precision)
+    lng_bits = (5 * precision + 1) // 2
+    lat_bits = 5 * precision // 2
+    # Longitude bits go first, then they alternate
+    bits = 0
+    for i in range(5 * precision):
+        if i % 2 == 0:
+            lng_bits -= 1
+            bits = (bits << 1) | ((column >> lng_bits) & 1)
+        else:
+            lat_bits -= 1
+            bits = (bits << 1) | ((row >> lat_bits) & 1)
+    return "".join(_GEOHASH_ALPHABET[(bits >> shift) & 31] for shift in range(5 * (precision - 1), -1, -5))
+
+
+def normalize_phone(phone: str | None) -> str | None:
+    """The last 10 digits of a phone number, so "(555) 123-4567" and "+1 555-123-4567" match."""
+    digits = _NON_DIGITS.sub("", phone or "")
+    return digits[-10:] if len(digits) >= 10 else None
+
+
+def website_domain(website: str | None) -> str | None:
+    """A website's domain without "www.", or None if there isn't one or it's a host many businesses share."""
+    if not website:
+        return None
+    website = website.strip().lower()
+    match = _URL_HOST.match(website if "//" in website else f"//{website}")
+    host = match.group(1).removeprefix("www.") if match else ""
+    # Both the host (sites.google.com) and the domain it's under (something.wixsite.com) are checked
+    if not host or host in SHARED_WEBSITE_DOMAINS or ".".join(host.rsplit(".", 2)[-2:]) in SHARED_WEBSITE_DOMAINS:
+        return None
+    return host
+
+
+def normalize_name(name: str | None) -> str:
+    """
+    Lowercase words of a business name without punctuation and the words every car wash has.
+    Empty if that's all it has, so two names like "Car Wash" and "Auto Wash" never count as similar.
+    """
+    words = _WORDS.findall((name or "").lower().replace("'", "").replace("&", " and "))
+    return " ".join(word for word in words if word not in NAME_STOP_WORDS)
+
+
+def normalize_address(address: str | None) -> str:
+    """Lowercase words of an address with the usual street abbreviations."""
+    words = _WORDS.findall((address or "").lower())
+    return " ".join(word for word in (ADDRESS_ABBREVIATIONS.get(word, word) for word in words) if word)
+
+
+def _trigrams(text: str) -> frozenset:
+    """The set of 3 character pieces of a text (padded, so short words still have some)."""
+    padded = f"  {text} "
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2)) if text else frozenset()
+
+
+def _similarity(a: frozenset, b: frozenset) -> float:
+    """Jaccard similarity of two trigram sets (the set operations run in C, so this is cheap enough to run on every candidate pair)."""
+    if not a or not b:
+        return 0.0
+    shared = len(a & b)
+    return shared / (len(a) + len(b) - shared)
+
+
+def _street_number(normalized_address: str) -> str | None:
+    first_word = normalized_address.split(" ", 1)[0]
+    return first_word if first_word[:1].isdigit() else None
+
+
+class _UnionFind:
+    def __init__(self, size: int):
+        self.parent = list(range(size))
+
+    def find(self, i: int) -> int:
+        while self.parent[i] != i:
+            self.parent[i] = self.parent[self.parent[i]]
+            i = self.parent[i]
+        return i
+
+    def union(self, i: int, j: int):
+        root_i, root_j = self.find(i), self.find(j)
+        if root_i != root_j:
+            # The earlier lead stays the root, so groups keep the order leads came in
+            self.parent[max(root_i, root_j)] = min(root_i, root_j)
+
+
+def _is_duplicate(a: dict, b: dict, distance: float, same_contact: bool) -> bool:
+    """Whether two prepared leads (see find_duplicate_groups) are the same business."""
+    # Two different street numbers are two different places, however alike the names are
+    if a["street_number"] and b["street_number"] and a["street_number"] != b["street_number"]:
+        return False
+    if distance <= SAME_ADDRESS_DISTANCE_M and _similarity(a["address"], b["address"]) >= SAME_ADDRESS_SIMILARITY \
+            and _similarity(a["name"], b["name"]) >= SAME_ADDRESS_NAME_SIMILARITY:
+        return True
+    if same_contact and distance <= MAX_CONTACT_MATCH_DISTANCE_M:
+        return (_similarity(a["name"], b["name"]) >= SAME_CONTACT_NAME_SIMILARITY
+                or _similarity(a["address"], b["address"]) >= SAME_CONTACT_ADDRESS_SIMILARITY)
+    return False
+
+
+def find_duplicate_groups(leads: list[dict]) -> list[list[int]]:
+    """
+    Group leads that are the same business.
+
+    Args:
+        leads (list): Lead records, with at least goog_places_id, name, lat and lng (address, phone and website help).
+
+    Returns:
+        list: Lists of indexes into leads, one per business, in the order each business first appears.
+    """
+    groups = _UnionFind(len(leads))
+    first_index = {}     # place id -> index of its first lead
+    cell_blocks = {}     # geohash cell (as row * CELL_KEY_ROW + column) -> indexes of the leads in it
+    contact_blocks = {}  # phone number or website domain -> indexes of the leads with it
+    lat_scale, lng_scale = 2 ** (5 * GEOHASH_PRECISION // 2) / 180, 2 ** ((5 * GEOHASH_PRECISION + 1) // 2) / 360
+    for i, lead in enumerate(leads):
+        # The same place from two result sets
+        j = first_index.setdefault(lead["goog_places_id"], i)
+        if j != i:
+            # Only the first lead of each place is compared with the others, the rest follow it
+            groups.union(j, i)
+            continue
+        # Same cell as geohash_cell, inlined since it runs for every lead
+        cell = int((lead["lat"] + 90) * lat_scale) * _CELL_KEY_ROW + int((lead["lng"] + 180) * lng_scale)
+        cell_blocks.setdefault(cell, []).append(i)
+        phone = normalize_phone(lead.get("phone"))
+        if phone:
+            contact_blocks.setdefault(("phone", phone), []).append(i)
+        domain = website_domain(lead.get("website"))
+        if domain:
+            contact_blocks.setdefault(("domain", domain), []).append(i)
+
+    # Names and addresses are only prepared for leads that turn out to have a candidate
+    prepared = [None] * len(leads)
+    for members in contact_blocks.values():
+        if 1 < len(members) <= MAX_BLOCK_SIZE:
+            _compare_block(leads, prepared, groups, members, members, same_contact=True)
+
+    # Nearby leads: each cell against itself and half the cells around it (the other half compare against this one)
+    for cell, members in cell_blocks.items():
+        for neighbor in (cell, cell + 1, cell + _CELL_KEY_ROW - 1, cell + _CELL_KEY_ROW, cell + _CELL_KEY_ROW + 1):
+            others = cell_blocks.get(neighbor)
+            if others is not None and (len(members) > 1 or others is not members):
+                _compare_block(leads, prepared, groups, members, others, same_contact=False)
+
+    grouped = {}
+    for i in range(len(leads)):
+        grouped.setdefault(groups.find(i), []).append(i)
+    return list(grouped.values())
+
+
+def _prepare(lead: dict) -> dict:
+    """The normalized name and address of a lead, for _is_duplicate."""
+    address = normalize_address(lead.get("address"))
+    return {
+        "name": _trigrams(normalize_name(lead.get("name"))),
+        "address": _trigrams(address),
+        "street_number": _street_number(address)
+    }
+
+
+def _compare_block(leads: list[dict], prepared: list, groups: _UnionFind, members: list[int], others: list[int], same_contact: bool):
+    for i in members:
+        for j in others:
+            # Within one block, compare each pair once
+            if (members is others and j <= i) or i == j:
+                continue
+            if groups.find(i) == groups.find(j):
+                continue
+            distance = haversine_m(leads[i]["lat"], leads[i]["lng"], leads[j]["lat"], leads[j]["lng"])
+            for k in (i, j):
+                if prepared[k] is None:
+                    prepared[k] = _prepare(leads[k])
+            if _is_duplicate(prepared[i], prepared[j], distance, same_contact):
+                groups.union(i, j)
+
+
+def merge_group(group: list[dict]) -> dict:
+    """
+    Merge the leads of one business into one record.
+
+    The lead with the most filled in fields is kept (the first one on a tie), missing fields are filled in from the others,
+    list fields (zip_codes_nearby, matched_queries...) are combined, and the other leads' place ids go in "duplicate_place_ids".
+    """
+    if len(group) == 1:
+        return group[0]
+    primary = max(group, key=lambda lead: sum(value is not None and value != [] for value in lead.values()))
+    merged = dict(primary)
+    for key in LIST_FIELDS:
+        if any(key in lead for lead in group):
+            combined = []
+            for lead in [primary, *group]:
+                combined.extend(item for item in lead.get(key) or [] if item not in combined)
+            merged[key] = combined
+    for lead in group:
+        for key, value in lead.items():
+            if merged.get(key) is None:
+                merged[key] = value
+
+    duplicate_place_ids = []
+    for lead in group:
+        for place_id in [lead["goog_places_id"], *lead.get("duplicate_place_ids", [])]:
+            if place_id != merged["goog_places_id"] and place_id not in duplicate_place_ids:
+                duplicate_place_ids.append(place_id)
+    merged["duplicate_place_ids"] = duplicate_place_ids
+    return merged
+
+
+def dedupe_leads(*result_sets) -> list[dict]:
+    """
+    Merge one or more result sets into one list with each business once.
+
+    Args:
+        *result_sets: Iterables of lead records (zip code, regional or stored leads). Leads with the same place id are
+            merged too, so the same result set can be combined with others directly.
+
+    Returns:
+        list: The merged leads, in the order each business first appears. A lead that absorbed others has their place ids
+              in "duplicate_place_ids".
+    """
+    leads = [lead for result_set in result_sets for lead in result_set]
+    return [merge_group([leads[i] for i in group]) for group in find_duplicate_groups(leads)]
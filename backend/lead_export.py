@@ -0,0 +1,205 @@
+# Bulk export of leads as CSV, Parquet, Arrow or Excel, generated a chunk at a time on the backend.
+#
+# The frontend used to build its CSV download from the full JSON results, which hangs the tab past ~1000 rows.
+# Exports read their leads lazily (from a search run, a job's checkpoints or the lead store) and stream the file out,
+# so memory stays flat no matter how many leads there are. Every list column (e.g. zip_codes_nearby) is flattened
+# into one text cell, so the files import into a CRM as one row per lead.
+
+import csv
+import importlib.util
+import io
+import tempfile
+from itertools import islice
+
+# Rows written between each chunk we send
+CSV_CHUNK_ROWS = 500
+ROW_GROUP_ROWS = 5000
+XLSX_READ_CHUNK_BYTES = 64 * 1024
+# How list values are joined into one cell
+LIST_SEPARATOR = "; "
+
+# Column name -> its type in Parquet / Arrow ("string" or "float")
+EXPORT_COLUMNS = {
+    "name": "string",
+    "address": "string",
+    "phone": "string",
+    "website": "string",
+    "goog_rating": "float",
+    "lat": "float",
+    "lng": "float",
+    "types": "string",
+    "zip_codes_nearby": "string",
+    "matched_queries": "string",
+    "matched_regions": "string",
+    "goog_places_id": "string",
+    "first_seen": "string",
+    "last_seen": "string"
+}
+
+# Format -> (media type, file extension, optional package it needs)
+EXPORT_FORMATS = {
+    "csv": ("text/csv; charset=utf-8", "csv", None),
+    "parquet": ("application/vnd.apache.parquet", "parquet", "pyarrow"),
+    "arrow": ("application/vnd.apache.arrow.stream", "arrows", "pyarrow"),
+    "xlsx": ("application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", "xlsx", "openpyxl")
+}
+
+
+def check_export_format(export_format: str) -> str | None:
+    """Returns an error message if we can't export in this format, otherwise None."""
+    if export_format not in EXPORT_FORMATS:
+        return f"Unknown export format {export_format}. Use one of: {', '.join(EXPORT_FORMATS)}"
+    package = EXPORT_FORMATS[export_format][2]
+    if package and importlib.util.find_spec(package) is None:
+        return f"Exporting {export_format} needs the {package} package, which isn't installed on the server (pip install {package})"
+    return None
+
+
+def flatten_lead(lead: dict) -> dict:
+    """One export row for a lead: every column in EXPORT_COLUMNS, with lists joined into one string and missing values as None."""
+    row = {}
+    for column in EXPORT_COLUMNS:
+        value = lead.get(column)
+        if isinstance(value, (list, tuple)):
+            value = LIST_SEPARATOR.join(str(item) for item in value)
+        row[column] = value
+    return row
+
+
+def _chunks(rows, size: int):
+    """Lists of up to size rows, read lazily from rows."""
+    rows = iter(rows)
+    while chunk := list(islice(rows, size)):
+        yield chunk
+
+
+def _csv_safe(value):
+    """
+    Stop spreadsheet apps from running a cell as a formula (e.g. a business named "=HYPERLINK(...)").
+    Excel and Google Sheets treat cells starting with =, +, - or @ as formulas, so those get a leading quote.
+    """
+    if isinstance(value, str) and value[:1] in ("=", "+", "-", "@"):
+        return "'" + value
+    return value
+
+
+def iter_csv(leads):
+    """CSV text (with a header row), a chunk of CSV_CHUNK_ROWS rows at a time."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for chunk in _chunks(leads, CSV_CHUNK_ROWS):
+        for lead in chunk:
+            writer.writerow([_csv_safe(value) for value in flatten_lead(lead).values()])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        # Only the header (there were no leads)
+        yield buffer.getvalue()
+
+
+class _ChunkSink:
+    """A write-only file that hands back whatever was written since the last drain, so a writer's output can be streamed."""
+
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self.parts.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+
+def _arrow_schema():
+    import pyarrow as pa
+    arrow_types = {"string": pa.string(), "float": pa.float64()}
+    return pa.schema([(column, arrow_types[column_type]) for column, column_type in EXPORT_COLUMNS.items()])
+
+
+def iter_parquet(leads):
+    """A Parquet file, one row group (and one chunk) per ROW_GROUP_ROWS leads."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = _arrow_schema()
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(pa.PythonFile(sink, mode="w"), schema, compression="snappy")
+    try:
+        for chunk in _chunks(leads, ROW_GROUP_ROWS):
+            writer.write_table(pa.Table.from_pylist([flatten_lead(lead) for lead in chunk], schema=schema))
+            yield sink.drain()
+    finally:
+        # Closing writes the footer
+        writer.close()
+    yield sink.drain()
+
+
+def iter_arrow(leads):
+    """An Arrow IPC stream, one record batch (and one chunk) per ROW_GROUP_ROWS leads."""
+    import pyarrow as pa
+
+    schema = _arrow_schema()
+    sink = _ChunkSink()
+    writer = pa.ipc.new_stream(pa.PythonFile(sink, mode="w"), schema)
+    try:
+        for chunk in _chunks(leads, ROW_GROUP_ROWS):
+            writer.write_batch(pa.RecordBatch.from_pylist([flatten_lead(lead) for lead in chunk], schema=schema))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+def iter_xlsx(leads):
+    """
+    An Excel workbook with one "Leads" sheet.
+
+    An xlsx file is a zip archive that can only be written out once every row is in, so nothing is sent until the end.
+    openpyxl's write-only mode keeps the rows in a temporary file rather than in memory while it's built.
+    """
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("Leads")
+    sheet.append(list(EXPORT_COLUMNS))
+    for lead in leads:
+        sheet.append(list(flatten_lead(lead).values()))
+
+    with tempfile.TemporaryFile() as file:
+        workbook.save(file)
+        file.seek(0)
+        while data := file.read(XLSX_READ_CHUNK_BYTES):
+            yield data
+
+
+def export_leads(leads, export_format: str):
+    """
+    Stream leads as a file in export_format ("csv", "parquet", "arrow" or "xlsx"). Call check_export_format first.
+
+    Args:
+        leads (iterable): Lead dicts (from iter_search_run_leads, iter_job_leads, iter_leads...), read one at a time.
+        export_format (str): A key of EXPORT_FORMATS.
+
+    Returns:
+        iterator: Chunks of the file (str for CSV, bytes otherwise), to pass to a StreamingResponse.
+    """
+    writers = {"csv": iter_csv, "parquet": iter_parquet, "arrow": iter_arrow, "xlsx": iter_xlsx}
+    return writers[export_format](leads)
@@ -0,0 +1,401 @@
+# Persistent store of every lead we've paid Google for, with a spatial index so nearby leads can be found locally.
+#
+# Each Nearby Search that wasn't saturated is also recorded as a coverage circle: we know every matching place in it.
+# A later search of a circle inside fresh coverage is answered from the store instead of calling Google, with only the
+# leads the most recent covering search returned (a place that closed since stops being served once its area is searched again).
+
+import json
+import math
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from geo_utils import METERS_PER_DEGREE_LAT, haversine_m
+from settings import get_config
+
+LEAD_STORE_DB = "lead_store.sqlite3"
+# Used if the api_limit_config.json file doesn't have a LEAD_STORE section
+DEFAULT_COVERAGE_MAX_AGE_DAYS = 30
+DEFAULT_TEXT_SEARCH_MAX_AGE_DAYS = 7
+# Allowed slack (meters) when checking that a coverage circle contains a search circle, for floating point noise
+COVERAGE_TOLERANCE_M = 1.0
+# Rows read per query by the iter_ functions. They run a new query per chunk instead of keeping a cursor open,
+# because a streaming response can resume a generator on a different thread (and each thread has its own connection).
+ITER_CHUNK_ROWS = 500
+
+_local = threading.local()
+# Whether this SQLite was built with the R-tree module (set when the first connection is opened)
+_has_rtree = None
+
+
+def _create_index_table(conn: sqlite3.Connection, name: str):
+    """
+    A table of bounding boxes: an R-tree if SQLite has the module, otherwise a plain table with a B-tree index.
+    Both have the same columns, so the same queries work on either.
+    """
+    global _has_rtree
+    if _has_rtree is not False:
+        try:
+            conn.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {name} USING rtree(id, min_lat, max_lat, min_lng, max_lng)")
+            _has_rtree = True
+            return
+        except sqlite3.OperationalError:
+            _has_rtree = False
+    conn.execute(f"CREATE TABLE IF NOT EXISTS {name} (id INTEGER PRIMARY KEY, min_lat REAL, max_lat REAL, min_lng REAL, max_lng REAL)")
+    conn.execute(f"CREATE INDEX IF NOT EXISTS {name}_by_lat ON {name} (min_lat, max_lat)")
+
+
+def _get_connection(db_path: str = LEAD_STORE_DB) -> sqlite3.Connection:
+    """Get this thread's connection to the lead store, creating the tables the first time (same setup as usage_store.py)."""
+    connections = getattr(_local, "connections", None)
+    if connections is None:
+        connections = _local.connections = {}
+    conn = connections.get(db_path)
+    if conn is None:
+        conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=30000")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS leads (
+                lead_id INTEGER PRIMARY KEY,
+                goog_places_id TEXT NOT NULL UNIQUE,
+                name TEXT,
+                address TEXT,
+                goog_rating REAL,
+                phone TEXT,
+                website TEXT,
+                lat REAL NOT NULL,
+                lng REAL NOT NULL,
+                types_json TEXT NOT NULL,
+                first_seen TEXT NOT NULL,
+                last_seen TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS coverage (
+                coverage_id INTEGER PRIMARY KEY,
+                lat REAL NOT NULL,
+                lng REAL NOT NULL,
+                radius REAL NOT NULL,
+                types_json TEXT NOT NULL,
+                searched_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS text_search_coverage (
+                text_query TEXT PRIMARY KEY,
+                place_ids_json TEXT NOT NULL,
+                searched_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS search_runs (
+                search_id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                params_json TEXT NOT NULL,
+                num_results INTEGER NOT NULL,
+                created_at TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS search_run_leads (
+                search_id TEXT NOT NULL,
+                goog_places_id TEXT NOT NULL,
+                extra_json TEXT NOT NULL,
+                PRIMARY KEY (search_id, goog_places_id)
+            );
+        """)
+        _create_index_table(conn, "lead_index")
+        _create_index_table(conn, "coverage_index")
+        connections[db_path] = conn
+    return conn
+
+
+def _read_config() -> dict:
+    return get_config().get("LEAD_STORE", {})
+
+
+def _bounding_box(lat: float, lng: float, radius: float) -> tuple[float, float, float, float]:
+    """(min_lat, max_lat, min_lng, max_lng) of a circle."""
+    d_lat = radius / METERS_PER_DEGREE_LAT
+    d_lng = radius / (METERS_PER_DEGREE_LAT * max(math.cos(math.radians(lat)), 1e-6))
+    return lat - d_lat, lat + d_lat, lng - d_lng, lng + d_lng
+
+
+def _now() -> str:
+    return datetime.now().isoformat(timespec="seconds")
+
+
+def record_places(places: list[dict]):
+    """
+    Save raw Google places (Nearby Search or Text Search), updating the fields and last seen time of ones we already have.
+    """
+    if not places:
+        return
+    conn = _get_connection()
+    now = _now()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for place in places:
+            lat, lng = place["location"]["latitude"], place["location"]["longitude"]
+            row = conn.execute("""
+                INSERT INTO leads (goog_places_id, name, address, goog_rating, phone, website, lat, lng, types_json, first_seen, last_seen)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(goog_places_id) DO UPDATE SET
+                    name = excluded.name, address = excluded.address, goog_rating = excluded.goog_rating,
+                    phone = excluded.phone, website = excluded.website, lat = excluded.lat, lng = excluded.lng,
+                    types_json = CASE WHEN excluded.types_json = '[]' THEN leads.types_json ELSE excluded.types_json END,
+                    last_seen = excluded.last_seen
+                RETURNING lead_id""", (
+                place["id"], place.get("displayName", {}).get("text"), place.get("formattedAddress"), place.get("rating"),
+                place.get("nationalPhoneNumber"), place.get("websiteUri"), lat, lng, json.dumps(place.get("types", [])), now, now
+            )).fetchone()
+            conn.execute("INSERT OR REPLACE INTO lead_index VALUES (?, ?, ?, ?, ?)", (row[0], lat, lat, lng, lng))
+        conn.execute("COMMIT")
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+
+
+def record_coverage(center: tuple[float, float], radius: float, included_types: list[str], searched_at: float | None = None):
+    """
+    Record that a search found every place of included_types within radius of center (i.e. it wasn't saturated).
+
+    searched_at (a time.time(), now by default) must be from before the search's places were recorded (see record_places),
+    as only leads seen since then are served from this coverage (see places_within).
+    """
+    conn = _get_connection()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        coverage_id = conn.execute("INSERT INTO coverage (lat, lng, radius, types_json, searched_at) VALUES (?, ?, ?, ?, ?)",
+                                   (center[0], center[1], radius, json.dumps(sorted(included_types)),
+                                    time.time() if searched_at is None else searched_at)).lastrowid
+        conn.execute("INSERT INTO coverage_index VALUES (?, ?, ?, ?, ?)", (coverage_id, *_bounding_box(center[0], center[1], radius)))
+        conn.execute("COMMIT")
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+
+
+def is_covered(center: tuple[float, float], radius: float, included_types: list[str], max_age_days: float | None = None) -> bool:
+    """
+    Whether fresh coverage already contains this circle for these types, so the store has every place a search would find.
+
+    Coverage counts if it is younger than max_age_days (LEAD_STORE.COVERAGE_MAX_AGE_DAYS by default), was searched
+    for at least these types, and its circle contains this one.
+    """
+    return covering_search_time(center, radius, included_types, max_age_days) is not None
+
+
+def covering_search_time(center: tuple[float, float], radius: float, included_types: list[str],
+                         max_age_days: float | None = None) -> float | None:
+    """When the most recent fresh coverage containing this circle was searched (see is_covered), or None if there isn't any."""
+    if max_age_days is None:
+        max_age_days = _read_config().get("COVERAGE_MAX_AGE_DAYS", DEFAULT_COVERAGE_MAX_AGE_DAYS)
+    min_lat, max_lat, min_lng, max_lng = _bounding_box(center[0], center[1], radius)
+    wanted_types = set(included_types)
+    rows = _get_connection().execute("""
+        SELECT coverage.lat, coverage.lng, coverage.radius, coverage.types_json, coverage.searched_at
+        FROM coverage_index JOIN coverage ON coverage.coverage_id = coverage_index.id
+        WHERE coverage_index.min_lat <= ? AND coverage_index.max_lat >= ? AND coverage_index.min_lng <= ? AND coverage_index.max_lng >= ?
+          AND coverage.searched_at >= ?""",
+        (min_lat, max_lat, min_lng, max_lng, time.time() - max_age_days * 86400)).fetchall()
+    searched_at = None
+    for lat, lng, coverage_radius, types_json, coverage_searched_at in rows:
+        if (wanted_types <= set(json.loads(types_json))
+                and haversine_m(lat, lng, center[0], center[1]) + radius <= coverage_radius + COVERAGE_TOLERANCE_M):
+            searched_at = max(searched_at or 0.0, coverage_searched_at)
+    return searched_at
+
+
+def _lead_from_row(row) -> dict:
+    lead_id, goog_places_id, name, address, goog_rating, phone, website, lat, lng, types_json, first_seen, last_seen = row
+    return {
+        "name": name,
+        "address": address,
+        "goog_rating": goog_rating,
+        "phone": phone,
+        "website": website,
+        "lat": lat,
+        "lng": lng,
+        "goog_places_id": goog_places_id,
+        "types": json.loads(types_json),
+        "first_seen": first_seen,
+        "last_seen": last_seen
+    }
+
+
+def iter_leads(included_types: list[str] | None = None, bbox: tuple[float, float, float, float] | None = None):
+    """
+    Stored leads one at a time, in the order they were first found, without loading them all.
+
+    Args:
+        included_types (list[str] | None): Only leads with at least one of these types.
+        bbox (tuple | None): Only leads inside (min_lat, min_lng, max_lat, max_lng).
+    """
+    wanted_types = set(included_types or [])
+    if bbox is None:
+        query = "SELECT leads.* FROM leads WHERE leads.lead_id > ? ORDER BY leads.lead_id LIMIT ?"
+        bbox_params = ()
+    else:
+        min_lat, min_lng, max_lat, max_lng = bbox
+        query = """
+            SELECT leads.* FROM lead_index JOIN leads ON leads.lead_id = lead_index.id
+            WHERE lead_index.min_lat >= ? AND lead_index.max_lat <= ? AND lead_index.min_lng >= ? AND lead_index.max_lng <= ?
+            AND leads.lead_id > ? ORDER BY leads.lead_id LIMIT ?"""
+        bbox_params = (min_lat, max_lat, min_lng, max_lng)
+
+    last_lead_id = 0
+    while True:
+        rows = _get_connection().execute(query, (*bbox_params, last_lead_id, ITER_CHUNK_ROWS)).fetchall()
+        for row in rows:
+            lead = _lead_from_row(row)
+            if not wanted_types or wanted_types & set(lead["types"]):
+                yield lead
+        if len(rows) < ITER_CHUNK_ROWS:
+            return
+        last_lead_id = rows[-1][0]
+
+
+def leads_in_bbox(min_lat: float, min_lng: float, max_lat: float, max_lng: float, included_types: list[str] | None = None) -> list[dict]:
+    """Every stored lead inside a bounding box, optionally only ones of the given types."""
+    return list(iter_leads(included_types, (min_lat, min_lng, max_lat, max_lng)))
+
+
+def leads_within(lat: float, lng: float, radius: float, included_types: list[str] | None = None) -> list[dict]:
+    """Every stored lead within radius meters of a point, nearest first, each with its "distance_m"."""
+    min_lat, max_lat, min_lng, max_lng = _bounding_box(lat, lng, radius)
+    leads = []
+    for lead in leads_in_bbox(min_lat, min_lng, max_lat, max_lng, included_types):
+        distance = haversine_m(lat, lng, lead["lat"], lead["lng"])
+        if distance <= radius:
+            leads.append({**lead, "distance_m": round(distance, 1)})
+    leads.sort(key=lambda lead: lead["distance_m"])
+    return leads
+
+
+def places_within(center: tuple[float, float], radius: float, included_types: list[str], seen_since: float | None = None) -> list[dict]:
+    """
+    Stored leads around a point as raw Google places, so the search pipeline can use them like a Nearby Search response.
+
+    With seen_since (a time.time(), e.g. from covering_search_time), only leads a search returned since then. A lead the
+    covering search didn't return has closed or moved, and isn't served from the store any more.
+    """
+    # last_seen is stored to the second, like the time it's compared with
+    min_last_seen = None if seen_since is None else datetime.fromtimestamp(seen_since).isoformat(timespec="seconds")
+    places = []
+    for lead in leads_within(center[0], center[1], radius, included_types):
+        if min_last_seen is not None and lead["last_seen"] < min_last_seen:
+            continue
+        place = {
+            "id": lead["goog_places_id"],
+            "displayName": {"text": lead["name"]},
+            "formattedAddress": lead["address"],
+            "location": {"latitude": lead["lat"], "longitude": lead["lng"]},
+            "types": lead["types"]
+        }
+        for key, field in (("rating", "goog_rating"), ("nationalPhoneNumber", "phone"), ("websiteUri", "website")):
+            if lead[field] is not None:
+                place[key] = lead[field]
+        places.append(place)
+    return places
+
+
+def record_text_search(text_query: str, places: list[dict]):
+    """Save the places a Text Search returned (in order), so the same query can be answered from the store."""
+    record_places(places)
+    _get_connection().execute("INSERT OR REPLACE INTO text_search_coverage VALUES (?, ?, ?)",
+                              (text_query, json.dumps([place["id"] for place in places]), time.time()))
+
+
+def get_text_search_leads(text_query: str, max_age_days: float | None = None) -> list[dict] | None:
+    """The leads a recent identical Text Search returned, in the same order, or None if there isn't a fresh one."""
+    if max_age_days is None:
+        max_age_days = _read_config().get("TEXT_SEARCH_MAX_AGE_DAYS", DEFAULT_TEXT_SEARCH_MAX_AGE_DAYS)
+    conn = _get_connection()
+    row = conn.execute("SELECT place_ids_json FROM text_search_coverage WHERE text_query = ? AND searched_at >= ?",
+                       (text_query, time.time() - max_age_days * 86400)).fetchone()
+    if row is None:
+        return None
+    place_ids = json.loads(row[0])
+    leads = get_leads(place_ids)
+    if len(leads) < len(place_ids):
+        return None
+    return [leads[place_id] for place_id in place_ids]
+
+
+def get_leads(place_ids: list[str]) -> dict[str, dict]:
+    """The stored leads with these place ids, as place id -> lead (ids we don't have are left out)."""
+    leads = {}
+    for chunk_start in range(0, len(place_ids), ITER_CHUNK_ROWS):
+        chunk = place_ids[chunk_start:chunk_start + ITER_CHUNK_ROWS]
+        for lead_row in _get_connection().execute(f"SELECT * FROM leads WHERE goog_places_id IN ({','.join('?' * len(chunk))})", chunk):
+            lead = _lead_from_row(lead_row)
+            leads[lead["goog_places_id"]] = lead
+    return leads
+
+
+def record_search_run(kind: str, params: dict, lead_extras: dict[str, dict]) -> str:
+    """
+    Save which leads a search returned, so its results can be fetched (or exported) later.
+
+    Args:
+        kind (str): "zipcode", "region" or "region_batch".
+        params (dict): What was searched for.
+        lead_extras (dict): goog_places_id -> the fields the search added to the lead, e.g. {"zip_codes_nearby": [...]}.
+
+    Returns:
+        str: The new search_id.
+    """
+    search_id = uuid.uuid4().hex
+    conn = _get_connection()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("INSERT INTO search_runs VALUES (?, ?, ?, ?, ?)", (search_id, kind, json.dumps(params), len(lead_extras), _now()))
+        conn.executemany("INSERT INTO search_run_leads VALUES (?, ?, ?)",
+                         [(search_id, place_id, json.dumps(extra)) for place_id, extra in lead_extras.items()])
+        conn.execute("COMMIT")
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    return search_id
+
+
+def iter_search_run_leads(search_id: str):
+    """The leads of a search run, one at a time (with the fields the search added), in the order they were stored."""
+    last_rowid = 0
+    while True:
+        rows = _get_connection().execute("""
+            SELECT search_run_leads.rowid, leads.*, search_run_leads.extra_json FROM search_run_leads
+            JOIN leads ON leads.goog_places_id = search_run_leads.goog_places_id
+            WHERE search_run_leads.search_id = ? AND search_run_leads.rowid > ?
+            ORDER BY search_run_leads.rowid LIMIT ?""", (search_id, last_rowid, ITER_CHUNK_ROWS)).fetchall()
+        for row in rows:
+            yield {**_lead_from_row(row[1:-1]), **json.loads(row[-1])}
+        if len(rows) < ITER_CHUNK_ROWS:
+            return
+        last_rowid = rows[-1][0]
+
+
+def get_search_run(search_id: str, include_results: bool = True) -> dict:
+    row = _get_connection().execute("SELECT kind, params_json, num_results, created_at FROM search_runs WHERE search_id = ?", (search_id,)).fetchone()
+    if row is None:
+        return {"error": f"No search run with id {search_id}"}
+    run = {"search_id": search_id, "kind": row[0], "params": json.loads(row[1]), "num_results": row[2], "created_at": row[3]}
+    if include_results:
+        run["results"] = list(iter_search_run_leads(search_id))
+    return run
+
+
+def list_search_runs(limit: int = 50) -> list[dict]:
+    rows = _get_connection().execute("SELECT search_id FROM search_runs ORDER BY created_at DESC, rowid DESC LIMIT ?", (limit,)).fetchall()
+    return [get_search_run(search_id, include_results=False) for (search_id,) in rows]
+
+
+def get_lead_store_stats() -> dict:
+    conn = _get_connection()
+    return {
+        "leads": conn.execute("SELECT COUNT(*) FROM leads").fetchone()[0],
+        "coverage_circles": conn.execute("SELECT COUNT(*) FROM coverage").fetchone()[0],
+        "text_searches": conn.execute("SELECT COUNT(*) FROM text_search_coverage").fetchone()[0],
+        "search_runs": conn.execute("SELECT COUNT(*) FROM search_runs").fetchone()[0],
+        "spatial_index": "rtree" if _has_rtree else "btree"
+    }
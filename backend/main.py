@@ -2,29 +2,72 @@
 #### IMPORTS ####
 ################################################################################
 # FastApi Imports
-from fastapi import FastAPI
+from fastapi import FastAPI, Header, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from pydantic import BaseModel
 
 # Python Imports
-import os
+import asyncio
+import sys
 import time
-import json
-from datetime import datetime
-from dotenv import load_dotenv
+from contextlib import asynccontextmanager
+from datetime import date
 
 # Local Imports 
-from carwash_regional import get_all_car_washes
-from carwash_zipcode import generate_carwashes_by_zipcode
+# The search modules (carwash_regional, carwash_zipcode, search_jobs, http_client) are imported after startup, see start_search_backend
+from settings import get_config, get_google_api_key
 from utils import increment_app_search_counts
 from retrieve_analytics import retrieve_analytics_data
-from endpoint_schemas import SearchTextQueryRequest, SearchZipCodesRequest
+from usage_history import get_usage_history, get_cost_projection, DEFAULT_PROJECTION_DAYS
+from search_cache import get_cache_stats
+from coverage_planner import dry_run_zipcode_search
+from zip_radius import plan_zip_radii
+from territory import expand_territory
+from geocode_cache import get_cached_location
+from lead_store import leads_within, leads_in_bbox, iter_leads, iter_search_run_leads, get_lead_store_stats, get_search_run, list_search_runs
+from lead_export import EXPORT_FORMATS, check_export_format, export_leads
+from lead_dedup import dedupe_leads
+from metrics import observe, timed, start_trace, server_timing_header, instrument_stream, render_prometheus
+from endpoint_schemas import SearchTextQueryRequest, SearchTextQueryBatchRequest, SearchZipCodesRequest, SearchZipCodesJobRequest, TerritoryRequest
 
 ################################################################################
 #### SETUP ####
 ################################################################################
-app = FastAPI()
+def import_search_modules():
+    import carwash_regional, carwash_zipcode, search_jobs, http_client  # noqa: F401
+
+async def start_search_backend(app: FastAPI):
+    # httpx and the search modules are the slowest part of importing the app after fastapi itself, so they're imported
+    # in a thread once the app is up, and it can answer everything that doesn't search (and health checks) right away
+    await asyncio.to_thread(import_search_modules)
+    from http_client import open_shared_client
+    from search_jobs import start_job_workers
+    # One pooled HTTP client for every call to Google, so connections are reused across requests
+    app.state.google_client = open_shared_client()
+    # Background workers for zip code search jobs (this also re-queues jobs that were interrupted by a restart)
+    start_job_workers(app.state.google_client, GOOGLE_API_KEY)
+
+async def wait_for_search_backend():
+    """Wait until the search modules are imported, the Google client is open and the job workers are running."""
+    await asyncio.shield(app.state.search_backend)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Fail on a broken api_limit_config.json now rather than on the first search
+    get_config()
+    app.state.search_backend = asyncio.create_task(start_search_backend(app))
+    yield
+    app.state.search_backend.cancel()
+    await asyncio.gather(app.state.search_backend, return_exceptions=True)
+    if "search_jobs" in sys.modules:
+        from search_jobs import stop_job_workers
+        from http_client import close_shared_client
+        await stop_job_workers()
+        # Close the pooled HTTP client we use for Google
+        await close_shared_client()
+
+app = FastAPI(lifespan=lifespan)
 
 # Define allowed origins
 allowed_origins = [
@@ -43,38 +86,238 @@ app.add_middleware(
     allow_headers=["*"],  
 )
 
-# Load the api key from dotenv:
-load_dotenv()
-GOOGLE_API_KEY = os.getenv('GOOGLE_MAPS_API_KEY')
-if not GOOGLE_API_KEY:
-    raise ValueError("No API key found. Please set the GOOGLE_MAPS_API_KEY environment variable in the .env file.")
+@app.middleware("http")
+async def time_requests(request: Request, call_next):
+    """Time every request, and trace its stages if it asks for it with an X-Trace: 1 header (or ?trace=1)."""
+    trace = None
+    if request.headers.get("X-Trace") == "1" or request.query_params.get("trace") == "1":
+        trace = start_trace()
+    start_time = time.perf_counter()
+    response = await call_next(request)
+    # Label by the route's path template (e.g. /jobs/{job_id}), not the raw path, so there's one series per endpoint
+    route = request.scope.get("route")
+    observe("http_request_seconds", time.perf_counter() - start_time, route=route.path if route else "unmatched", status=str(response.status_code))
+    # A streamed response ends with a "trace" message instead (see metrics.instrument_stream), it's still running here
+    if trace is not None and response.headers.get("content-type", "").startswith("application/json"):
+        response.headers["Server-Timing"] = server_timing_header(trace)
+    return response
+
+# Load the api key from the environment (or the .env file)
+GOOGLE_API_KEY = get_google_api_key()
 
 ################################################################################
 #### MAIN TWO ENDPOINTS ####
 ################################################################################
 @app.post("/search_carwashes_regions")
-def search_carwashes(request: SearchTextQueryRequest):
+async def search_carwashes(request: SearchTextQueryRequest):
     """Get a list of car washes in a region"""
     start_time = time.time()
+    await wait_for_search_backend()
+    from carwash_regional import get_all_car_washes, record_regional_search
     # Increment the regional total
     increment_app_search_counts("regional_total")
     # Call the primary function
-    car_washes_result = get_all_car_washes(GOOGLE_API_KEY, request.region, request.query)
+    car_washes_result = await get_all_car_washes(GOOGLE_API_KEY, request.region, request.query, request.use_cache, app.state.google_client)
     if "error" in car_washes_result:
         # Return or handle the error message as needed for the frontend
         return car_washes_result
     else: 
         num_results = len(car_washes_result)
         total_time = round((time.time() - start_time), 2)
-        return {'results': car_washes_result, 'num_results': num_results, 'exc_time': total_time}
+        search_id = record_regional_search(request.query, request.region, car_washes_result)
+        return {'search_id': search_id, 'results': car_washes_result, 'num_results': num_results, 'exc_time': total_time}
+
+@app.post("/search_carwashes_regions/stream")
+async def stream_carwashes_regions(request: SearchTextQueryRequest):
+    """Same as /search_carwashes_regions, but streams each page of results as soon as it arrives."""
+    increment_app_search_counts("regional_total")
+    await wait_for_search_backend()
+    from carwash_regional import generate_car_washes_by_region
+    search = generate_car_washes_by_region(GOOGLE_API_KEY, request.region, request.query, request.use_cache, app.state.google_client)
+    return StreamingResponse(instrument_stream(search, "/search_carwashes_regions/stream"), media_type="text/event-stream")
+
+@app.post("/search_carwashes_regions/batch")
+async def search_carwashes_regions_batch(request: SearchTextQueryBatchRequest):
+    """Run many (query, region) searches at once and return one lead set, deduplicated across the whole batch."""
+    searches = [(search.query, search.region) for search in request.searches]
+    searches += [(query, region) for query in request.queries for region in request.regions]
+    if not searches:
+        return {"error": "No searches given. Send (query, region) pairs in searches, or lists of queries and regions."}
+    for _ in searches:
+        increment_app_search_counts("regional_total")
+    await wait_for_search_backend()
+    from carwash_regional import search_car_washes_batch
+    return await search_car_washes_batch(GOOGLE_API_KEY, searches, request.use_cache, app.state.google_client)
     
 
 @app.post("/search_carwashes_zipcodes")
 async def search_carwashes(request: SearchZipCodesRequest):
     """Take a list of zip codes and return a robust list of car washes for each zip code."""
     increment_app_search_counts("zip_code_total")
+    await wait_for_search_backend()
+    from carwash_zipcode import generate_carwashes_by_zipcode
     # This endpoint is basically a generator that returns a yield of data to the frontend through a streaming response
-    return StreamingResponse(generate_carwashes_by_zipcode(GOOGLE_API_KEY, request.zip_codes, request.included_types, request.radius), media_type="text/event-stream")
+    search = generate_carwashes_by_zipcode(GOOGLE_API_KEY, request.zip_codes, request.included_types, request.radius, request.use_cache, request.adaptive_tiling, request.plan_coverage, request.stream_mode, app.state.google_client, request.auto_radius,
+                                           request.states, request.counties, [area.model_dump() for area in request.within])
+    return StreamingResponse(instrument_stream(search, "/search_carwashes_zipcodes"), media_type="text/event-stream")
+
+@app.post("/search_carwashes_zipcodes/plan")
+def plan_search_carwashes(request: SearchZipCodesRequest):
+    """Dry run: how many Nearby Search calls a zip code search would make with and without coverage planning. Makes no API calls."""
+    zip_codes = expand_territory(request.zip_codes, request.states, request.counties, [area.model_dump() for area in request.within])["zip_codes"]
+    return dry_run_zipcode_search(zip_codes, request.radius)
+
+@app.post("/search_carwashes_zipcodes/radii")
+def preview_zip_code_radii(request: SearchZipCodesRequest):
+    """The radius auto_radius would pick for each zip code, and where it came from. Makes no API calls."""
+    zip_codes = expand_territory(request.zip_codes, request.states, request.counties, [area.model_dump() for area in request.within])["zip_codes"]
+    included_types = [request.included_types] if isinstance(request.included_types, str) else request.included_types
+    return plan_zip_radii(zip_codes, included_types, request.radius, get_config().get("AUTO_RADIUS", {}))
+
+@app.post("/territories/expand")
+def expand_search_territory(request: TerritoryRequest):
+    """The validated zip codes a territory (zip codes, states, counties, areas) would search, and what was dropped. Makes no API calls."""
+    return expand_territory(request.zip_codes, request.states, request.counties, [area.model_dump() for area in request.within])
+
+################################################################################
+#### BACKGROUND JOBS for big zip code searches (they keep running if the browser disconnects)
+################################################################################
+@app.post("/jobs/search_carwashes_zipcodes")
+async def submit_zipcode_search_job(request: SearchZipCodesJobRequest):
+    """Queue a zip code search as a background job. Returns the job's status, including its job_id."""
+    territory = expand_territory(request.zip_codes, request.states, request.counties, [area.model_dump() for area in request.within])
+    if territory["errors"] or not territory["zip_codes"]:
+        return {"error": "; ".join(territory["errors"]) or "None of the zip codes are valid", "invalid_zip_codes": territory["invalid_zip_codes"]}
+    increment_app_search_counts("zip_code_total")
+    included_types = [request.included_types] if isinstance(request.included_types, str) else request.included_types
+    await wait_for_search_backend()
+    from search_jobs import submit_job
+    status = await submit_job(request.rep, territory["zip_codes"], included_types, request.radius, request.use_cache, request.adaptive_tiling, request.auto_radius)
+    return {**status, "invalid_zip_codes": territory["invalid_zip_codes"], "duplicates_removed": territory["duplicates_removed"]}
+
+@app.get("/jobs")
+def get_jobs(rep: str | None = None):
+    """The most recent jobs, optionally only one rep's"""
+    from search_jobs import list_jobs
+    return list_jobs(rep)
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    """A job's status and progress"""
+    from search_jobs import get_job_status
+    return get_job_status(job_id)
+
+@app.get("/jobs/{job_id}/events")
+async def get_job_events(job_id: str, last_event_id: int = 0, last_event_id_header: str | None = Header(None, alias="Last-Event-ID")):
+    """Stream a job's events (server-sent events). Reconnect with Last-Event-ID (or ?last_event_id=) to pick up where you left off."""
+    if last_event_id_header and last_event_id_header.isdigit():
+        last_event_id = int(last_event_id_header)
+    await wait_for_search_backend()
+    from search_jobs import stream_job_events
+    return StreamingResponse(stream_job_events(job_id, last_event_id), media_type="text/event-stream")
+
+@app.get("/jobs/{job_id}/results")
+def get_job_leads(job_id: str):
+    """Every lead a job has found so far, deduplicated"""
+    from search_jobs import get_job_results
+    return get_job_results(job_id)
+
+@app.post("/jobs/{job_id}/resume")
+async def resume_search_job(job_id: str):
+    """Re-queue a stopped or failed job, skipping the zip codes it already finished"""
+    await wait_for_search_backend()
+    from search_jobs import resume_job
+    return await resume_job(job_id)
+
+################################################################################
+#### LEAD STORE: every lead we've found, and every search we've run
+################################################################################
+def split_types(types: str | None) -> list[str] | None:
+    """Place types from a comma separated query parameter (e.g. ?types=car_wash,gas_station)"""
+    if not types:
+        return None
+    return [place_type.strip() for place_type in types.split(",") if place_type.strip()]
+
+@app.get("/leads/nearby")
+def get_leads_nearby(lat: float | None = None, lng: float | None = None, zip_code: str | None = None, radius: float = 5000, types: str | None = None):
+    """Stored leads within radius meters of a point (or of a zip code we've geocoded before), nearest first. Makes no API calls."""
+    if zip_code is not None:
+        location = get_cached_location(zip_code)
+        if location is None:
+            return {"error": f"Zip code {zip_code} hasn't been searched yet, so we don't know where it is. Send lat and lng instead."}
+        lat, lng = location["lat"], location["lng"]
+    if lat is None or lng is None:
+        return {"error": "Send lat and lng, or a zip_code."}
+    leads = leads_within(lat, lng, radius, split_types(types))
+    return {"results": leads, "num_results": len(leads)}
+
+@app.get("/leads/bbox")
+def get_leads_in_bbox(min_lat: float, min_lng: float, max_lat: float, max_lng: float, types: str | None = None):
+    """Stored leads inside a bounding box (e.g. the visible part of the map). Makes no API calls."""
+    leads = leads_in_bbox(min_lat, min_lng, max_lat, max_lng, split_types(types))
+    return {"results": leads, "num_results": len(leads)}
+
+@app.get("/leads/stats")
+def lead_store_stats():
+    """How many leads, covered areas and search runs are stored"""
+    return get_lead_store_stats()
+
+@app.get("/search_runs")
+def get_search_runs(limit: int = 50):
+    """The most recent search runs (without their results)"""
+    return list_search_runs(limit)
+
+@app.get("/search_runs/{search_id}")
+def get_search_run_results(search_id: str):
+    """A past search run with its results, rebuilt from the lead store"""
+    return get_search_run(search_id)
+
+################################################################################
+#### EXPORTS: stream leads as a CSV / Parquet / Arrow / Excel download (?format=csv, parquet, arrow or xlsx)
+################################################################################
+def export_response(leads, export_format: str, file_name: str, dedupe: bool = False):
+    """
+    A streamed download of leads, or an error if the format isn't available.
+    With dedupe, leads that are the same business under different place ids are merged first (see lead_dedup.py),
+    which means reading every lead into memory rather than streaming them straight from the database.
+    """
+    error = check_export_format(export_format)
+    if error:
+        return {"error": error}
+    if dedupe:
+        with timed("dedup"):
+            leads = dedupe_leads(leads)
+    media_type, extension, _ = EXPORT_FORMATS[export_format]
+    return StreamingResponse(export_leads(leads, export_format), media_type=media_type,
+                             headers={"Content-Disposition": f'attachment; filename="{file_name}.{extension}"'})
+
+@app.get("/export/search_runs/{search_id}")
+def export_search_run(search_id: str, format: str = "csv", dedupe: bool = False):
+    """Download the leads of a past search (the search_id from its response or summary)"""
+    run = get_search_run(search_id, include_results=False)
+    if "error" in run:
+        return run
+    return export_response(iter_search_run_leads(search_id), format, f"leads-{run['kind']}-{search_id[:8]}", dedupe)
+
+@app.get("/export/jobs/{job_id}")
+def export_job(job_id: str, format: str = "csv", dedupe: bool = False):
+    """Download every lead a background job has found so far"""
+    from search_jobs import get_job_status, iter_job_leads
+    status = get_job_status(job_id)
+    if "job_id" not in status:
+        return status
+    return export_response(iter_job_leads(job_id), format, f"leads-job-{job_id[:8]}", dedupe)
+
+@app.get("/export/leads")
+def export_stored_leads(format: str = "csv", types: str | None = None, min_lat: float | None = None, min_lng: float | None = None,
+                        max_lat: float | None = None, max_lng: float | None = None, dedupe: bool = False):
+    """Download stored leads: all of them, or only ones of some types (comma separated) and/or inside a bounding box"""
+    bbox = None
+    if None not in (min_lat, min_lng, max_lat, max_lng):
+        bbox = (min_lat, min_lng, max_lat, max_lng)
+    elif any(value is not None for value in (min_lat, min_lng, max_lat, max_lng)):
+        return {"error": "Send all of min_lat, min_lng, max_lat and max_lng for a bounding box, or none of them."}
+    return export_response(iter_leads(split_types(types), bbox), format, "leads", dedupe)
 
 ################################################################################
 #### ANALYTICS ENDPOINT for Analytics Dashboard, and Utility Endpoint to check Current API Call Limits
@@ -86,12 +329,36 @@ def api_analytics():
     # Filter the data for the current date
     return analytics_data
 
+@app.get("/api_analytics/history")
+def api_analytics_history(first_day: date | None = None, last_day: date | None = None):
+    """Daily API calls, searches and cost between two days (YYYY-MM-DD, defaults to the last 30 days), with totals and calls per search"""
+    return get_usage_history(first_day, last_day)
+
+@app.get("/api_analytics/projection")
+def api_analytics_projection(days: int = DEFAULT_PROJECTION_DAYS):
+    """This month's projected calls and cost at the pace of the last `days` days, and when each monthly limit would run out"""
+    return get_cost_projection(days)
+
+@app.get("/api_analytics/result_cache")
+def result_cache_analytics():
+    """Get hit/miss counters for the Nearby Search and Text Search result cache"""
+    return get_cache_stats()
+
+@app.get("/api_analytics/http_client")
+def http_client_analytics():
+    """Get call latency, retry and error counts for each Google endpoint we call"""
+    from http_client import get_latency_stats
+    return get_latency_stats()
+
+@app.get("/metrics")
+def metrics():
+    """Stage timings, Google calls by endpoint and outcome, errors and stream timings, in the Prometheus text format"""
+    return PlainTextResponse(render_prometheus(), media_type="text/plain; version=0.0.4")
+
 @app.get("/check_api_call_limits")
 def check_api_call_limits():
     """Check the current API self imposed call limit for all endpoints used in this app"""
-    # Read in the api_limit_config.json file
-    with open('api_limit_config.json', 'r') as file:
-        api_limits = json.load(file)
-    return api_limits
+    # The validated api_limit_config.json, read again only when the file changes
+    return get_config()
 
 ################################################################################
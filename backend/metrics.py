@@ -0,0 +1,181 @@
+# In-process metrics: how long each stage of a search takes, how many calls we make to each Google endpoint, and what fails.
+#
+# The only timing we had was exc_time on the responses. Stages are timed with `with timed("geocode"):` blocks in the
+# search code, and everything is served by the /metrics endpoint in the Prometheus text format.
+# A request sent with an X-Trace: 1 header (or ?trace=1) also gets its own per stage breakdown (see start_trace).
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+METRIC_PREFIX = "carwash_"
+# Histogram buckets in seconds, from a SQLite read to a slow Google call with retries
+BUCKETS_SECONDS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+# Metric name -> (type, help text) for the /metrics output
+METRICS = {
+    "stage_seconds": ("histogram", "Time spent in each stage of a search"),
+    "google_request_seconds": ("histogram", "Latency of each request to a Google endpoint, retries included as separate requests"),
+    "google_requests_total": ("counter", "Requests to each Google endpoint by outcome (ok, retry or error)"),
+    "errors_total": ("counter", "Errors by where they happened and their type"),
+    "quota_refusals_total": ("counter", "Calls or searches refused because an api call limit was reached"),
+    "http_request_seconds": ("histogram", "Time to answer each request to our app (for streams, until the response starts)"),
+    "stream_first_byte_seconds": ("histogram", "Time from the start of a streamed response to its first message"),
+    "stream_seconds": ("histogram", "Time from the start of a streamed response to its last message"),
+    "stream_bytes_total": ("counter", "Bytes sent in streamed responses")
+}
+
+_lock = threading.Lock()
+_histograms = {}  # (name, labels) -> {"buckets": [count per bucket, then +Inf], "sum": ..., "count": ..., "min": ..., "max": ...}
+_counters = {}    # (name, labels) -> value
+# The trace of the request being handled, if it asked for one: stage -> {"count", "total_ms"}
+_request_trace = ContextVar("request_trace", default=None)
+
+
+def _key(name: str, labels: dict) -> tuple:
+    return name, tuple(sorted(labels.items()))
+
+
+def observe(name: str, seconds: float, **labels):
+    """Add a duration to a histogram (name is a key of METRICS, labels e.g. stage="geocode")."""
+    with _lock:
+        histogram = _histograms.get(_key(name, labels))
+        if histogram is None:
+            histogram = _histograms[_key(name, labels)] = {"buckets": [0] * (len(BUCKETS_SECONDS) + 1), "sum": 0.0, "count": 0,
+                                                           "min": seconds, "max": seconds}
+        bucket = next((i for i, upper in enumerate(BUCKETS_SECONDS) if seconds <= upper), len(BUCKETS_SECONDS))
+        histogram["buckets"][bucket] += 1
+        histogram["sum"] += seconds
+        histogram["count"] += 1
+        histogram["min"] = min(histogram["min"], seconds)
+        histogram["max"] = max(histogram["max"], seconds)
+
+
+def increment(name: str, amount: float = 1, **labels):
+    """Add to a counter (name is a key of METRICS)."""
+    with _lock:
+        key = _key(name, labels)
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def record_error(where: str, error_type: str):
+    """Count an error, e.g. record_error("nearby_search", "http_500")."""
+    increment("errors_total", where=where, type=error_type)
+
+
+@contextmanager
+def timed(stage: str):
+    """Time a block as one stage of a search, and add it to the request's trace if it has one."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        observe("stage_seconds", elapsed, stage=stage)
+        trace = _request_trace.get()
+        if trace is not None:
+            stage_trace = trace.setdefault(stage, {"count": 0, "total_ms": 0.0})
+            stage_trace["count"] += 1
+            stage_trace["total_ms"] += elapsed * 1000
+
+
+def start_trace() -> dict:
+    """
+    Start collecting a per stage trace for the current request. Returns the trace, which fills up as stages finish.
+
+    Tasks started afterwards (e.g. one per zip code) copy the trace with the rest of the context, so their stages are included.
+    """
+    trace = {}
+    _request_trace.set(trace)
+    return trace
+
+
+def current_trace() -> dict | None:
+    return _request_trace.get()
+
+
+def format_trace(trace: dict) -> dict:
+    """A trace as {stage: {"count", "total_ms"}}, rounded, slowest stage first."""
+    return {stage: {"count": stage_trace["count"], "total_ms": round(stage_trace["total_ms"], 2)}
+            for stage, stage_trace in sorted(trace.items(), key=lambda item: -item[1]["total_ms"])}
+
+
+def server_timing_header(trace: dict) -> str:
+    """A trace as a Server-Timing header, which browser dev tools show in the network tab."""
+    return ", ".join(f'{stage};dur={stage_trace["total_ms"]:.2f};desc="{stage_trace["count"]}x"'
+                     for stage, stage_trace in format_trace(trace).items())
+
+
+async def instrument_stream(generator, route: str):
+    """
+    Pass a streamed response through, timing its first message and the whole stream and counting the bytes sent.
+
+    If the request asked for a trace, a final {"type": "trace", "stages": ...} message is added to the stream.
+    """
+    start = time.perf_counter()
+    first_message = True
+    num_bytes = 0
+    try:
+        async for message in generator:
+            if first_message:
+                observe("stream_first_byte_seconds", time.perf_counter() - start, route=route)
+                first_message = False
+            num_bytes += len(message)
+            yield message
+        trace = current_trace()
+        if trace is not None:
+            yield json.dumps({"type": "trace", "stages": format_trace(trace)}) + "\n"
+    finally:
+        observe("stream_seconds", time.perf_counter() - start, route=route)
+        increment("stream_bytes_total", num_bytes, route=route)
+
+
+def histogram_stats(name: str) -> dict:
+    """Every histogram called name, as labels tuple -> copy of its stats."""
+    with _lock:
+        return {labels: {**histogram, "buckets": list(histogram["buckets"])}
+                for (histogram_name, labels), histogram in _histograms.items() if histogram_name == name}
+
+
+def counter_values(name: str) -> dict:
+    """Every counter called name, as labels tuple -> value."""
+    with _lock:
+        return {labels: value for (counter_name, labels), value in _counters.items() if counter_name == name}
+
+
+def _format_labels(labels: tuple, extra: tuple = ()) -> str:
+    labels = labels + extra
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{label}="{value}"' for (label, _), value in zip(labels, escaped)) + "}"
+
+
+def render_prometheus() -> str:
+    """Every metric in the Prometheus text exposition format."""
+    lines = []
+    for name, (metric_type, help_text) in METRICS.items():
+        full_name = METRIC_PREFIX + name
+        lines.append(f"# HELP {full_name} {help_text}")
+        lines.append(f"# TYPE {full_name} {metric_type}")
+        if metric_type == "counter":
+            for labels, value in sorted(counter_values(name).items()):
+                lines.append(f"{full_name}{_format_labels(labels)} {value}")
+            continue
+        for labels, histogram in sorted(histogram_stats(name).items()):
+            cumulative = 0
+            for upper, count in zip(BUCKETS_SECONDS + ["+Inf"], histogram["buckets"]):
+                cumulative += count
+                lines.append(f"{full_name}_bucket{_format_labels(labels, (('le', upper),))} {cumulative}")
+            lines.append(f"{full_name}_sum{_format_labels(labels)} {histogram['sum']:.6f}")
+            lines.append(f"{full_name}_count{_format_labels(labels)} {histogram['count']}")
+    return "\n".join(lines) + "\n"
+
+
+def reset_metrics():
+    """Forget everything recorded so far (for benchmarks)."""
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
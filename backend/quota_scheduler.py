@@ -0,0 +1,176 @@
+# Reserves the API calls a search is expected to make before it starts, and paces outgoing calls to stay under Google's QPS limits.
+#
+# Checking the limits one call at a time let a 50 zip code search burn 30 calls and then stop with "Limit exceeded",
+# wasting the quota on partial results. Instead, a search estimates its calls up front and reserves all of them at once
+# (or is refused before making any), then gives back whatever it didn't use.
+
+import asyncio
+import time
+from contextvars import ContextVar
+from datetime import datetime
+
+from metrics import timed, increment
+from usage_store import reserve_api_calls, refund_api_calls
+from shared_state import take_rate_limit_tokens
+from settings import get_config
+
+# Usage store endpoint name -> its key in API_LIMITS (and RATE_LIMITS) in api_limit_config.json
+API_LIMIT_KEYS = {
+    "nearby_search_calls": "NEARBY_SEARCH",
+    "text_search_calls": "TEXT_SEARCH",
+    "geocode_calls": "GEOCODE"
+}
+# http_client.request_with_retries label -> its key in RATE_LIMITS
+RATE_LIMIT_KEYS = {
+    "nearby_search": "NEARBY_SEARCH",
+    "text_search": "TEXT_SEARCH",
+    "geocode": "GEOCODE"
+}
+ENDPOINT_DISPLAY_NAMES = {
+    "nearby_search_calls": "Nearby Search",
+    "text_search_calls": "Text Search",
+    "geocode_calls": "Geocoding"
+}
+# Each process takes this many seconds' worth of tokens from the shared bucket at a time (at least one), and hands them
+# out to its own calls, so the shared state is written once per batch instead of once per call
+TOKEN_LEASE_SECONDS = 0.25
+# Taken tokens not used within this long are dropped, so an idle process can't save them up for a burst later
+TOKEN_LEASE_MAX_AGE_SECONDS = 1.0
+
+# The reservation of the search running in the current task (see run_with_reservation)
+_active_reservation = ContextVar("active_reservation", default=None)
+_token_buckets = {}
+
+
+class CallReservation:
+    """
+    API calls reserved for one search.
+
+    Reserved calls are counted in the usage store as soon as they're reserved, so concurrent searches can't
+    reserve the same budget. check_api_call_limit_new uses up the active reservation before counting a call on its own.
+    reserve and release write to the usage store (and may wait for another worker process), so async code runs them
+    with asyncio.to_thread.
+    """
+
+    def __init__(self, api_limits: dict):
+        self.api_limits = api_limits
+        self.reserved = {}  # endpoint name -> calls reserved and not used yet
+        self.counts = {}    # endpoint name -> usage counts when the calls were reserved
+        self.reserved_on = str(datetime.now().date())
+
+    def reserve(self, estimated_calls: dict[str, int]):
+        """
+        Reserve calls for one or more endpoints, all or nothing.
+
+        Args:
+            estimated_calls (dict): endpoint name (e.g. "nearby_search_calls") -> number of calls.
+
+        Returns:
+            tuple: (bool reserved, str error message, dict endpoint name -> counts)
+        """
+        requested_calls = {}
+        for endpoint_name, num_calls in estimated_calls.items():
+            if num_calls > 0:
+                limits = self.api_limits[API_LIMIT_KEYS[endpoint_name]]
+                requested_calls[endpoint_name] = (num_calls, limits["DAILY"], limits["MONTHLY"])
+        if not requested_calls:
+            return True, "", {}
+
+        with timed("quota_reserve"):
+            success, message, counts, endpoint_name = reserve_api_calls(requested_calls)
+        if not success:
+            # Tell the user how big the search is compared to what's left, instead of just "limit exceeded"
+            increment("quota_refusals_total", endpoint=endpoint_name, stage="reservation")
+            num_calls, daily_limit, monthly_limit = requested_calls[endpoint_name]
+            if message.startswith("Daily"):
+                calls_left = max(0, daily_limit - (counts[endpoint_name]["daily_calls"] - num_calls))
+                period = "today"
+            else:
+                calls_left = max(0, monthly_limit - (counts[endpoint_name]["monthly_calls"] - num_calls))
+                period = "this month"
+            message = (f"{message}. This search needs about {num_calls} {ENDPOINT_DISPLAY_NAMES[endpoint_name]} calls, "
+                       f"but only {calls_left} are left {period}")
+            return False, message, counts[endpoint_name]
+
+        self.reserved_on = str(datetime.now().date())
+        for endpoint_name, (num_calls, _, _) in requested_calls.items():
+            self.reserved[endpoint_name] = self.reserved.get(endpoint_name, 0) + num_calls
+            self.counts[endpoint_name] = counts[endpoint_name]
+        return True, "", counts
+
+    def take(self, endpoint_name: str) -> dict | None:
+        """Use one reserved call. Returns the counts from when it was reserved, or None if none are left."""
+        if self.reserved.get(endpoint_name, 0) <= 0:
+            return None
+        self.reserved[endpoint_name] -= 1
+        return self.counts[endpoint_name]
+
+    def release(self):
+        """Give back every reserved call that wasn't used."""
+        for endpoint_name, num_calls in self.reserved.items():
+            refund_api_calls(endpoint_name, num_calls, self.reserved_on)
+        self.reserved = {}
+
+
+def active_reservation() -> CallReservation | None:
+    return _active_reservation.get()
+
+
+async def run_with_reservation(reservation: CallReservation, awaitable):
+    """
+    Run awaitable with reservation as the active reservation.
+
+    Tasks copy the active reservation when they're created, so anything awaitable starts (e.g. one task per zip code)
+    draws from the same reservation.
+    """
+    token = _active_reservation.set(reservation)
+    try:
+        return await awaitable
+    finally:
+        _active_reservation.reset(token)
+
+
+class TokenBucket:
+    """
+    Lets calls through at rate per second on average, with bursts of up to capacity calls.
+
+    The bucket itself is kept in the shared state (see shared_state.py), so every worker process draws from the same one.
+    Tokens are taken from it in small batches (TOKEN_LEASE_SECONDS worth) and handed out in this process.
+    """
+
+    def __init__(self, label: str, rate: float, capacity: float):
+        self.label = label
+        self.rate = rate
+        self.capacity = capacity
+        self.lease_size = max(1, min(int(capacity), int(rate * TOKEN_LEASE_SECONDS)))
+        self.leased = 0
+        self.leased_at = 0.0
+
+    async def acquire(self):
+        while True:
+            if self.leased > 0 and time.monotonic() - self.leased_at <= TOKEN_LEASE_MAX_AGE_SECONDS:
+                self.leased -= 1
+                return
+            # A cross-process write that can wait on another worker's lock, so it runs in a thread to keep the event loop free
+            taken, wait = await asyncio.to_thread(take_rate_limit_tokens, self.label, self.rate, self.capacity, self.lease_size)
+            if taken:
+                self.leased, self.leased_at = taken, time.monotonic()
+                continue
+            await asyncio.sleep(wait)
+
+
+async def acquire_call_slot(label: str):
+    """
+    Wait until a call to an endpoint (an http_client label, e.g. "nearby_search") is allowed by its token bucket.
+
+    Rates are calls per second from RATE_LIMITS in api_limit_config.json, shared by every search in every worker process.
+    Endpoints without a rate aren't paced.
+    """
+    rate = get_config().get("RATE_LIMITS", {}).get(RATE_LIMIT_KEYS.get(label, ""))
+    if not rate:
+        return
+    bucket = _token_buckets.get(label)
+    # A new bucket when the rate changed in api_limit_config.json (the tokens themselves are in the shared state)
+    if bucket is None or bucket.rate != rate:
+        bucket = _token_buckets[label] = TokenBucket(label, rate, max(1.0, rate))
+    await bucket.acquire()
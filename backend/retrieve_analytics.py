@@ -1,55 +1,31 @@
-from datetime import datetime 
-import json
+from datetime import datetime
+import sqlite3
+from usage_store import read_usage_counts, API_ENDPOINT_NAMES
 
 def retrieve_analytics_data():
-        
+    """
+    Today's and this month's counts for each API endpoint, and the app search counts, for the analytics page.
+    Past days and date ranges are in usage_history.py.
+    """
     # Read in the analytics data
     try:
-        with open('search_counts_all.json', 'r') as file:
-            analytics_data = json.load(file)
-    except FileNotFoundError:
-        return {"error": "Analytics data file not found"}
-    except json.JSONDecodeError:
-        return {"error": "Error decoding analytics data"}  
-    
-    print('Analytics data: ')
-    print(analytics_data)
+        analytics_data = read_usage_counts()
+    except sqlite3.Error:
+        return {"error": "Error reading analytics data"}
 
     # Get the current date
     current_date = datetime.now().strftime("%Y-%m-%d")
 
     # Initialize the new data dictionary with nested structures
-    new_data = {
-        'app_search_counts': analytics_data['app_search_counts'],
-        'nearby_search_calls': {},
-        'text_search_calls': {},
-        'geocode_calls': {}
-    }
+    new_data = {'app_search_counts': analytics_data['app_search_counts']}
 
-    # Nearby search calls
-    if current_date == analytics_data['nearby_search_calls']['last_call_date']:
-        new_data['nearby_search_calls']['monthly_count_not_today'] = analytics_data['nearby_search_calls']['monthly_count'] - analytics_data['nearby_search_calls']['daily_count']
-        new_data['nearby_search_calls']['daily_count'] = analytics_data['nearby_search_calls']['daily_count']
-    else:
-        new_data['nearby_search_calls']['monthly_count_not_today'] = analytics_data['nearby_search_calls']['monthly_count']
-        new_data['nearby_search_calls']['daily_count'] = 0
+    for endpoint_name in API_ENDPOINT_NAMES:
+        counts = analytics_data[endpoint_name]
+        # The stored daily count is from the last day the endpoint was called, which might not be today
+        daily_count = counts['daily_count'] if current_date == counts['last_call_date'] else 0
+        new_data[endpoint_name] = {
+            'monthly_count_not_today': counts['monthly_count'] - daily_count,
+            'daily_count': daily_count
+        }
 
-    # Text search calls
-    if current_date == analytics_data['text_search_calls']['last_call_date']:
-        new_data['text_search_calls']['monthly_count_not_today'] = analytics_data['text_search_calls']['monthly_count'] - analytics_data['text_search_calls']['daily_count']
-        new_data['text_search_calls']['daily_count'] = analytics_data['text_search_calls']['daily_count']
-    else:
-        new_data['text_search_calls']['monthly_count_not_today'] = analytics_data['text_search_calls']['monthly_count']
-        new_data['text_search_calls']['daily_count'] = 0
-        
-    # Geocode calls
-    if current_date == analytics_data['geocode_calls']['last_call_date']:
-        new_data['geocode_calls']['monthly_count_not_today'] = analytics_data['geocode_calls']['monthly_count'] - analytics_data['geocode_calls']['daily_count']
-        new_data['geocode_calls']['daily_count'] = analytics_data['geocode_calls']['daily_count']
-    else:
-        new_data['geocode_calls']['monthly_count_not_today'] = analytics_data['geocode_calls']['monthly_count']
-        new_data['geocode_calls']['daily_count'] = 0
-    
-    print(f"New data: {new_data}")
-
-    return new_data
\ No newline at end of file
+    return new_data
@@ -0,0 +1,130 @@
+# Cache for Nearby Search and Text Search responses, shared by every worker process (see shared_state.py).
+# Reps rerun the same zip lists and regional queries all week, and every rerun costs $35/1000 calls.
+
+import hashlib
+import json
+import threading
+import time
+
+from shared_state import state_backend, get_connection, get_redis, redis_key
+
+# Used if the api_limit_config.json file does not have a RESULT_CACHE section
+DEFAULT_TTL_SECONDS = 3 * 24 * 60 * 60
+DEFAULT_MAX_ENTRIES = 2000
+# A hit only moves an entry's last_used forward when it's older than this, so hits on hot entries don't each take the
+# write lock. LRU eviction only needs to know roughly when an entry was last used.
+LAST_USED_RESOLUTION_SECONDS = 60
+
+_lock = threading.Lock()
+# Counted per process (like the metrics), the cached responses themselves are shared
+_stats = {"hits": 0, "misses": 0, "bypassed": 0, "expired": 0, "evicted": 0}
+
+
+def make_cache_key(endpoint: str, field_mask: str, **request_parts) -> str:
+    """
+    Build the cache key for a Google Places request.
+
+    Args:
+        endpoint (str): "searchNearby" or "searchText".
+        field_mask (str): The X-Goog-FieldMask we send, a different mask means a different response.
+        **request_parts: Whatever identifies the request, e.g. center/radius/included_types or text_query.
+
+    Returns:
+        str: A short stable hash of the request.
+    """
+    if "included_types" in request_parts:
+        request_parts["included_types"] = sorted(request_parts["included_types"])
+    if "center" in request_parts:
+        # ~10cm of precision, so the same zip centroid always maps to the same key
+        request_parts["center"] = [round(request_parts["center"][0], 6), round(request_parts["center"][1], 6)]
+    raw_key = json.dumps({"endpoint": endpoint, "field_mask": field_mask, **request_parts}, sort_keys=True)
+    return hashlib.sha256(raw_key.encode()).hexdigest()
+
+
+def _count(stat: str, amount: int = 1):
+    with _lock:
+        _stats[stat] += amount
+
+
+def get_cached_response(key: str):
+    """Return the cached response for a key, or None if it is missing or expired."""
+    if state_backend() == "redis":
+        # Redis drops expired entries itself, so a missing entry may also have expired
+        value_json = get_redis().get(redis_key("cache", key))
+        _count("misses" if value_json is None else "hits")
+        return None if value_json is None else json.loads(value_json)
+
+    conn = get_connection()
+    now = time.time()
+    row = conn.execute("SELECT expires_at, last_used, value_json FROM result_cache WHERE cache_key = ?", (key,)).fetchone()
+    if row is None:
+        _count("misses")
+        return None
+    expires_at, last_used, value_json = row
+    if expires_at < now:
+        conn.execute("DELETE FROM result_cache WHERE cache_key = ? AND expires_at < ?", (key, now))
+        _count("expired")
+        _count("misses")
+        return None
+    # Mark it recently used, so it's the last to be evicted
+    if now - last_used >= LAST_USED_RESOLUTION_SECONDS:
+        conn.execute("UPDATE result_cache SET last_used = ? WHERE cache_key = ?", (now, key))
+    _count("hits")
+    return json.loads(value_json)
+
+
+def is_cached(key: str) -> bool:
+    """Whether a key has a fresh entry, without counting a hit or miss (used to estimate the calls a search will make)."""
+    if state_backend() == "redis":
+        return bool(get_redis().exists(redis_key("cache", key)))
+    row = get_connection().execute("SELECT expires_at FROM result_cache WHERE cache_key = ?", (key,)).fetchone()
+    return row is not None and row[0] >= time.time()
+
+
+def cache_response(key: str, value, ttl_seconds: int = DEFAULT_TTL_SECONDS, max_entries: int = DEFAULT_MAX_ENTRIES):
+    """
+    Store a response, evicting the least recently used entries once the cache is full.
+
+    With the Redis backend entries only expire after ttl_seconds; set a maxmemory-policy (e.g. allkeys-lru) on the
+    Redis server to cap its size instead of max_entries.
+    """
+    value_json = json.dumps(value)
+    if state_backend() == "redis":
+        get_redis().set(redis_key("cache", key), value_json, ex=max(1, int(ttl_seconds)))
+        return
+
+    conn = get_connection()
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("INSERT OR REPLACE INTO result_cache VALUES (?, ?, ?, ?)", (key, now + ttl_seconds, now, value_json))
+        evicted = conn.execute("""
+            DELETE FROM result_cache WHERE cache_key IN (
+                SELECT cache_key FROM result_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)""", (max_entries,)).rowcount
+        conn.execute("COMMIT")
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    if evicted:
+        _count("evicted", evicted)
+
+
+def record_cache_bypass():
+    """Count a request that skipped the cache lookup because the user asked for fresh results."""
+    _count("bypassed")
+
+
+def get_cache_stats() -> dict:
+    """Hit/miss counters for the analytics dashboard."""
+    if state_backend() == "redis":
+        entries = sum(1 for _ in get_redis().scan_iter(match=redis_key("cache", "*"), count=1000))
+    else:
+        entries = get_connection().execute("SELECT COUNT(*) FROM result_cache WHERE expires_at >= ?", (time.time(),)).fetchone()[0]
+    with _lock:
+        lookups = _stats["hits"] + _stats["misses"]
+        return {
+            **_stats,
+            "entries": entries,
+            "hit_rate": round(_stats["hits"] / lookups, 3) if lookups else 0.0
+        }
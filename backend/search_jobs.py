@@ -0,0 +1,664 @@
+# Background jobs for zip code searches, so a big search doesn't depend on one browser connection staying open.
+#
+# A job's zip codes are searched by a pool of worker tasks. Each finished zip code is checkpointed to a local SQLite
+# database along with the events it produced, so clients can reconnect to the event stream where they left off,
+# and a job interrupted by a restart picks up where it stopped without paying for its finished zip codes again.
+# When the app runs as several worker processes, only the process holding the worker lease runs the workers. Any process
+# can submit, resume or stream a job: the jobs and their events are in the database, which every process shares.
+
+import asyncio
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from collections import deque
+from datetime import datetime, timedelta
+
+import httpx
+
+from carwash_zipcode import search_zip_code, merge_places, place_record, place_events, estimate_zipcode_search_calls, limit_exceeded_message
+from quota_scheduler import CallReservation, run_with_reservation
+from lead_dedup import dedupe_leads
+from zip_radius import plan_zip_radii
+from settings import get_config
+from metrics import record_error
+
+SEARCH_JOBS_DB = "search_jobs.sqlite3"
+# How many zip codes (across every job) are searched at once. Used if SEARCH_SETTINGS doesn't set JOB_WORKERS.
+DEFAULT_JOB_WORKERS = 4
+# A job in one of these states won't produce any more events until it is resumed
+FINISHED_STATUSES = {"completed", "stopped", "failed"}
+# Checkpoints read per query by _iter_checkpoints
+CHECKPOINT_CHUNK_ROWS = 50
+# How often the event stream sends a comment to keep idle connections (and proxies) from timing out
+EVENT_STREAM_KEEPALIVE_SECONDS = 15
+# How often each process renews (or tries to take) the worker lease, the lease owner picks up jobs queued by other
+# processes, and event streams check for events written by other processes
+JOB_POLL_SECONDS = 1
+# A lease that isn't renewed for this long (its process died or hung) can be taken over by another process
+WORKER_LEASE_SECONDS = 15
+WORKER_LEASE_NAME = "job_workers"
+# Events of jobs that finished longer ago than this are deleted (except each job's last one), so job_events doesn't grow
+# forever. The job's status and results are kept. The lease owner checks for them every JOB_EVENT_PRUNE_SECONDS.
+JOB_EVENT_RETENTION_DAYS = 30
+JOB_EVENT_PRUNE_SECONDS = 60 * 60
+
+_local = threading.local()
+logger = logging.getLogger(__name__)
+
+# Scheduler state (only touched from the event loop, the database is read and written in threads, see _set_status): reps take turns, and each rep's jobs run in the order they were submitted
+_jobs_by_rep = {}         # rep -> deque of job ids with zip codes still to start
+_rep_order = deque()      # reps with queued work, in round robin order
+_remaining_zip_codes = {}  # job id -> deque of zip codes not started yet
+_in_flight = {}           # job id -> number of its zip codes being searched right now
+_known_zip_codes = {}     # job id -> place id -> zip codes, for the place / place_update events
+_work_available = None
+_claim_lock = None
+_events_changed = None
+_event_version = 0
+_workers = []
+_coordinator = None
+# The event loop only keeps weak references to tasks, so the notify tasks are kept here until they're done
+_background_tasks = set()
+# Identifies this process as the worker lease owner
+_process_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def _get_connection(db_path: str = SEARCH_JOBS_DB) -> sqlite3.Connection:
+    """Get this thread's connection to the jobs database, creating the tables the first time (same setup as usage_store.py)."""
+    connections = getattr(_local, "connections", None)
+    if connections is None:
+        connections = _local.connections = {}
+    conn = connections.get(db_path)
+    if conn is None:
+        conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=30000")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                rep TEXT NOT NULL,
+                status TEXT NOT NULL,
+                request_json TEXT NOT NULL,
+                num_zip_codes INTEGER NOT NULL,
+                created_at TEXT NOT NULL,
+                started_at TEXT,
+                finished_at TEXT,
+                error TEXT
+            );
+            CREATE TABLE IF NOT EXISTS job_zip_results (
+                job_id TEXT NOT NULL,
+                zip_code TEXT NOT NULL,
+                outcome_json TEXT NOT NULL,
+                finished_at TEXT NOT NULL,
+                PRIMARY KEY (job_id, zip_code)
+            );
+            CREATE TABLE IF NOT EXISTS job_events (
+                event_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                job_id TEXT NOT NULL,
+                event_json TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS job_events_by_job ON job_events (job_id, event_id);
+            CREATE TABLE IF NOT EXISTS worker_lease (
+                name TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            );
+        """)
+        connections[db_path] = conn
+    return conn
+
+
+def _now() -> str:
+    return datetime.now().isoformat(timespec="seconds")
+
+
+def _notify_events_changed():
+    """Wake up every event stream waiting for new events."""
+    global _event_version
+    _event_version += 1
+    if _events_changed is not None:
+        async def notify():
+            async with _events_changed:
+                _events_changed.notify_all()
+        task = asyncio.get_running_loop().create_task(notify())
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+
+
+def _append_events(conn: sqlite3.Connection, job_id: str, events: list[dict]):
+    conn.executemany("INSERT INTO job_events (job_id, event_json) VALUES (?, ?)",
+                     [(job_id, json.dumps(event)) for event in events])
+
+
+def _write_status(job_id: str, status: str, error: str | None = None):
+    """Update a job's status and add a job_status event for it, in one transaction."""
+    conn = _get_connection()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if status == "running":
+            conn.execute("UPDATE jobs SET status = ?, started_at = COALESCE(started_at, ?), finished_at = NULL, error = NULL WHERE job_id = ?",
+                         (status, _now(), job_id))
+        else:
+            conn.execute("UPDATE jobs SET status = ?, finished_at = ?, error = ? WHERE job_id = ?",
+                         (status, _now() if status in FINISHED_STATUSES else None, error, job_id))
+        event = {"type": "job_status", "job_id": job_id, "status": status}
+        if error:
+            event["error"] = error
+        _append_events(conn, job_id, [event])
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+async def _set_status(job_id: str, status: str, error: str | None = None):
+    """
+    Update a job's status (see _write_status) and wake its event streams.
+
+    Writes to the jobs database run in a thread: with several worker processes one may have to wait for another's
+    write lock (up to the busy timeout), which would freeze every stream and search of this process on the event loop.
+    """
+    await asyncio.to_thread(_write_status, job_id, status, error)
+    _notify_events_changed()
+    if status in FINISHED_STATUSES:
+        _forget_job(job_id)
+
+
+def _forget_job(job_id: str):
+    """Drop a finished job's scheduler state, once none of its zip codes are being searched any more."""
+    if _in_flight.get(job_id):
+        # The last of them to finish does it (see _search_unit)
+        return
+    _remaining_zip_codes.pop(job_id, None)
+    _in_flight.pop(job_id, None)
+    _known_zip_codes.pop(job_id, None)
+
+
+def _finished_zip_codes(job_id: str) -> list[str]:
+    return [row[0] for row in _get_connection().execute("SELECT zip_code FROM job_zip_results WHERE job_id = ?", (job_id,))]
+
+
+def _iter_checkpoints(job_id: str):
+    """
+    The outcome of every finished zip code of a job, in the order they finished.
+
+    Reads a chunk at a time rather than keeping a cursor open, so it can be resumed from another thread (e.g. by a streaming export).
+    """
+    last_rowid = 0
+    while True:
+        rows = _get_connection().execute("SELECT rowid, outcome_json FROM job_zip_results WHERE job_id = ? AND rowid > ? ORDER BY rowid LIMIT ?",
+                                         (job_id, last_rowid, CHECKPOINT_CHUNK_ROWS)).fetchall()
+        for _, outcome_json in rows:
+            yield json.loads(outcome_json)
+        if len(rows) < CHECKPOINT_CHUNK_ROWS:
+            return
+        last_rowid = rows[-1][0]
+
+
+def _read_progress(job_id: str, zip_codes: list[str]) -> tuple[deque, dict, str]:
+    """A job's zip codes that haven't been searched yet, what it already found (place id -> zip codes) and its status."""
+    finished = set(_finished_zip_codes(job_id))
+    remaining = deque(zip_code for zip_code in zip_codes if zip_code not in finished)
+    known_zip_codes = {}
+    for outcome in _iter_checkpoints(job_id):
+        place_events(known_zip_codes, outcome)
+    return remaining, known_zip_codes, _read_job(job_id)["status"]
+
+
+async def _enqueue(job_id: str, rep: str, zip_codes: list[str]):
+    """Queue a job's zip codes that haven't been searched yet, rebuilding what it already found from its checkpoints."""
+    remaining, known_zip_codes, status = await asyncio.to_thread(_read_progress, job_id, zip_codes)
+    _known_zip_codes[job_id] = known_zip_codes
+
+    if not remaining:
+        await _set_status(job_id, "completed")
+        return
+    _remaining_zip_codes[job_id] = remaining
+    _in_flight.setdefault(job_id, 0)
+    if rep not in _jobs_by_rep or not _jobs_by_rep[rep]:
+        _jobs_by_rep[rep] = deque()
+        _rep_order.append(rep)
+    _jobs_by_rep[rep].append(job_id)
+    # A job submitted or resumed by any process is already queued (with its job_status event)
+    if status != "queued":
+        await _set_status(job_id, "queued")
+
+
+def _next_unit():
+    """
+    Take the next (job id, zip code) to search, or None if there's nothing queued.
+
+    Reps take turns one zip code at a time, so a rep who submits a 50 zip code job doesn't hold up everyone else's
+    searches (or use up the shared daily quota before anyone else gets a turn).
+    """
+    while _rep_order:
+        rep = _rep_order.popleft()
+        jobs = _jobs_by_rep[rep]
+        while jobs and not _remaining_zip_codes.get(jobs[0]):
+            jobs.popleft()
+        if not jobs:
+            del _jobs_by_rep[rep]
+            continue
+        job_id = jobs[0]
+        zip_code = _remaining_zip_codes[job_id].popleft()
+        if not _remaining_zip_codes[job_id]:
+            jobs.popleft()
+        if jobs:
+            _rep_order.append(rep)
+        else:
+            del _jobs_by_rep[rep]
+        _in_flight[job_id] += 1
+        return job_id, zip_code
+    return None
+
+
+def _drop_queued(job_id: str):
+    """Stop starting new zip codes for a job (the zip codes already being searched still finish)."""
+    remaining = _remaining_zip_codes.pop(job_id, None)
+    if remaining is not None:
+        remaining.clear()
+
+
+def _read_job(job_id: str) -> dict | None:
+    row = _get_connection().execute("SELECT rep, status, request_json FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+    if row is None:
+        return None
+    return {"rep": row[0], "status": row[1], "request": json.loads(row[2])}
+
+
+def _save_zip_code(job_id: str, zip_code: str, events: list[dict], outcome: dict | None = None):
+    """Add a zip code's events, and checkpoint its outcome (if it has one to keep), in one transaction."""
+    conn = _get_connection()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if outcome is not None:
+            conn.execute("INSERT OR REPLACE INTO job_zip_results (job_id, zip_code, outcome_json, finished_at) VALUES (?, ?, ?, ?)",
+                         (job_id, zip_code, json.dumps({"places": outcome["places"], "zip_codes_by_place": outcome["zip_codes_by_place"]}), _now()))
+        _append_events(conn, job_id, events)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+async def _search_unit(client: httpx.AsyncClient, api_key: str, semaphore: asyncio.Semaphore, job_id: str, zip_code: str):
+    """Search one zip code of a job and checkpoint its results and events."""
+    job = _read_job(job_id)
+    if job["status"] == "queued":
+        await _set_status(job_id, "running")
+    request = job["request"]
+
+    config = get_config()
+
+    # Picked when the zip code's turn comes, so it learns from the zip codes this job (or any other search) already ran
+    radius = request["radius"]
+    if request.get("auto_radius"):
+        radius = plan_zip_radii([zip_code], request["included_types"], radius, config.get("AUTO_RADIUS", {}))[zip_code]["radius"]
+
+    # Reserve the zip code's calls before starting it, so a zip code is never left half searched by the limits
+    reservation = CallReservation(config["API_LIMITS"])
+    estimated_calls = await asyncio.to_thread(estimate_zipcode_search_calls, [zip_code], radius, request["included_types"], request["use_cache"])
+    success, message, counts = await asyncio.to_thread(reservation.reserve, estimated_calls)
+    if success:
+        try:
+            outcome = await run_with_reservation(reservation, search_zip_code(
+                client, semaphore, api_key, zip_code, request["included_types"], radius,
+                config["API_LIMITS"], config.get("RESULT_CACHE", {}), request["use_cache"],
+                request["adaptive_tiling"], config.get("SEARCH_SETTINGS", {}), config.get("AUTO_RADIUS", {})))
+        except Exception as e:
+            _in_flight[job_id] -= 1
+            _drop_queued(job_id)
+            await _set_status(job_id, "failed", f"Error searching {zip_code}: {str(e)}")
+            return
+        finally:
+            await asyncio.to_thread(reservation.release)
+    else:
+        outcome = {"events": [limit_exceeded_message(message, counts)], "places": [], "zip_codes_by_place": {}, "limit_exceeded": True}
+
+    _in_flight[job_id] -= 1
+    events = list(outcome["events"])
+    if outcome["limit_exceeded"]:
+        # The quota is shared, so there's no point searching the rest of the job until the limit resets. It can be resumed later.
+        await asyncio.to_thread(_save_zip_code, job_id, zip_code, events)
+        _drop_queued(job_id)
+        await _set_status(job_id, "stopped", "API call limit exceeded. Resume the job once the limit resets.")
+        return
+
+    # A zip code whose search returned an error isn't checkpointed, so resuming the job searches it again
+    failed = any("error" in event for event in events)
+    if not failed:
+        events.extend(place_events(_known_zip_codes[job_id], outcome))
+    events.append({"type": "zip_code_failed" if failed else "zip_code_complete", "zip_code": zip_code,
+                   "num_places": len(outcome["places"])})
+
+    await asyncio.to_thread(_save_zip_code, job_id, zip_code, events, None if failed else outcome)
+    _notify_events_changed()
+
+    if not _remaining_zip_codes.get(job_id) and _in_flight[job_id] == 0:
+        if _read_job(job_id)["status"] == "running":
+            await _set_status(job_id, "completed")
+        else:
+            # Stopped or failed while this zip code was being searched
+            _forget_job(job_id)
+
+
+async def _worker(client: httpx.AsyncClient, api_key: str, semaphore: asyncio.Semaphore):
+    while True:
+        async with _work_available:
+            await _work_available.wait_for(lambda: bool(_rep_order))
+            unit = _next_unit()
+        if unit is None:
+            continue
+        job_id, zip_code = unit
+        try:
+            await _search_unit(client, api_key, semaphore, job_id, zip_code)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            record_error("search_job", type(e).__name__)
+            logger.exception("Search job %s failed on %s", job_id, zip_code)
+
+
+async def _wake_workers():
+    async with _work_available:
+        _work_available.notify_all()
+
+
+def _acquire_worker_lease() -> bool:
+    """Take or renew the worker lease. Returns whether this process holds it."""
+    conn = _get_connection()
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute("SELECT owner, expires_at FROM worker_lease WHERE name = ?", (WORKER_LEASE_NAME,)).fetchone()
+        acquired = row is None or row[0] == _process_id or row[1] < now
+        if acquired:
+            conn.execute("INSERT OR REPLACE INTO worker_lease VALUES (?, ?, ?)", (WORKER_LEASE_NAME, _process_id, now + WORKER_LEASE_SECONDS))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return acquired
+
+
+def _prune_job_events() -> int:
+    """
+    Delete the events of jobs that finished more than JOB_EVENT_RETENTION_DAYS ago, keeping each job's last event (its final
+    job_status), so a stream of an old job still ends with it. Returns how many were deleted.
+    """
+    cutoff = (datetime.now() - timedelta(days=JOB_EVENT_RETENTION_DAYS)).isoformat(timespec="seconds")
+    conn = _get_connection()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        deleted = conn.execute("""
+            DELETE FROM job_events
+            WHERE job_id IN (SELECT job_id FROM jobs WHERE status IN ('completed', 'stopped', 'failed') AND finished_at < ?)
+              AND event_id < (SELECT MAX(event_id) FROM job_events AS last WHERE last.job_id = job_events.job_id)""", (cutoff,)).rowcount
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return deleted
+
+
+def _release_worker_lease():
+    _get_connection().execute("DELETE FROM worker_lease WHERE name = ? AND owner = ?", (WORKER_LEASE_NAME, _process_id))
+
+
+def _unfinished_jobs() -> list[tuple]:
+    return _get_connection().execute(
+        "SELECT job_id, rep, request_json FROM jobs WHERE status IN ('queued', 'running') ORDER BY created_at").fetchall()
+
+
+async def _claim_queued_jobs() -> bool:
+    """
+    Queue every queued or running job this process isn't already working on: jobs submitted or resumed by other
+    processes, and (on start or after taking over the lease) jobs that were interrupted. Returns whether any were queued.
+    """
+    # One claim at a time (the coordinator's and a submit's), as _enqueue waits for the database before it queues a job
+    async with _claim_lock:
+        claimed = False
+        for job_id, rep, request_json in await asyncio.to_thread(_unfinished_jobs):
+            if _remaining_zip_codes.get(job_id) or _in_flight.get(job_id):
+                continue
+            await _enqueue(job_id, rep, json.loads(request_json)["zip_codes"])
+            claimed = True
+        return claimed
+
+
+async def _cancel_workers():
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
+    # Whoever runs the workers next rebuilds all of this from the database
+    _jobs_by_rep.clear()
+    _rep_order.clear()
+    _remaining_zip_codes.clear()
+    _in_flight.clear()
+    _known_zip_codes.clear()
+
+
+async def _coordinate_workers(client: httpx.AsyncClient, api_key: str, num_workers: int):
+    """
+    Every JOB_POLL_SECONDS, renew (or try to take) the worker lease. The process holding it runs the worker pool and
+    picks up jobs queued by other processes. A process that lost the lease (e.g. it hung for longer than
+    WORKER_LEASE_SECONDS and another process took over) stops its workers, so no job is run twice.
+    """
+    semaphore = asyncio.Semaphore(num_workers)
+    next_prune = 0.0
+    while True:
+        try:
+            if await asyncio.to_thread(_acquire_worker_lease):
+                if not _workers:
+                    for _ in range(num_workers):
+                        _workers.append(asyncio.create_task(_worker(client, api_key, semaphore)))
+                if await _claim_queued_jobs():
+                    await _wake_workers()
+                if time.monotonic() >= next_prune:
+                    next_prune = time.monotonic() + JOB_EVENT_PRUNE_SECONDS
+                    await asyncio.to_thread(_prune_job_events)
+            elif _workers:
+                await _cancel_workers()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            record_error("search_job_coordinator", type(e).__name__)
+            logger.exception("Search job coordinator error")
+        await asyncio.sleep(JOB_POLL_SECONDS)
+
+
+def start_job_workers(client: httpx.AsyncClient, api_key: str):
+    """
+    Start coordinating the worker pool (called when the app starts in each worker process).
+
+    Only the process holding the worker lease runs the workers, and it re-queues any job that was queued or running
+    when the app stopped.
+    """
+    global _work_available, _events_changed, _claim_lock, _coordinator
+    _work_available = asyncio.Condition()
+    _events_changed = asyncio.Condition()
+    _claim_lock = asyncio.Lock()
+
+    num_workers = get_config().get("SEARCH_SETTINGS", {}).get("JOB_WORKERS", DEFAULT_JOB_WORKERS)
+    _coordinator = asyncio.create_task(_coordinate_workers(client, api_key, max(1, num_workers)))
+
+
+async def stop_job_workers():
+    """
+    Cancel the workers (called when the app shuts down) and give up the worker lease, so another process can take over
+    right away. Unfinished jobs are picked up again by whichever process runs the workers next.
+    """
+    global _coordinator
+    if _coordinator is not None:
+        _coordinator.cancel()
+        await asyncio.gather(_coordinator, return_exceptions=True)
+        _coordinator = None
+    was_running = bool(_workers)
+    await _cancel_workers()
+    if was_running:
+        await asyncio.to_thread(_release_worker_lease)
+
+
+async def _start_queued_jobs():
+    """Start newly queued jobs right away if this process runs the workers, otherwise the lease owner picks them up within JOB_POLL_SECONDS."""
+    if _workers and await _claim_queued_jobs():
+        await _wake_workers()
+
+
+def _insert_job(job_id: str, rep: str, request: dict):
+    """Add a queued job and its first job_status event, in one transaction."""
+    conn = _get_connection()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("INSERT INTO jobs (job_id, rep, status, request_json, num_zip_codes, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                     (job_id, rep, "queued", json.dumps(request), len(request["zip_codes"]), _now()))
+        _append_events(conn, job_id, [{"type": "job_status", "job_id": job_id, "status": "queued"}])
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+async def submit_job(rep: str, zip_codes: list[str], included_types: list[str], radius: int,
+                     use_cache: bool = True, adaptive_tiling: bool = False, auto_radius: bool = False) -> dict:
+    """
+    Create a zip code search job and queue it.
+
+    Args:
+        rep (str): Who the job is for. Reps' jobs take turns, see _next_unit.
+        zip_codes (list): The zip codes to search.
+        included_types (list): Place types to search for.
+        radius (int): The radius of each zip code's search in meters.
+        use_cache (bool): Reuse recent identical Nearby Search responses from the result cache.
+        adaptive_tiling (bool): Split searches that hit the 20 result cap into smaller ones.
+        auto_radius (bool): Pick each zip code's radius from its area and past searches of it instead (see zip_radius.py).
+
+    Returns:
+        dict: The job's status (see get_job_status).
+    """
+    job_id = uuid.uuid4().hex
+    zip_codes = list(dict.fromkeys(zip_code.strip() for zip_code in zip_codes))
+    request = {"zip_codes": zip_codes, "included_types": included_types, "radius": radius,
+               "use_cache": use_cache, "adaptive_tiling": adaptive_tiling, "auto_radius": auto_radius}
+    await asyncio.to_thread(_insert_job, job_id, rep, request)
+    await _start_queued_jobs()
+    return get_job_status(job_id)
+
+
+async def resume_job(job_id: str) -> dict:
+    """Re-queue a stopped or failed job. Zip codes it already finished are skipped."""
+    job = _read_job(job_id)
+    if job is None:
+        return {"error": f"No job with id {job_id}"}
+    if job["status"] not in FINISHED_STATUSES or _in_flight.get(job_id):
+        return {"error": f"Job {job_id} is still {job['status']}"}
+    await _set_status(job_id, "queued")
+    await _start_queued_jobs()
+    return get_job_status(job_id)
+
+
+def get_job_status(job_id: str) -> dict:
+    row = _get_connection().execute("""
+        SELECT rep, status, num_zip_codes, created_at, started_at, finished_at, error,
+               (SELECT COUNT(*) FROM job_zip_results WHERE job_id = jobs.job_id),
+               (SELECT MAX(event_id) FROM job_events WHERE job_id = jobs.job_id)
+        FROM jobs WHERE job_id = ?""", (job_id,)).fetchone()
+    if row is None:
+        return {"error": f"No job with id {job_id}"}
+    return {
+        "job_id": job_id,
+        "rep": row[0],
+        "status": row[1],
+        "num_zip_codes": row[2],
+        "zip_codes_done": row[7],
+        "created_at": row[3],
+        "started_at": row[4],
+        "finished_at": row[5],
+        "error": row[6],
+        "last_event_id": row[8] or 0
+    }
+
+
+def list_jobs(rep: str | None = None, limit: int = 50) -> list[dict]:
+    """The most recent jobs, optionally only one rep's."""
+    if rep is None:
+        rows = _get_connection().execute("SELECT job_id FROM jobs ORDER BY created_at DESC LIMIT ?", (limit,)).fetchall()
+    else:
+        rows = _get_connection().execute("SELECT job_id FROM jobs WHERE rep = ? ORDER BY created_at DESC LIMIT ?", (rep, limit)).fetchall()
+    return [get_job_status(job_id) for (job_id,) in rows]
+
+
+def get_job_results(job_id: str) -> dict:
+    """Every lead the job has found so far, deduplicated the same way as a zip code search (by place id, then fuzzily)."""
+    status = get_job_status(job_id)
+    if "job_id" not in status:
+        return status
+    all_car_washes = {}
+    for outcome in _iter_checkpoints(job_id):
+        merge_places(all_car_washes, outcome)
+    results = dedupe_leads(all_car_washes.values())
+    return {**status, "results": results, "num_results": len(results)}
+
+
+def iter_job_leads(job_id: str):
+    """
+    Every lead the job has found so far, deduplicated by place id, one at a time (for exports).
+    Fuzzy duplicates aren't merged here, as that needs every lead in memory (exports do it with ?dedupe=true).
+
+    Makes two passes over the checkpoints: the first collects each place's zip codes, the second yields each place's record
+    the first time it's seen. Only place id -> zip codes is kept in memory, not the records.
+    """
+    zip_codes_by_place = {}
+    for outcome in _iter_checkpoints(job_id):
+        for place_id, zip_codes in outcome["zip_codes_by_place"].items():
+            known_zip_codes = zip_codes_by_place.setdefault(place_id, [])
+            known_zip_codes.extend(zip_code for zip_code in zip_codes if zip_code not in known_zip_codes)
+
+    for outcome in _iter_checkpoints(job_id):
+        for place in outcome["places"]:
+            zip_codes = zip_codes_by_place.pop(place["id"], None)
+            if zip_codes is not None:
+                yield {**place_record(place, zip_codes), "types": place.get("types", [])}
+
+
+async def stream_job_events(job_id: str, last_event_id: int = 0):
+    """
+    Stream a job's events as server-sent events, starting after last_event_id.
+
+    Each event has an "id:" line, so a client that reconnects with a Last-Event-ID header carries on where it left off.
+    The stream ends once the job is completed, stopped or failed and every event has been sent.
+    """
+    if _read_job(job_id) is None:
+        yield f"data: {json.dumps({'error': f'No job with id {job_id}'})}\n\n"
+        return
+
+    last_sent = time.monotonic()
+    while True:
+        seen_version = _event_version
+        rows = _get_connection().execute("SELECT event_id, event_json FROM job_events WHERE job_id = ? AND event_id > ? ORDER BY event_id",
+                                         (job_id, last_event_id)).fetchall()
+        for event_id, event_json in rows:
+            yield f"id: {event_id}\ndata: {event_json}\n\n"
+            last_event_id = event_id
+        if rows:
+            last_sent = time.monotonic()
+            continue
+        if _read_job(job_id)["status"] in FINISHED_STATUSES:
+            return
+
+        # Events written by this process wake the stream right away. Events written by another worker process
+        # (the one running the job) are picked up by checking again every JOB_POLL_SECONDS.
+        try:
+            async with _events_changed:
+                await asyncio.wait_for(_events_changed.wait_for(lambda: _event_version != seen_version), JOB_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            if time.monotonic() - last_sent >= EVENT_STREAM_KEEPALIVE_SECONDS:
+                yield ": keep-alive\n\n"
+                last_sent = time.monotonic()
@@ -0,0 +1,181 @@
+# api_limit_config.json, loaded once per process and validated, instead of opened and parsed by every search.
+#
+# The file is checked for changes at most once every RELOAD_CHECK_SECONDS (one os.stat), and reloaded when its
+# modification time or size changed, so edits (e.g. raising a daily limit) apply to every worker process within a second
+# without a restart. A file that doesn't validate is refused: the first load raises, a reload keeps the previous settings.
+#
+# Also reads the Google API key, importing python-dotenv only when the key isn't already in the environment (in the
+# Docker image it always is), so a cold start doesn't pay for it.
+
+import logging
+import os
+import threading
+import time
+
+from pydantic import BaseModel, ConfigDict, Field, ValidationError
+
+from metrics import timed
+
+CONFIG_FILE = 'api_limit_config.json'
+RELOAD_CHECK_SECONDS = 1.0
+
+logger = logging.getLogger(__name__)
+
+
+class ConfigSection(BaseModel):
+    # Settings a section doesn't declare are kept as they are, so a new setting doesn't need a change here to be read
+    model_config = ConfigDict(extra="allow")
+
+
+class EndpointLimits(ConfigSection):
+    DAILY: int = Field(ge=0)
+    MONTHLY: int = Field(ge=0)
+
+
+class ApiLimits(ConfigSection):
+    TEXT_SEARCH: EndpointLimits
+    NEARBY_SEARCH: EndpointLimits
+    GEOCODE: EndpointLimits
+
+
+class ApiPricing(ConfigSection):
+    NEARBY_SEARCH: float | None = Field(None, ge=0)
+    TEXT_SEARCH: float | None = Field(None, ge=0)
+    GEOCODE: float | None = Field(None, ge=0)
+    MONTHLY_FREE_CREDIT: float | None = Field(None, ge=0)
+
+
+class RateLimits(ConfigSection):
+    # Calls per second, 0 turns pacing off for the endpoint
+    NEARBY_SEARCH: float | None = Field(None, ge=0)
+    TEXT_SEARCH: float | None = Field(None, ge=0)
+    GEOCODE: float | None = Field(None, ge=0)
+
+
+class SearchSettings(ConfigSection):
+    ZIPCODE_CONCURRENCY: int | None = Field(None, ge=1)
+    ADAPTIVE_MAX_CALLS_PER_ZIP: int | None = Field(None, ge=1)
+    ADAPTIVE_MIN_RADIUS: float | None = Field(None, gt=0)
+    TEXT_SEARCH_PAGE_DELAY: float | None = Field(None, ge=0)
+    REGIONAL_BATCH_CONCURRENCY: int | None = Field(None, ge=1)
+    JOB_WORKERS: int | None = Field(None, ge=1)
+    ZIPCODE_CHUNK_SIZE: int | None = Field(None, ge=1)
+    MAX_TERRITORY_ZIP_CODES: int | None = Field(None, ge=1)
+
+
+class AutoRadius(ConfigSection):
+    MIN_RADIUS: float | None = Field(None, gt=0)
+    MAX_RADIUS: float | None = Field(None, gt=0)
+    SATURATED_SCALE: float | None = Field(None, gt=0)
+    EMPTY_SCALE: float | None = Field(None, gt=0)
+
+
+class ResultCache(ConfigSection):
+    TTL_SECONDS: float | None = Field(None, ge=0)
+    MAX_ENTRIES: int | None = Field(None, ge=0)
+
+
+class HttpClient(ConfigSection):
+    MAX_CONNECTIONS: int | None = Field(None, ge=1)
+    MAX_KEEPALIVE_CONNECTIONS: int | None = Field(None, ge=0)
+    KEEPALIVE_EXPIRY: float | None = Field(None, ge=0)
+    CONNECT_TIMEOUT: float | None = Field(None, gt=0)
+    READ_TIMEOUT: float | None = Field(None, gt=0)
+    MAX_RETRIES: int | None = Field(None, ge=0)
+    RETRY_BASE_DELAY: float | None = Field(None, ge=0)
+    RETRY_MAX_DELAY: float | None = Field(None, ge=0)
+
+
+class LeadStore(ConfigSection):
+    COVERAGE_MAX_AGE_DAYS: float | None = Field(None, ge=0)
+    TEXT_SEARCH_MAX_AGE_DAYS: float | None = Field(None, ge=0)
+
+
+class SharedState(ConfigSection):
+    BACKEND: str | None = None
+    REDIS_URL: str | None = None
+    KEY_PREFIX: str | None = None
+
+
+class Settings(ConfigSection):
+    API_LIMITS: ApiLimits
+    API_PRICING: ApiPricing | None = None
+    RATE_LIMITS: RateLimits | None = None
+    SEARCH_SETTINGS: SearchSettings | None = None
+    AUTO_RADIUS: AutoRadius | None = None
+    RESULT_CACHE: ResultCache | None = None
+    HTTP_CLIENT: HttpClient | None = None
+    LEAD_STORE: LeadStore | None = None
+    SHARED_STATE: SharedState | None = None
+
+
+_lock = threading.Lock()
+_settings = None
+_config = None
+# (modification time, size) of the file the settings came from, and when to stat it again
+_file_version = None
+_next_check = 0.0
+
+
+def _reload_if_changed():
+    global _settings, _config, _file_version, _next_check
+    now = time.monotonic()
+    if _settings is not None and now < _next_check:
+        return
+    with _lock:
+        if _settings is not None and now < _next_check:
+            return
+        _next_check = now + RELOAD_CHECK_SECONDS
+        try:
+            stat = os.stat(CONFIG_FILE)
+        except OSError as e:
+            if _settings is None:
+                raise
+            logger.warning("Keeping the previous settings, can't read %s: %s", CONFIG_FILE, e)
+            return
+        version = (stat.st_mtime_ns, stat.st_size)
+        if version == _file_version:
+            return
+        try:
+            with timed("config_read"), open(CONFIG_FILE, 'rb') as file:
+                settings = Settings.model_validate_json(file.read())
+        except (OSError, ValidationError) as e:
+            if _settings is None:
+                raise ValueError(f"{CONFIG_FILE} isn't valid: {e}") from e
+            # Remembered so a broken file is reported once, not parsed again every second until it's fixed
+            _file_version = version
+            logger.warning("Keeping the previous settings, %s isn't valid: %s", CONFIG_FILE, e)
+            return
+        # Only what's in the file, so code that falls back to its own defaults (config.get(key, DEFAULT)) still does.
+        # A setting set to null counts as not set, rather than handing None to code expecting a number.
+        _config = settings.model_dump(exclude_unset=True, exclude_none=True)
+        _settings = settings
+        _file_version = version
+
+
+def get_settings() -> Settings:
+    """The validated api_limit_config.json, reloaded if the file changed."""
+    _reload_if_changed()
+    return _settings
+
+
+def get_config() -> dict:
+    """
+    The validated api_limit_config.json as a dict shaped like the file, reloaded if the file changed.
+
+    The same dict is shared by every caller until the next reload, so don't change it.
+    """
+    _reload_if_changed()
+    return _config
+
+
+def get_google_api_key() -> str:
+    """GOOGLE_MAPS_API_KEY from the environment, or from the .env file if it isn't set there."""
+    api_key = os.getenv('GOOGLE_MAPS_API_KEY')
+    if not api_key:
+        from dotenv import load_dotenv
+        load_dotenv()
+        api_key = os.getenv('GOOGLE_MAPS_API_KEY')
+    if not api_key:
+        raise ValueError("No API key found. Please set the GOOGLE_MAPS_API_KEY environment variable in the .env file.")
+    return api_key
@@ -0,0 +1,187 @@
+# Where the state shared by every worker process lives, so the backend can run as several processes
+# (uvicorn --workers N) or several replicas.
+#
+# The api call counts (usage_store.py), the result cache (search_cache.py) and the rate limits we pace Google calls with
+# (quota_scheduler.py) have to be the same in every process, or a limit is only a limit per process. By default they
+# live in SQLite files in the working directory, which every process on one machine shares. Set SHARED_STATE.BACKEND
+# (or the SHARED_STATE_BACKEND environment variable) to "redis" to keep them in Redis instead, so they're shared between
+# machines too. "fakeredis://" as the REDIS_URL uses an in-process stand-in (the fakeredis package) for trying it out.
+
+import os
+import sqlite3
+import threading
+import time
+
+from settings import get_config
+
+SHARED_STATE_DB = "shared_state.sqlite3"
+BACKENDS = ("sqlite", "redis")
+# Used for whatever the api_limit_config.json file's SHARED_STATE section doesn't set
+DEFAULT_SHARED_STATE_CONFIG = {
+    "BACKEND": "sqlite",
+    "REDIS_URL": "redis://localhost:6379/0",
+    "KEY_PREFIX": "carwash:"
+}
+# How many times a Redis transaction is retried when another process changed its keys first
+MAX_TRANSACTION_RETRIES = 100
+
+_local = threading.local()
+_config = None
+_redis = None
+_redis_lock = threading.Lock()
+
+
+def shared_state_config() -> dict:
+    """
+    The SHARED_STATE section of api_limit_config.json, with SHARED_STATE_BACKEND and REDIS_URL from the environment
+    taking precedence (so a deployment can switch backends without editing the file). Read once per process.
+    """
+    global _config
+    if _config is None:
+        config = {**DEFAULT_SHARED_STATE_CONFIG, **get_config().get("SHARED_STATE", {})}
+        config["BACKEND"] = os.getenv("SHARED_STATE_BACKEND", config["BACKEND"]).lower()
+        config["REDIS_URL"] = os.getenv("REDIS_URL", config["REDIS_URL"])
+        if config["BACKEND"] not in BACKENDS:
+            raise ValueError(f"Unknown SHARED_STATE backend {config['BACKEND']}. Use one of: {', '.join(BACKENDS)}")
+        _config = config
+    return _config
+
+
+def state_backend() -> str:
+    """ "sqlite" or "redis" """
+    return shared_state_config()["BACKEND"]
+
+
+def redis_key(*parts) -> str:
+    """A Redis key under our KEY_PREFIX, e.g. redis_key("usage", "geocode_calls") -> "carwash:usage:geocode_calls"."""
+    return shared_state_config()["KEY_PREFIX"] + ":".join(str(part) for part in parts)
+
+
+def get_redis():
+    """
+    This process's Redis client (thread safe, with its own connection pool), created the first time.
+
+    Raises:
+        RuntimeError: If the redis package (or fakeredis, for a fakeredis:// url) isn't installed.
+    """
+    global _redis
+    with _redis_lock:
+        if _redis is None:
+            url = shared_state_config()["REDIS_URL"]
+            try:
+                if url.startswith("fakeredis://"):
+                    import fakeredis
+                    _redis = fakeredis.FakeRedis(decode_responses=True)
+                else:
+                    import redis
+                    _redis = redis.Redis.from_url(url, decode_responses=True)
+            except ImportError as e:
+                raise RuntimeError(f"The redis shared state backend needs the {e.name} package (pip install {e.name})") from e
+        return _redis
+
+
+def redis_transaction(keys: list[str], update):
+    """
+    Run update(pipe) as an optimistic Redis transaction on keys, retrying if another process changes them first.
+
+    update reads what it needs with the pipe (its commands run right away until it calls pipe.multi()), then queues its
+    writes after pipe.multi(). Whatever update returns is returned. If it returns without calling pipe.multi(), nothing is written.
+    """
+    from redis.exceptions import WatchError
+    with get_redis().pipeline() as pipe:
+        for _ in range(MAX_TRANSACTION_RETRIES):
+            try:
+                pipe.watch(*keys)
+                result = update(pipe)
+                if pipe.explicit_transaction:
+                    pipe.execute()
+                else:
+                    pipe.unwatch()
+                return result
+            except WatchError:
+                pipe.reset()
+        raise RuntimeError(f"Gave up updating {', '.join(keys)} after {MAX_TRANSACTION_RETRIES} conflicting writes")
+
+
+def get_connection(db_path: str = SHARED_STATE_DB) -> sqlite3.Connection:
+    """Get this thread's connection to the shared state database, creating the tables the first time (same setup as usage_store.py)."""
+    connections = getattr(_local, "connections", None)
+    if connections is None:
+        connections = _local.connections = {}
+    conn = connections.get(db_path)
+    if conn is None:
+        conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=30000")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS result_cache (
+                cache_key TEXT PRIMARY KEY,
+                expires_at REAL NOT NULL,
+                last_used REAL NOT NULL,
+                value_json TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS result_cache_by_last_used ON result_cache (last_used);
+            CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+                label TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated_at REAL NOT NULL
+            );
+        """)
+        connections[db_path] = conn
+    return conn
+
+
+def take_rate_limit_tokens(label: str, rate: float, capacity: float, wanted: int = 1) -> tuple[int, float]:
+    """
+    Take up to wanted tokens from the shared token bucket for label, refilled at rate tokens per second up to capacity.
+
+    Every process takes from the same bucket, so N workers together still stay under Google's QPS limits.
+    This is a cross-process write (and can wait on another process's lock), so call it from a thread, not the event loop.
+
+    Returns:
+        tuple: (tokens taken, 0 if any were taken, otherwise how many seconds to wait before trying again)
+    """
+    now = time.time()
+    if state_backend() == "redis":
+        key = redis_key("rate_limit", label)
+
+        def update(pipe):
+            bucket = pipe.hgetall(key)
+            tokens = _refill(bucket, now, rate, capacity)
+            if tokens < 1:
+                return 0, (1 - tokens) / rate
+            taken = min(wanted, int(tokens))
+            pipe.multi()
+            pipe.hset(key, mapping={"tokens": tokens - taken, "updated_at": now})
+            # An idle bucket is full again after capacity / rate seconds, so it can expire by then
+            pipe.expire(key, max(1, int(capacity / rate) + 1))
+            return taken, 0.0
+        return redis_transaction([key], update)
+
+    conn = get_connection()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute("SELECT tokens, updated_at FROM rate_limit_buckets WHERE label = ?", (label,)).fetchone()
+        tokens = _refill({"tokens": row[0], "updated_at": row[1]} if row else {}, now, rate, capacity)
+        taken, wait = 0, 0.0
+        if tokens >= 1:
+            taken = min(wanted, int(tokens))
+            tokens -= taken
+        else:
+            wait = (1 - tokens) / rate
+        conn.execute("INSERT OR REPLACE INTO rate_limit_buckets VALUES (?, ?, ?)", (label, tokens, now))
+        conn.execute("COMMIT")
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    return taken, wait
+
+
+def _refill(bucket: dict, now: float, rate: float, capacity: float) -> float:
+    """The tokens in a bucket ({"tokens", "updated_at"}, empty for a new bucket) after refilling it up to now."""
+    if not bucket:
+        return capacity
+    elapsed = max(0.0, now - float(bucket["updated_at"]))
+    return min(capacity, float(bucket["tokens"]) + elapsed * rate)
@@ -0,0 +1,254 @@
+# Turns what a rep types into a clean list of zip codes to search: zip codes (thousands of them, any separators),
+# whole states, counties, and every zip code within N km of a zip code or a point.
+#
+# Everything is checked against the bundled zip code table (data/zip_table.bin, see data/build_zip_table.py) before
+# a search starts, so typos, duplicates and retired zip codes never cost a Geocoding or Nearby Search call.
+# The table is memory mapped and its columns are used in place, so loading it is free and every worker process shares the pages.
+
+import json
+import math
+import mmap
+import os
+import re
+import struct
+import sys
+import threading
+from array import array
+from bisect import bisect_left
+
+from geocode_cache import normalize_zip_code
+from geo_utils import haversine_m, METERS_PER_DEGREE_LAT
+
+BUNDLED_ZIP_TABLE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "zip_table.bin")
+# Must match data/build_zip_table.py
+ZIP_TABLE_MAGIC = b"ZIPT"
+ZIP_TABLE_HEADER_FORMAT = "<4sIIII12x"
+FLAG_ACTIVE = 1
+FLAG_STANDARD = 2
+# "within" areas bigger than this are refused, a state is a better way to ask for that many zip codes
+MAX_WITHIN_KM = 300
+
+STATE_NAMES = {
+    "AL": "Alabama", "AK": "Alaska", "AZ": "Arizona", "AR": "Arkansas", "CA": "California", "CO": "Colorado",
+    "CT": "Connecticut", "DE": "Delaware", "DC": "District of Columbia", "FL": "Florida", "GA": "Georgia", "HI": "Hawaii",
+    "ID": "Idaho", "IL": "Illinois", "IN": "Indiana", "IA": "Iowa", "KS": "Kansas", "KY": "Kentucky", "LA": "Louisiana",
+    "ME": "Maine", "MD": "Maryland", "MA": "Massachusetts", "MI": "Michigan", "MN": "Minnesota", "MS": "Mississippi",
+    "MO": "Missouri", "MT": "Montana", "NE": "Nebraska", "NV": "Nevada", "NH": "New Hampshire", "NJ": "New Jersey",
+    "NM": "New Mexico", "NY": "New York", "NC": "North Carolina", "ND": "North Dakota", "OH": "Ohio", "OK": "Oklahoma",
+    "OR": "Oregon", "PA": "Pennsylvania", "RI": "Rhode Island", "SC": "South Carolina", "SD": "South Dakota",
+    "TN": "Tennessee", "TX": "Texas", "UT": "Utah", "VT": "Vermont", "VA": "Virginia", "WA": "Washington",
+    "WV": "West Virginia", "WI": "Wisconsin", "WY": "Wyoming", "PR": "Puerto Rico", "GU": "Guam", "VI": "U.S. Virgin Islands",
+    "AS": "American Samoa", "MP": "Northern Mariana Islands"
+}
+# "Kings County", "Orleans Parish", "Juneau City and Borough" can also be written without the suffix
+COUNTY_SUFFIXES = (" county", " parish", " borough", " city and borough", " census area", " municipality", " municipio")
+
+_load_lock = threading.Lock()
+_table = None
+
+
+def _load_table() -> dict | None:
+    """Memory map the zip code table once per process. Returns None if the file isn't there."""
+    global _table
+    with _load_lock:
+        if _table is not None or not os.path.exists(BUNDLED_ZIP_TABLE_FILE):
+            return _table
+        with open(BUNDLED_ZIP_TABLE_FILE, "rb") as file:
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, _, count, names_offset, names_length = struct.unpack_from(ZIP_TABLE_HEADER_FORMAT, data)
+        if magic != ZIP_TABLE_MAGIC:
+            raise ValueError(f"{BUNDLED_ZIP_TABLE_FILE} isn't a zip code table, rebuild it with data/build_zip_table.py")
+
+        view = memoryview(data)
+        offset = struct.calcsize(ZIP_TABLE_HEADER_FORMAT)
+        columns = {}
+        for name, type_code in (("zip_code", "I"), ("lat", "f"), ("lng", "f"), ("county", "H"), ("state", "B"), ("flags", "B")):
+            size = array(type_code).itemsize * count
+            column = view[offset:offset + size].cast(type_code)
+            if sys.byteorder != "little" and column.itemsize > 1:
+                # The file is little endian, so big endian machines get a swapped copy instead of the mapped pages
+                column = array(type_code, column)
+                column.byteswap()
+            columns[name] = column
+            offset += size
+        names = json.loads(bytes(view[names_offset:names_offset + names_length]))
+
+        states = {state: index for index, state in enumerate(names["states"])}
+        for abbreviation, state_name in STATE_NAMES.items():
+            if abbreviation in states:
+                states[state_name.lower()] = states[abbreviation]
+        counties = {}
+        for index, (county_name, state_index) in enumerate(zip(names["counties"], names["county_states"])):
+            counties.setdefault(_county_key(county_name), []).append((state_index, index))
+        # Lookups: state abbreviation (upper case) or lower case name -> state index, county name without its suffix
+        # (lower case) -> [(state index, county index)]
+        _table = {"count": count, **columns, "state_names": names["states"], "county_names": names["counties"],
+                  "states": states, "counties": counties}
+        return _table
+
+
+def _county_key(county_name: str) -> str:
+    key = county_name.strip().lower()
+    for suffix in COUNTY_SUFFIXES:
+        if key.endswith(suffix):
+            return key[:-len(suffix)].strip()
+    return key
+
+
+def _zip_string(table: dict, index: int) -> str:
+    return str(table["zip_code"][index]).zfill(5)
+
+
+def _index_of(table: dict, zip_code: str) -> int | None:
+    key = int(zip_code)
+    index = bisect_left(table["zip_code"], key)
+    if index < table["count"] and table["zip_code"][index] == key:
+        return index
+    return None
+
+
+def _active(table: dict, index: int | None) -> bool:
+    # Zip codes typed in are kept unless they're unknown or retired: a PO box or unique zip code still geocodes,
+    # and the rep asked for it by name
+    return index is not None and bool(table["flags"][index] & FLAG_ACTIVE)
+
+
+def _searchable(table: dict, index: int) -> bool:
+    # Expansions only add active standard zip codes: PO box and unique zip codes sit inside a standard one (same area,
+    # another search of it), and military ones aren't on a map
+    return table["flags"][index] & (FLAG_ACTIVE | FLAG_STANDARD) == FLAG_ACTIVE | FLAG_STANDARD
+
+
+def split_zip_codes(zip_codes: str | list[str]) -> list[str]:
+    """Split a raw zip code string (or a list of them) on commas, semicolons and whitespace."""
+    if isinstance(zip_codes, str):
+        zip_codes = [zip_codes]
+    return [value for entry in zip_codes for value in re.split(r"[\s,;]+", str(entry)) if value]
+
+
+def _state_index(table: dict, state: str) -> int | None:
+    state = state.strip()
+    return table["states"].get(state.upper() if len(state) == 2 else state.lower())
+
+
+def _expand_state(table: dict, state_index: int) -> list[int]:
+    states = table["state"]
+    return [index for index in range(table["count"]) if states[index] == state_index and _searchable(table, index)]
+
+
+def _expand_county(table: dict, county: str) -> tuple[list[int] | None, str]:
+    """(indexes of the county's zip codes, error message). county is "Kings County, NY", "Kings, NY" or just "Kings"."""
+    name, _, state = county.rpartition(",")
+    if not name:
+        name, state = state, ""
+    matches = table["counties"].get(_county_key(name), [])
+    if state.strip():
+        state_index = _state_index(table, state)
+        matches = [match for match in matches if match[0] == state_index]
+    if len(matches) > 1:
+        # "Orleans Parish" is only the one in Louisiana, "Orleans" is also a county in New York and Vermont
+        exact = [match for match in matches if table["county_names"][match[1]].lower() == name.strip().lower()]
+        matches = exact or matches
+    if not matches:
+        return None, f"Unknown county: {county}"
+    if len(matches) > 1:
+        in_states = ", ".join(table["state_names"][state_index] for state_index, _ in matches)
+        return None, f"\"{name.strip()}\" is a county in {in_states}, add the state (e.g. \"{name.strip()}, {table['state_names'][matches[0][0]]}\")"
+    county_index = matches[0][1]
+    counties = table["county"]
+    return [index for index in range(table["count"]) if counties[index] == county_index and _searchable(table, index)], ""
+
+
+def _expand_within(table: dict, center: str, km: float) -> tuple[list[int] | None, str]:
+    """(indexes of the zip codes whose centers are within km of center, error message). center is a zip code or "lat,lng"."""
+    if not 0 < km <= MAX_WITHIN_KM:
+        return None, f"The distance around {center} must be more than 0 and at most {MAX_WITHIN_KM} km"
+    if "," in center:
+        try:
+            lat, lng = (float(value) for value in center.split(","))
+        except ValueError:
+            return None, f"Can't read the point {center}, use \"lat,lng\" or a zip code"
+    else:
+        index = _index_of(table, normalize_zip_code(center)) if normalize_zip_code(center).isdigit() else None
+        if index is None or math.isnan(table["lat"][index]):
+            return None, f"Unknown zip code: {center}"
+        lat, lng = table["lat"][index], table["lng"][index]
+
+    radius_m = km * 1000
+    # A bounding box check first, so the exact distance is only worked out for the zip codes close enough to matter
+    lat_span = radius_m / METERS_PER_DEGREE_LAT
+    lng_span = lat_span / max(0.01, math.cos(math.radians(lat)))
+    lats, lngs = table["lat"], table["lng"]
+    return [index for index in range(table["count"])
+            if abs(lats[index] - lat) <= lat_span and abs(lngs[index] - lng) <= lng_span and _searchable(table, index)
+            and haversine_m(lat, lng, lats[index], lngs[index]) <= radius_m], ""
+
+
+def expand_territory(zip_codes: str | list[str] | None = None, states: list[str] | None = None, counties: list[str] | None = None,
+                     within: list[dict] | None = None, max_zip_codes: int | None = None) -> dict:
+    """
+    Expand and validate a territory into the zip codes to search.
+
+    Args:
+        zip_codes (str or list): Zip codes, as a list and/or strings separated by commas, semicolons or whitespace.
+        states (list): State abbreviations or names, e.g. "NY" or "New York".
+        counties (list): Counties, e.g. "Kings County, NY" (the state can be left out if the name is unique).
+        within (list): {"center": zip code or "lat,lng", "km": distance} areas.
+        max_zip_codes (int, optional): Refuse territories with more zip codes than this.
+
+    Returns:
+        dict: {"zip_codes" (valid zip codes, each once, in the order given then in zip code order for each expansion),
+               "invalid_zip_codes", "duplicates_removed", "sources" (how many zip codes each kind of input added),
+               "errors" (unknown states, counties and areas, or a territory that's too big)}
+    """
+    table = _load_table()
+    found = {}
+    invalid = []
+    errors = []
+    sources = {"zip_codes": 0, "states": 0, "counties": 0, "within": 0}
+    duplicates = 0
+
+    def add(zip_code: str, source: str):
+        nonlocal duplicates
+        if zip_code in found:
+            duplicates += 1
+        else:
+            found[zip_code] = source
+            sources[source] += 1
+
+    for value in split_zip_codes(zip_codes or []):
+        zip_code = normalize_zip_code(value)
+        if len(zip_code) != 5 or not zip_code.isdigit() or (table is not None and not _active(table, _index_of(table, zip_code))):
+            invalid.append(value)
+        else:
+            add(zip_code, "zip_codes")
+
+    if (states or counties or within) and table is None:
+        errors.append("States, counties and areas need the bundled zip code table, rebuild it with data/build_zip_table.py")
+    elif table is not None:
+        for state in states or []:
+            state_index = _state_index(table, state)
+            if state_index is None:
+                errors.append(f"Unknown state: {state}")
+                continue
+            for index in _expand_state(table, state_index):
+                add(_zip_string(table, index), "states")
+        for county in counties or []:
+            indexes, error = _expand_county(table, county)
+            if indexes is None:
+                errors.append(error)
+                continue
+            for index in indexes:
+                add(_zip_string(table, index), "counties")
+        for area in within or []:
+            indexes, error = _expand_within(table, str(area["center"]).strip(), float(area["km"]))
+            if indexes is None:
+                errors.append(error)
+                continue
+            for index in indexes:
+                add(_zip_string(table, index), "within")
+
+    if max_zip_codes is not None and len(found) > max_zip_codes:
+        errors.append(f"This territory has {len(found)} zip codes, searches are limited to {max_zip_codes}. Split it into smaller territories.")
+    return {"zip_codes": list(found), "num_zip_codes": len(found), "invalid_zip_codes": invalid,
+            "duplicates_removed": duplicates, "sources": sources, "errors": errors}
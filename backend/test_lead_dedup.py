@@ -0,0 +1,56 @@
+# The merge decisions of lead_dedup.py: when two leads a few doors apart are the same business, and when they aren't.
+#
+# Run from the backend folder:
+#   python -m unittest test_lead_dedup
+
+import unittest
+
+from lead_dedup import dedupe_leads
+
+
+def _lead(place_id: str, name: str, lat: float = 40.7500, lng: float = -73.9900, **fields) -> dict:
+    return {"goog_places_id": place_id, "name": name, "lat": lat, "lng": lng, **fields}
+
+
+class LeadDedupTest(unittest.TestCase):
+    def test_similar_names_nearby_are_not_merged(self):
+        # Both are just "joes" once the generic words are dropped, and there's no address or contact to back it up
+        leads = [_lead("a", "Joe's Car Wash"), _lead("b", "Joe's Auto Detailing", lat=40.7502)]
+        self.assertEqual(len(dedupe_leads(leads)), 2)
+
+    def test_same_name_nearby_is_not_merged(self):
+        leads = [_lead("a", "Joe's Car Wash"), _lead("b", "Joe's Car Wash", lat=40.7502)]
+        self.assertEqual(len(dedupe_leads(leads)), 2)
+
+    def test_same_address_is_merged(self):
+        leads = [_lead("a", "Joe's Car Wash", address="123 Main Street, New York, NY 10001"),
+                 _lead("b", "Joes Carwash & Detail", lat=40.7501, address="123 Main St, New York, NY 10001")]
+        merged = dedupe_leads(leads)
+        self.assertEqual(len(merged), 1)
+        self.assertEqual(merged[0]["duplicate_place_ids"], ["b"])
+
+    def test_different_street_numbers_are_not_merged(self):
+        leads = [_lead("a", "Joe's Car Wash", address="123 Main Street, New York, NY 10001", phone="(212) 555-0100"),
+                 _lead("b", "Joe's Car Wash", lat=40.7501, address="125 Main Street, New York, NY 10001", phone="(212) 555-0100")]
+        self.assertEqual(len(dedupe_leads(leads)), 2)
+
+    def test_same_phone_is_merged(self):
+        leads = [_lead("a", "Joe's Car Wash", phone="(212) 555-0100"),
+                 _lead("b", "Joes Carwash", lat=40.7530, phone="+1 212-555-0100")]
+        self.assertEqual(len(dedupe_leads(leads)), 1)
+
+    def test_same_phone_with_different_names_is_not_merged(self):
+        # A shared phone number (a chain's call center, a franchise owner) isn't enough without a similar name or address
+        leads = [_lead("a", "Sparkle Express Car Wash", phone="(212) 555-0100"),
+                 _lead("b", "Bubbles Auto Spa", lat=40.7530, phone="(212) 555-0100")]
+        self.assertEqual(len(dedupe_leads(leads)), 2)
+
+    def test_same_place_id_is_merged(self):
+        leads = [_lead("a", "Joe's Car Wash", zip_codes_nearby=["10001"]), _lead("a", "Joe's Car Wash", zip_codes_nearby=["10018"])]
+        merged = dedupe_leads(leads)
+        self.assertEqual(len(merged), 1)
+        self.assertEqual(sorted(merged[0]["zip_codes_nearby"]), ["10001", "10018"])
+
+
+if __name__ == "__main__":
+    unittest.main()
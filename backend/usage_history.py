@@ -0,0 +1,177 @@
+# Daily usage over any date range, cost projections and calls per search, for the analytics page.
+#
+# Reads the daily time series usage_store.py appends to. Days before yesterday can't change anymore (calls are only counted
+# today, and given back on the day they were reserved, which is at most yesterday), so each process loads them once into
+# running totals and only adds the days that closed since. Yesterday and today are read from the store on every query,
+# so counts from every worker process show up right away.
+
+import threading
+from bisect import bisect_left, bisect_right
+from calendar import monthrange
+from datetime import date, datetime, timedelta
+
+from usage_store import read_daily_usage, API_ENDPOINT_NAMES, APP_SEARCH_LABELS
+from quota_scheduler import API_LIMIT_KEYS
+from settings import get_config
+
+# USD per 1000 calls, used if the api_limit_config.json file doesn't have an API_PRICING section (see docs.md for the SKUs)
+DEFAULT_PRICES_PER_1000 = {"NEARBY_SEARCH": 35.0, "TEXT_SEARCH": 35.0, "GEOCODE": 5.0}
+DEFAULT_MONTHLY_FREE_CREDIT = 200.0
+DEFAULT_PROJECTION_DAYS = 7
+# The API calls each kind of search makes
+SEARCH_TYPE_ENDPOINTS = {
+    "zip_code_total": ["nearby_search_calls", "geocode_calls"],
+    "regional_total": ["text_search_calls"]
+}
+SERIES_NAMES = API_ENDPOINT_NAMES + APP_SEARCH_LABELS
+# Where the time series starts when a process first loads it
+HISTORY_START = "2000-01-01"
+
+_lock = threading.Lock()
+# The closed days (before yesterday) that had any usage, in order, and for each series name the running total
+# through each of those days, so the sum over any range is two binary searches and a subtraction.
+_closed_through = None
+_closed_days = []
+_closed_counts = {}
+_running_totals = {name: [] for name in SERIES_NAMES}
+
+
+def _update_closed_days(today: date):
+    """Append the days that closed since the last query to the running totals."""
+    global _closed_through
+    last_closed = str(today - timedelta(days=2))
+    with _lock:
+        if _closed_through is not None and _closed_through >= last_closed:
+            return
+        first_day = HISTORY_START if _closed_through is None else str(date.fromisoformat(_closed_through) + timedelta(days=1))
+        series = read_daily_usage(first_day, last_closed)
+        for day in sorted({day for days in series.values() for day in days}):
+            _closed_days.append(day)
+            counts = _closed_counts[day] = {name: series.get(name, {}).get(day, 0) for name in SERIES_NAMES}
+            for name in SERIES_NAMES:
+                totals = _running_totals[name]
+                totals.append((totals[-1] if totals else 0) + counts[name])
+        _closed_through = last_closed
+
+
+def _closed_sum(name: str, first_day: str, last_day: str) -> int:
+    start, end = bisect_left(_closed_days, first_day), bisect_right(_closed_days, last_day)
+    if end <= start:
+        return 0
+    totals = _running_totals[name]
+    return totals[end - 1] - (totals[start - 1] if start else 0)
+
+
+def _usage_between(first_day: date, last_day: date, today: date) -> tuple[dict, dict]:
+    """(name -> total count, day -> name -> count for the days with any usage) between two days, both included."""
+    _update_closed_days(today)
+    first, last = str(first_day), str(last_day)
+    with _lock:
+        totals = {name: _closed_sum(name, first, last) for name in SERIES_NAMES}
+        days = {day: _closed_counts[day] for day in _closed_days[bisect_left(_closed_days, first):bisect_right(_closed_days, last)]}
+    open_first = max(first_day, today - timedelta(days=1))
+    if open_first <= last_day:
+        for name, counts in read_daily_usage(str(open_first), last).items():
+            for day, count in counts.items():
+                totals[name] = totals.get(name, 0) + count
+                days.setdefault(day, {n: 0 for n in SERIES_NAMES})[name] = count
+    return totals, days
+
+
+def _read_pricing() -> tuple[dict, float, dict]:
+    """(endpoint name -> USD per call, monthly free credit, endpoint name -> monthly limit) from api_limit_config.json"""
+    config = get_config()
+    pricing = config.get("API_PRICING", {})
+    prices = {endpoint_name: pricing.get(key, DEFAULT_PRICES_PER_1000[key]) / 1000 for endpoint_name, key in API_LIMIT_KEYS.items()}
+    monthly_limits = {endpoint_name: config["API_LIMITS"][key]["MONTHLY"] for endpoint_name, key in API_LIMIT_KEYS.items()}
+    return prices, pricing.get("MONTHLY_FREE_CREDIT", DEFAULT_MONTHLY_FREE_CREDIT), monthly_limits
+
+
+def _cost(counts: dict, prices: dict) -> dict:
+    cost = {endpoint_name: round(counts.get(endpoint_name, 0) * price, 2) for endpoint_name, price in prices.items()}
+    cost["total"] = round(sum(cost.values()), 2)
+    return cost
+
+
+def get_usage_history(first_day: date | None = None, last_day: date | None = None) -> dict:
+    """
+    API calls, app searches and their cost for each day of a date range, with totals and calls per search.
+
+    Args:
+        first_day (date, optional): Defaults to 30 days before last_day.
+        last_day (date, optional): Defaults to today.
+
+    Returns:
+        dict: {"first_day", "last_day", "days" (one entry per day, including days without usage), "totals", "cost",
+               "efficiency" (per search type: searches, calls, calls_per_search, cost_per_search)}
+    """
+    today = datetime.now().date()
+    last_day = last_day or today
+    first_day = first_day or last_day - timedelta(days=29)
+    if first_day > last_day:
+        return {"error": "first_day is after last_day"}
+    prices, _, _ = _read_pricing()
+    totals, days_with_usage = _usage_between(first_day, last_day, today)
+
+    days = []
+    day = first_day
+    while day <= last_day:
+        counts = days_with_usage.get(str(day), {name: 0 for name in SERIES_NAMES})
+        days.append({"date": str(day), **counts, "cost": _cost(counts, prices)["total"]})
+        day += timedelta(days=1)
+
+    efficiency = {}
+    for search_label, endpoint_names in SEARCH_TYPE_ENDPOINTS.items():
+        searches = totals.get(search_label, 0)
+        calls = sum(totals.get(endpoint_name, 0) for endpoint_name in endpoint_names)
+        cost = sum(totals.get(endpoint_name, 0) * prices[endpoint_name] for endpoint_name in endpoint_names)
+        efficiency[search_label] = {
+            "searches": searches,
+            "calls": calls,
+            "calls_per_search": round(calls / searches, 2) if searches else None,
+            "cost_per_search": round(cost / searches, 4) if searches else None
+        }
+    return {"first_day": str(first_day), "last_day": str(last_day), "days": days, "totals": totals,
+            "cost": _cost(totals, prices), "efficiency": efficiency}
+
+
+def get_cost_projection(projection_days: int = DEFAULT_PROJECTION_DAYS) -> dict:
+    """
+    Project this month's calls and cost from the average of the last projection_days days (today included).
+
+    Returns:
+        dict: {"month", "days_left", per endpoint {"month_to_date", "daily_average", "projected", "monthly_limit",
+               "limit_reached_on" (the day the monthly limit runs out at this pace, or None)}, "cost"
+               {"month_to_date", "projected", "free_credit", "projected_after_credit"}}
+    """
+    today = datetime.now().date()
+    projection_days = max(1, projection_days)
+    prices, free_credit, monthly_limits = _read_pricing()
+    month_to_date, _ = _usage_between(today.replace(day=1), today, today)
+    recent, _ = _usage_between(today - timedelta(days=projection_days - 1), today, today)
+    days_left = monthrange(today.year, today.month)[1] - today.day
+
+    projection = {"month": today.strftime("%Y-%m"), "days_left": days_left, "projection_days": projection_days}
+    projected_counts = {}
+    for endpoint_name in API_ENDPOINT_NAMES:
+        daily_average = recent.get(endpoint_name, 0) / projection_days
+        projected = projected_counts[endpoint_name] = round(month_to_date.get(endpoint_name, 0) + daily_average * days_left)
+        calls_left = monthly_limits[endpoint_name] - month_to_date.get(endpoint_name, 0)
+        limit_reached_on = None
+        if projected > monthly_limits[endpoint_name] and daily_average > 0:
+            limit_reached_on = str(today + timedelta(days=max(0, int(calls_left // daily_average))))
+        projection[endpoint_name] = {
+            "month_to_date": month_to_date.get(endpoint_name, 0),
+            "daily_average": round(daily_average, 1),
+            "projected": projected,
+            "monthly_limit": monthly_limits[endpoint_name],
+            "limit_reached_on": limit_reached_on
+        }
+    projected_cost = _cost(projected_counts, prices)["total"]
+    projection["cost"] = {
+        "month_to_date": _cost(month_to_date, prices)["total"],
+        "projected": projected_cost,
+        "free_credit": free_credit,
+        "projected_after_credit": round(max(0.0, projected_cost - free_credit), 2)
+    }
+    return projection
@@ -0,0 +1,418 @@
+# SQLite backed store for our API call counts and app search counts.
+# Replaces the read-modify-write of search_counts_all.json, which lost increments when two searches ran at once.
+# With the redis shared state backend (see shared_state.py) the counts live in Redis instead, seeded from this store.
+#
+# Every count is also added to a daily time series (one row per day and endpoint or search label) in the same transaction,
+# so past days aren't lost when the daily count resets. usage_history.py answers date range queries from it.
+
+import json
+import os
+import sqlite3
+import threading
+from datetime import datetime
+
+from shared_state import state_backend, get_redis, redis_key, redis_transaction
+
+USAGE_DB = "usage_counts.sqlite3"
+# The old json counts file, imported once the first time the store is created
+LEGACY_COUNTS_FILE = "search_counts_all.json"
+
+API_ENDPOINT_NAMES = ["nearby_search_calls", "text_search_calls", "geocode_calls"]
+APP_SEARCH_LABELS = ["regional_total", "zip_code_total"]
+
+_local = threading.local()
+_redis_seeded = False
+
+
+def _get_connection(db_path: str = USAGE_DB) -> sqlite3.Connection:
+    """
+    Get this thread's connection to the usage database, opening (and if needed creating) it the first time.
+
+    WAL mode lets readers (the analytics page) run while a search is counting calls, and synchronous=NORMAL
+    means commits are only fsynced at checkpoints, so durable writes are batched instead of hitting the disk every call.
+    """
+    connections = getattr(_local, "connections", None)
+    if connections is None:
+        connections = _local.connections = {}
+    conn = connections.get(db_path)
+    if conn is None:
+        # isolation_level=None so we control transactions ourselves with BEGIN IMMEDIATE
+        conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=30000")
+        _initialize(conn)
+        connections[db_path] = conn
+    return conn
+
+
+def _initialize(conn: sqlite3.Connection):
+    """Create the tables, seeding them from search_counts_all.json when the store is brand new."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS api_call_counts (
+                endpoint_name TEXT PRIMARY KEY,
+                total_count INTEGER NOT NULL,
+                monthly_count INTEGER NOT NULL,
+                daily_count INTEGER NOT NULL,
+                last_call_date TEXT NOT NULL,
+                current_month INTEGER NOT NULL
+            )""")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS app_search_counts (
+                search_label TEXT PRIMARY KEY,
+                count INTEGER NOT NULL
+            )""")
+        # name is an endpoint name or an app search label. Append only: rows for past days are never rewritten
+        # (except to give back calls reserved on that day). WITHOUT ROWID keeps it to the primary key's b-tree.
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS daily_usage (
+                day TEXT NOT NULL,
+                name TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (day, name)
+            ) WITHOUT ROWID""")
+        is_new = conn.execute("SELECT 1 FROM api_call_counts LIMIT 1").fetchone() is None
+        if is_new:
+            legacy_data = {}
+            if os.path.exists(LEGACY_COUNTS_FILE):
+                with open(LEGACY_COUNTS_FILE, "r") as file:
+                    legacy_data = json.load(file)
+
+            today = datetime.now()
+            for endpoint_name in API_ENDPOINT_NAMES:
+                data = legacy_data.get(endpoint_name, {})
+                conn.execute("INSERT INTO api_call_counts VALUES (?, ?, ?, ?, ?, ?)", (
+                    endpoint_name,
+                    data.get("total_count", 0),
+                    data.get("monthly_count", 0),
+                    data.get("daily_count", 0),
+                    data.get("last_call_date", today.strftime("%Y-%m-%d")),
+                    data.get("current_month", today.month)
+                ))
+            for search_label in APP_SEARCH_LABELS:
+                count = legacy_data.get("app_search_counts", {}).get(search_label, 0)
+                conn.execute("INSERT INTO app_search_counts VALUES (?, ?)", (search_label, count))
+        if conn.execute("SELECT 1 FROM daily_usage LIMIT 1").fetchone() is None:
+            # Stores from before the time series only know the last day's counts, so that's where the history starts
+            conn.execute("INSERT INTO daily_usage SELECT last_call_date, endpoint_name, daily_count FROM api_call_counts WHERE daily_count > 0")
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def _add_daily_usage(conn: sqlite3.Connection, day: str, name: str, count: int):
+    """Add to (or with a negative count, take back from) a day's count, inside the caller's transaction."""
+    if count < 0:
+        conn.execute("UPDATE daily_usage SET count = MAX(0, count + ?) WHERE day = ? AND name = ?", (count, day, name))
+        return
+    conn.execute("INSERT INTO daily_usage VALUES (?, ?, ?) ON CONFLICT (day, name) DO UPDATE SET count = count + excluded.count",
+                 (day, name, count))
+
+
+def increment_api_call_count(endpoint_name: str, daily_limit: int, monthly_limit: int):
+    """
+    Atomically count one call to an API endpoint, unless that call would go over the daily or monthly limit.
+
+    The read, the daily/monthly resets and the increment happen in one write transaction,
+    so concurrent searches (threads or worker processes) can't lose increments.
+
+    Returns:
+        tuple: (bool within limits, str error message, dict counts) - the same as check_api_call_limit_new.
+    """
+    success, message, counts, _ = reserve_api_calls({endpoint_name: (1, daily_limit, monthly_limit)})
+    return success, message, counts[endpoint_name]
+
+
+def _read_counts(conn: sqlite3.Connection, endpoint_name: str, current_date, current_month: int) -> list:
+    """An endpoint's [total, monthly, daily] counts, with the daily and monthly counts reset if it's a new day or month."""
+    row = conn.execute("SELECT total_count, monthly_count, daily_count, last_call_date, current_month FROM api_call_counts WHERE endpoint_name = ?",
+                       (endpoint_name,)).fetchone()
+    return _reset_counts(row, current_date, current_month)
+
+
+def _reset_counts(row, current_date, current_month: int) -> list:
+    """[total, monthly, daily] from a stored (total, monthly, daily, last_call_date, current_month), or zeros if there's none yet."""
+    if row is None:
+        row = (0, 0, 0, str(current_date), current_month)
+    total_count, monthly_count, daily_count, last_call_date, stored_month = (int(row[0]), int(row[1]), int(row[2]), row[3], int(row[4]))
+
+    if current_date > datetime.strptime(last_call_date, "%Y-%m-%d").date():
+        daily_count = 0  # Reset daily count for a new day
+    if stored_month != current_month:
+        monthly_count = 0  # Reset monthly count for a new month
+    return [total_count, monthly_count, daily_count]
+
+
+def reserve_api_calls(requested_calls: dict[str, tuple[int, int, int]]):
+    """
+    Atomically count several calls to one or more API endpoints, all or nothing.
+
+    Used to reserve the calls a search is expected to make before it starts (see quota_scheduler.py). If any endpoint
+    would go over its daily or monthly limit, nothing is counted for any of them.
+
+    Args:
+        requested_calls (dict): endpoint name -> (number of calls, daily limit, monthly limit).
+
+    Returns:
+        tuple: (bool within limits, str error message, dict endpoint name -> counts after the calls,
+                str the endpoint that would go over its limit or None)
+    """
+    current_date = datetime.now().date()
+    current_month = datetime.now().month
+    if state_backend() == "redis":
+        return _reserve_api_calls_redis(requested_calls, current_date, current_month)
+
+    conn = _get_connection()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        all_counts = {}
+        for endpoint_name, (num_calls, daily_limit, monthly_limit) in requested_calls.items():
+            total_count, monthly_count, daily_count = _read_counts(conn, endpoint_name, current_date, current_month)
+
+            # Increment counts
+            total_count += num_calls
+            monthly_count += num_calls
+            daily_count += num_calls
+            all_counts[endpoint_name] = {
+                "total_calls": total_count,
+                "monthly_calls": monthly_count,
+                "daily_calls": daily_count
+            }
+
+            # If a limit is exceeded we don't save the increment, just like the old json file
+            if daily_count > daily_limit:
+                conn.execute("ROLLBACK")
+                return False, "Daily limit exceeded", all_counts, endpoint_name
+            elif monthly_count > monthly_limit:
+                conn.execute("ROLLBACK")
+                return False, "Monthly limit exceeded", all_counts, endpoint_name
+
+            conn.execute("INSERT OR REPLACE INTO api_call_counts VALUES (?, ?, ?, ?, ?, ?)",
+                         (endpoint_name, total_count, monthly_count, daily_count, str(current_date), current_month))
+            _add_daily_usage(conn, str(current_date), endpoint_name, num_calls)
+        conn.execute("COMMIT")
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    return True, "", all_counts, None
+
+
+def refund_api_calls(endpoint_name: str, num_calls: int, reserved_on: str):
+    """
+    Give back reserved calls that weren't made.
+
+    The daily count is only lowered if it's still the day the calls were reserved on (reserved_on, "YYYY-MM-DD"),
+    and the monthly count if it's still that month, so a refund never eats into a new day's or month's budget.
+    """
+    if num_calls <= 0:
+        return
+    current_date = datetime.now().date()
+    current_month = datetime.now().month
+    reserved_date = datetime.strptime(reserved_on, "%Y-%m-%d").date()
+    if state_backend() == "redis":
+        return _refund_api_calls_redis(endpoint_name, num_calls, reserved_date, current_date, current_month)
+
+    conn = _get_connection()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        total_count, monthly_count, daily_count = _refunded_counts(_read_counts(conn, endpoint_name, current_date, current_month),
+                                                                   num_calls, reserved_date, current_date)
+        conn.execute("INSERT OR REPLACE INTO api_call_counts VALUES (?, ?, ?, ?, ?, ?)",
+                     (endpoint_name, total_count, monthly_count, daily_count, str(current_date), current_month))
+        # The calls were counted on the day they were reserved, so that's the day they're taken back from
+        _add_daily_usage(conn, reserved_on, endpoint_name, -num_calls)
+        conn.execute("COMMIT")
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+
+
+def _refunded_counts(counts: list, num_calls: int, reserved_date, current_date) -> list:
+    """[total, monthly, daily] after giving back num_calls reserved on reserved_date."""
+    total_count, monthly_count, daily_count = counts
+    total_count = max(0, total_count - num_calls)
+    if reserved_date == current_date:
+        daily_count = max(0, daily_count - num_calls)
+    if (reserved_date.year, reserved_date.month) == (current_date.year, current_date.month):
+        monthly_count = max(0, monthly_count - num_calls)
+    return [total_count, monthly_count, daily_count]
+
+
+def increment_search_count(search_label: str):
+    """Atomically add one to an app search count ("regional_total" or "zip_code_total")."""
+    today = str(datetime.now().date())
+    if state_backend() == "redis":
+        _seed_redis()
+        pipe = get_redis().pipeline()
+        pipe.hincrby(redis_key("app_search_counts"), search_label, 1)
+        pipe.hincrby(redis_key("usage_daily", search_label), today, 1)
+        pipe.execute()
+        return
+    conn = _get_connection()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("INSERT INTO app_search_counts VALUES (?, 1) ON CONFLICT(search_label) DO UPDATE SET count = count + 1",
+                     (search_label,))
+        _add_daily_usage(conn, today, search_label, 1)
+        conn.execute("COMMIT")
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+
+
+def read_usage_counts() -> dict:
+    """
+    Read every count in the store.
+
+    Returns:
+        dict: The same shape as the old search_counts_all.json file.
+    """
+    if state_backend() == "redis":
+        return _read_usage_counts_redis()
+    return _read_usage_counts_sqlite()
+
+
+def _read_usage_counts_sqlite() -> dict:
+    conn = _get_connection()
+    usage = {"app_search_counts": dict(conn.execute("SELECT search_label, count FROM app_search_counts").fetchall())}
+    for endpoint_name, total_count, monthly_count, daily_count, last_call_date, current_month in conn.execute(
+            "SELECT endpoint_name, total_count, monthly_count, daily_count, last_call_date, current_month FROM api_call_counts"):
+        usage[endpoint_name] = {
+            "total_count": total_count,
+            "monthly_count": monthly_count,
+            "daily_count": daily_count,
+            "last_call_date": last_call_date,
+            "current_month": current_month
+        }
+    return usage
+
+
+def read_daily_usage(first_day: str, last_day: str) -> dict[str, dict[str, int]]:
+    """
+    The daily time series between two days ("YYYY-MM-DD", both included).
+
+    Returns:
+        dict: name (endpoint name or app search label) -> {day: count}, days without any count are left out.
+    """
+    if state_backend() == "redis":
+        return _read_daily_usage_redis(first_day, last_day)
+    series = {}
+    for day, name, count in _get_connection().execute(
+            "SELECT day, name, count FROM daily_usage WHERE day BETWEEN ? AND ?", (first_day, last_day)):
+        series.setdefault(name, {})[day] = count
+    return series
+
+
+################################################################################
+#### REDIS: the same counts as one hash per endpoint (see shared_state.py)
+#### and the daily time series as one hash per endpoint or search label (day -> count)
+################################################################################
+_COUNT_FIELDS = ("total_count", "monthly_count", "daily_count", "last_call_date", "current_month")
+
+
+def _seed_redis():
+    """
+    Copy the counts from the SQLite store into Redis the first time Redis is used, so switching backends keeps today's
+    and this month's counts. Done in one transaction, so only one worker process seeds and none counts before it's done.
+    """
+    global _redis_seeded
+    if _redis_seeded:
+        return
+    seeded_key = redis_key("usage", "seeded")
+
+    def update(pipe):
+        if pipe.exists(seeded_key):
+            return
+        usage = _read_usage_counts_sqlite()
+        pipe.multi()
+        for endpoint_name in API_ENDPOINT_NAMES:
+            pipe.hset(redis_key("usage", endpoint_name), mapping=usage[endpoint_name])
+        if usage["app_search_counts"]:
+            pipe.hset(redis_key("app_search_counts"), mapping=usage["app_search_counts"])
+        for name, days in _read_daily_usage_sqlite_all().items():
+            pipe.hset(redis_key("usage_daily", name), mapping=days)
+        pipe.set(seeded_key, datetime.now().isoformat(timespec="seconds"))
+    redis_transaction([seeded_key], update)
+    _redis_seeded = True
+
+
+def _redis_counts_row(pipe, endpoint_name: str):
+    counts = pipe.hmget(redis_key("usage", endpoint_name), _COUNT_FIELDS)
+    return None if counts[0] is None else counts
+
+
+def _reserve_api_calls_redis(requested_calls: dict, current_date, current_month: int):
+    """reserve_api_calls with the counts in Redis: the same checks, in one optimistic transaction over every endpoint's hash."""
+    _seed_redis()
+    keys = [redis_key("usage", endpoint_name) for endpoint_name in requested_calls]
+
+    def update(pipe):
+        all_counts = {}
+        new_counts = {}
+        for endpoint_name, (num_calls, daily_limit, monthly_limit) in requested_calls.items():
+            total_count, monthly_count, daily_count = _reset_counts(_redis_counts_row(pipe, endpoint_name), current_date, current_month)
+            total_count += num_calls
+            monthly_count += num_calls
+            daily_count += num_calls
+            all_counts[endpoint_name] = {"total_calls": total_count, "monthly_calls": monthly_count, "daily_calls": daily_count}
+            if daily_count > daily_limit:
+                return False, "Daily limit exceeded", all_counts, endpoint_name
+            elif monthly_count > monthly_limit:
+                return False, "Monthly limit exceeded", all_counts, endpoint_name
+            new_counts[endpoint_name] = (total_count, monthly_count, daily_count)
+
+        pipe.multi()
+        for endpoint_name, counts in new_counts.items():
+            pipe.hset(redis_key("usage", endpoint_name), mapping=dict(zip(_COUNT_FIELDS, (*counts, str(current_date), current_month))))
+            pipe.hincrby(redis_key("usage_daily", endpoint_name), str(current_date), requested_calls[endpoint_name][0])
+        return True, "", all_counts, None
+    return redis_transaction(keys, update)
+
+
+def _refund_api_calls_redis(endpoint_name: str, num_calls: int, reserved_date, current_date, current_month: int):
+    _seed_redis()
+    key = redis_key("usage", endpoint_name)
+
+    def update(pipe):
+        counts = _refunded_counts(_reset_counts(_redis_counts_row(pipe, endpoint_name), current_date, current_month),
+                                  num_calls, reserved_date, current_date)
+        pipe.multi()
+        pipe.hset(key, mapping=dict(zip(_COUNT_FIELDS, (*counts, str(current_date), current_month))))
+        pipe.hincrby(redis_key("usage_daily", endpoint_name), str(reserved_date), -num_calls)
+    redis_transaction([key], update)
+
+
+def _read_usage_counts_redis() -> dict:
+    _seed_redis()
+    redis = get_redis()
+    usage = {"app_search_counts": {label: int(count) for label, count in redis.hgetall(redis_key("app_search_counts")).items()}}
+    for endpoint_name in API_ENDPOINT_NAMES:
+        counts = redis.hgetall(redis_key("usage", endpoint_name))
+        if counts:
+            usage[endpoint_name] = {field: counts[field] if field == "last_call_date" else int(counts[field]) for field in _COUNT_FIELDS}
+    return usage
+
+
+def _read_daily_usage_sqlite_all() -> dict[str, dict[str, int]]:
+    series = {}
+    for day, name, count in _get_connection().execute("SELECT day, name, count FROM daily_usage"):
+        series.setdefault(name, {})[day] = count
+    return series
+
+
+def _read_daily_usage_redis(first_day: str, last_day: str) -> dict[str, dict[str, int]]:
+    _seed_redis()
+    redis = get_redis()
+    series = {}
+    for name in API_ENDPOINT_NAMES + APP_SEARCH_LABELS:
+        days = {day: max(0, int(count)) for day, count in redis.hgetall(redis_key("usage_daily", name)).items()
+                if first_day <= day <= last_day}
+        if days:
+            series[name] = days
+    return series
@@ -0,0 +1,194 @@
+# Picks a search radius for each zip code (auto_radius), instead of one radius the rep has to guess for the whole list.
+#
+# A radius that's right for a rural zip code saturates the 20 result cap in a city, and one that's right for a city
+# needs a dozen searches to cover a rural county. The starting radius comes from the bundled zip code area table
+# (see data/build_zip_areas.py): a circle with the same area as the zip code. Every per zip code search then records
+# whether it saturated or came back empty, and later searches of that zip code (for the same place types) shrink or
+# grow the radius from there.
+
+import csv
+import gzip
+import math
+import os
+import sqlite3
+import threading
+from array import array
+from bisect import bisect_left
+from datetime import datetime
+
+from geocode_cache import normalize_zip_code
+
+ZIP_RADIUS_DB = "zip_radius.sqlite3"
+BUNDLED_AREAS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "zip_areas.csv.gz")
+
+# Used if the api_limit_config.json file doesn't have an AUTO_RADIUS section
+DEFAULT_MIN_RADIUS = 500
+DEFAULT_MAX_RADIUS = 50000  # the largest radius Nearby Search accepts
+DEFAULT_SATURATED_SCALE = 0.7
+DEFAULT_EMPTY_SCALE = 1.5
+
+_local = threading.local()
+_load_lock = threading.Lock()
+# Sorted zip codes (as ints) and their areas in km2, loaded from BUNDLED_AREAS_FILE the first time they're needed.
+# Two flat arrays are ~340KB for every US zip code, a dict of strings to floats would be ~5MB.
+_zip_codes = None
+_areas_km2 = None
+
+
+def _load_areas():
+    global _zip_codes, _areas_km2
+    with _load_lock:
+        if _zip_codes is not None:
+            return
+        zip_codes, areas_km2 = array("I"), array("f")
+        if os.path.exists(BUNDLED_AREAS_FILE):
+            with gzip.open(BUNDLED_AREAS_FILE, "rt", encoding="utf-8", newline="") as file:
+                rows = sorted((int(row["zip_code"]), float(row["area_km2"])) for row in csv.DictReader(file))
+            for zip_code, area_km2 in rows:
+                zip_codes.append(zip_code)
+                areas_km2.append(area_km2)
+        _areas_km2 = areas_km2
+        _zip_codes = zip_codes
+
+
+def zip_area_km2(zip_code: str) -> float | None:
+    """The zip code's estimated area in km2 from the bundled table, or None if it isn't in it."""
+    if _zip_codes is None:
+        _load_areas()
+    zip_code = normalize_zip_code(zip_code)
+    if not zip_code.isdigit():
+        return None
+    key = int(zip_code)
+    index = bisect_left(_zip_codes, key)
+    if index < len(_zip_codes) and _zip_codes[index] == key:
+        return _areas_km2[index]
+    return None
+
+
+def _get_connection(db_path: str = ZIP_RADIUS_DB) -> sqlite3.Connection:
+    """Get this thread's connection to the feedback table, creating it the first time (same setup as usage_store.py)."""
+    connections = getattr(_local, "connections", None)
+    if connections is None:
+        connections = _local.connections = {}
+    conn = connections.get(db_path)
+    if conn is None:
+        conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=30000")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS radius_feedback (
+                zip_code TEXT NOT NULL,
+                types_key TEXT NOT NULL,
+                learned_radius REAL,
+                searches INTEGER NOT NULL DEFAULT 0,
+                saturated INTEGER NOT NULL DEFAULT 0,
+                empty INTEGER NOT NULL DEFAULT 0,
+                updated_at TEXT NOT NULL,
+                PRIMARY KEY (zip_code, types_key)
+            )""")
+        connections[db_path] = conn
+    return conn
+
+
+def _types_key(included_types_list: list[str]) -> str:
+    # Car washes and tire shops aren't equally dense, so each set of place types learns its own radius
+    return ",".join(sorted(included_types_list))
+
+
+def _clamp(radius: float, settings: dict) -> int:
+    return int(min(settings.get("MAX_RADIUS", DEFAULT_MAX_RADIUS), max(settings.get("MIN_RADIUS", DEFAULT_MIN_RADIUS), radius)))
+
+
+def _area_radius(area_km2: float, settings: dict) -> int:
+    # The radius of a circle with the same area as the zip code
+    return _clamp(math.sqrt(area_km2 / math.pi) * 1000, settings)
+
+
+def plan_zip_radii(zip_codes_list: list[str], included_types_list: list[str], default_radius: int, settings: dict | None = None) -> dict[str, dict]:
+    """
+    Pick the search radius for each zip code.
+
+    A radius learned from past searches of the zip code wins, then the radius of a circle with the zip code's area,
+    then default_radius for zip codes that aren't in the bundled table.
+
+    Args:
+        zip_codes_list (list): The zip codes to search.
+        included_types_list (list): Place types the search is for.
+        default_radius (int): The request's radius in meters.
+        settings (dict, optional): The AUTO_RADIUS section of api_limit_config.json.
+
+    Returns:
+        dict: zip code -> {"radius" (int meters), "source" ("learned", "area" or "default"), "area_km2" (float or None)}
+    """
+    settings = settings or {}
+    zip_codes_list = list(dict.fromkeys(zip_codes_list))
+    learned = {}
+    conn = _get_connection()
+    # Chunked so a long zip list stays under SQLite's limit on query parameters
+    for start in range(0, len(zip_codes_list), 500):
+        chunk = [normalize_zip_code(zip_code) for zip_code in zip_codes_list[start:start + 500]]
+        rows = conn.execute(f"""
+            SELECT zip_code, learned_radius FROM radius_feedback
+            WHERE types_key = ? AND learned_radius IS NOT NULL AND zip_code IN ({','.join('?' * len(chunk))})""",
+                            [_types_key(included_types_list), *chunk]).fetchall()
+        learned.update(rows)
+
+    radii = {}
+    for zip_code in zip_codes_list:
+        area_km2 = zip_area_km2(zip_code)
+        if normalize_zip_code(zip_code) in learned:
+            radii[zip_code] = {"radius": _clamp(learned[normalize_zip_code(zip_code)], settings), "source": "learned"}
+        elif area_km2 is not None:
+            radii[zip_code] = {"radius": _area_radius(area_km2, settings), "source": "area"}
+        else:
+            radii[zip_code] = {"radius": default_radius, "source": "default"}
+        radii[zip_code]["area_km2"] = None if area_km2 is None else round(area_km2, 2)
+    return radii
+
+
+def record_radius_feedback(zip_code: str, included_types_list: list[str], radius: float, saturated: bool, empty: bool,
+                           settings: dict | None = None):
+    """
+    Learn from one search of a zip code, so the next one picks a better radius.
+
+    A saturated search (it hit the 20 result cap, even if adaptive tiling split it afterwards) caps the zip code's radius
+    at SATURATED_SCALE times the radius it used. An empty one raises it to at least EMPTY_SCALE times. Both start from
+    the area radius the first time. Searches that were neither leave it as it was. Repeating the same search
+    (e.g. served from the result cache) doesn't move it further.
+    """
+    settings = settings or {}
+    if saturated:
+        new_radius = radius * settings.get("SATURATED_SCALE", DEFAULT_SATURATED_SCALE)
+    elif empty:
+        new_radius = radius * settings.get("EMPTY_SCALE", DEFAULT_EMPTY_SCALE)
+    else:
+        new_radius = None
+    key = (normalize_zip_code(zip_code), _types_key(included_types_list))
+
+    conn = _get_connection()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute("SELECT learned_radius FROM radius_feedback WHERE zip_code = ? AND types_key = ?", key).fetchone()
+        learned_radius = row[0] if row else None
+        if new_radius is not None:
+            if learned_radius is None:
+                area_km2 = zip_area_km2(zip_code)
+                learned_radius = new_radius if area_km2 is None else _area_radius(area_km2, settings)
+            learned_radius = min(learned_radius, new_radius) if saturated else max(learned_radius, new_radius)
+            learned_radius = _clamp(learned_radius, settings)
+        conn.execute("""
+            INSERT INTO radius_feedback (zip_code, types_key, learned_radius, searches, saturated, empty, updated_at)
+            VALUES (?, ?, ?, 1, ?, ?, ?)
+            ON CONFLICT (zip_code, types_key) DO UPDATE SET
+                learned_radius = excluded.learned_radius,
+                searches = searches + 1,
+                saturated = saturated + excluded.saturated,
+                empty = empty + excluded.empty,
+                updated_at = excluded.updated_at""",
+                     (*key, learned_radius, int(saturated), int(empty), datetime.now().isoformat(timespec="seconds")))
+        conn.execute("COMMIT")
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise